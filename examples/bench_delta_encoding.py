@@ -0,0 +1,81 @@
+"""
+Delta encoding of correlated frames
+===================================
+
+In this example we compare the compression ratio and the throughput of
+plain blosc compression with the temporal delta encoding
+(``write_xarray(..., delta_dim=...)``) on a series of correlated camera
+frames, for several keyframe intervals. Shots are the leading dimension,
+so that each frame is contiguous and plain blosc cannot exploit the
+similarity of consecutive frames.
+"""
+
+import os
+import time
+
+import numpy as np
+import xarray as xr
+
+from phicore.io import PhiDataFile
+
+
+rng = np.random.RandomState(42)
+
+Ns, Nx, Ny = 64, 512, 512
+
+shot = np.arange(Ns)
+x = np.arange(Nx)
+y = np.arange(Ny)
+
+# a slowly drifting beam on a fixed background pattern, with shot noise
+background = rng.randint(90, 110, size=(Nx, Ny))
+x0 = 200 + 0.5 * shot
+beam = 3000 * np.exp(-((x[None, :, None] - x0[:, None, None]) ** 2
+                       + (y[None, None, :] - 250) ** 2) / 2000)
+frames = background[None, :, :] + np.round(beam)
+frames += rng.poisson(0.2, size=frames.shape)
+
+X = xr.DataArray(frames.astype(np.uint16), dims=['shot', 'x', 'y'],
+                 coords={'shot': shot, 'x': x, 'y': y},
+                 attrs={'scale_units': {'shot': 'index', 'x': 'px',
+                                        'y': 'px'}},
+                 name='I')
+n_bytes = X.nbytes
+
+
+def _benchmark(**options):
+    fh = PhiDataFile('bench_delta.h5', 'w', force=True)
+    t0 = time.time()
+    fh.write_xarray(X, complevel=5, **options)
+    t_write = time.time() - t0
+    size = os.path.getsize(fh.fullpath)
+
+    t0 = time.time()
+    X_out = fh.read_xarray('/data/I', backend='pytables')
+    t_read = time.time() - t0
+    assert (X_out.values == X.values).all()
+
+    t0 = time.time()
+    for idx in range(Ns):
+        fh.read_xarray('/data/I', index=(idx,), backend='pytables')
+    t_frame = (time.time() - t0) / Ns
+    os.remove(fh.fullpath)
+    return n_bytes / size, n_bytes / t_write / 1e6, n_bytes / t_read / 1e6, \
+        t_frame * 1e3
+
+
+#############################################################################
+#
+# For each storage mode, we report the compression ratio, the write and read
+# throughputs in MB/s and the average time to read a single frame in ms.
+
+print('{:<22} {:>7} {:>10} {:>10} {:>10}'.format(
+    'storage', 'ratio', 'write MB/s', 'read MB/s', 'frame ms'))
+results = [('blosc', _benchmark())]
+for keyframe_interval in (4, 16, 64):
+    results.append(('delta, keyframes {}'.format(keyframe_interval),
+                    _benchmark(delta_dim='shot',
+                               keyframe_interval=keyframe_interval)))
+for name, (ratio, write, read, frame) in results:
+    print('{:<22} {:>7.2f} {:>10.0f} {:>10.0f} {:>10.2f}'.format(
+        name, ratio, write, read, frame))
@@ -1,7 +1,9 @@
 # CeCILL-B license LIDYL, CEA
 
 from .io import PhiDataFile
+from .archive import repack, verify, convert
+from .virtual import build_virtual
 
 __version__ = "0.3.2"
 
-__all__ = ['PhiDataFile']
+__all__ = ['PhiDataFile', 'repack', 'verify', 'convert', 'build_virtual']
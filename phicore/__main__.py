@@ -0,0 +1,7 @@
+# CeCILL-B license LIDYL, CEA
+
+import sys
+
+from .cli import main
+
+sys.exit(main())
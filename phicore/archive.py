@@ -0,0 +1,480 @@
+# CeCILL-B license LIDYL, CEA
+
+"""Maintenance tools operating on whole phicore files"""
+
+import os
+import hashlib
+import tempfile
+import warnings
+
+from typing import Optional, Tuple, List, Dict, Any, Union, Sequence
+
+from .utils import gen_batches, get_chunk_n_rows
+
+
+def _walk_h5(fh) -> List[Tuple[str, str, Any]]:
+    """List all links of an h5py file, parents first
+
+    Returns a list of ``(path, kind, extra)`` tuples, where ``kind`` is one
+    of {'group', 'array', 'dataset', 'virtual', 'hardlink', 'softlink',
+    'external'}. 'array' datasets can be re-encoded with PyTables, while
+    'dataset' ones (variable length strings, compound types, scalars, ...)
+    are copied as is, and 'virtual' ones are mappings to source datasets
+    (see :func:`phicore.build_virtual`). Additional names of an already
+    listed object are reported as 'hardlink' with the first path as
+    ``extra``.
+    """
+    import h5py
+
+    out = []
+    seen = {}
+
+    def _walk(group):
+        for name in group:
+            path = group.name.rstrip('/') + '/' + name
+            link = group.get(name, getlink=True)
+            if isinstance(link, h5py.SoftLink):
+                out.append((path, 'softlink', link.path))
+                continue
+            if isinstance(link, h5py.ExternalLink):
+                out.append((path, 'external', (link.filename, link.path)))
+                continue
+            obj = group[name]
+            if obj.id in seen:
+                out.append((path, 'hardlink', seen[obj.id]))
+                continue
+            seen[obj.id] = path
+            if isinstance(obj, h5py.Group):
+                out.append((path, 'group', None))
+                _walk(obj)
+            elif obj.is_virtual:
+                out.append((path, 'virtual', None))
+            elif (obj.dtype.kind in 'biufcS' and obj.shape and obj.size
+                  and h5py.check_string_dtype(obj.dtype) is None):
+                out.append((path, 'array', None))
+            else:
+                out.append((path, 'dataset', None))
+
+    _walk(fh)
+    return out
+
+
+def _walk_store(fh) -> List[Tuple[str, str, Any]]:
+    """List all nodes of a directory store, parents first
+
+    Same as :func:`_walk_h5`, but directory stores have no links.
+    """
+    out = []
+
+    def _walk(group):
+        for name, obj in group.items():
+            path = group.name.rstrip('/') + '/' + name
+            if not hasattr(obj, 'shape'):
+                out.append((path, 'group', None))
+                _walk(obj)
+            elif obj.dtype.kind in 'biufcS' and obj.shape and obj.size:
+                out.append((path, 'array', None))
+            else:
+                out.append((path, 'dataset', None))
+
+    _walk(fh)
+    return out
+
+
+def _copy_attrs(src, dst) -> None:
+    """Make the attributes of ``dst`` identical to those of ``src``"""
+    for key in list(dst.attrs):
+        if key not in src.attrs:
+            del dst.attrs[key]
+    for key in src.attrs:
+        dst.attrs.create(key, src.attrs[key],
+                         dtype=src.attrs.get_id(key).dtype)
+
+
+def _chunkshape(node, chunks, shape: Tuple[int, ...]):
+    """Chunk shape of a re-encoded array following the ``chunks`` policy"""
+    if chunks == 'auto':
+        return None
+    elif chunks == 'keep':
+        return getattr(node, 'chunkshape', None)
+    elif isinstance(chunks, (tuple, list)):
+        if len(chunks) != len(shape):
+            return None
+        return tuple(max(1, min(int(c), n)) for c, n in zip(chunks, shape))
+    raise ValueError("chunks must be one of 'auto', 'keep' or a tuple, "
+                     "got {!r}".format(chunks))
+
+
+def _iter_blocks(node, working_memory: float):
+    """Yield slices along the first axis covering ``node`` in blocks
+
+    Blocks are sized to fit in ``working_memory`` MiB and aligned with
+    the chunks of the array when it is chunked.
+    """
+    import numpy as np
+
+    n_rows = node.shape[0]
+    row_bytes = max(1, int(np.prod(node.shape[1:])) * node.dtype.itemsize)
+    batch_size = get_chunk_n_rows(row_bytes, working_memory)
+    chunkshape = getattr(node, 'chunkshape', None)
+    if chunkshape:
+        batch_size = max(chunkshape[0],
+                         batch_size // chunkshape[0] * chunkshape[0])
+    return gen_batches(n_rows, batch_size)
+
+
+def _digest_array(node, working_memory: float) -> str:
+    """Checksum of the (decoded) content of an array node"""
+    digest = hashlib.sha1()
+    for sl in _iter_blocks(node, working_memory):
+        digest.update(node[sl].tobytes())
+    return digest.hexdigest()
+
+
+def _repack_file(path: str,
+                 complib: str,
+                 complevel: int,
+                 fletcher32: bool,
+                 shuffle: bool,
+                 chunks: Union[str, Tuple[int, ...]],
+                 working_memory: float) -> Dict[str, Any]:
+    """Repack a single file, see :func:`repack`"""
+    import h5py
+    import tables as tb
+
+    size_before = os.path.getsize(path)
+    fd, tmp_path = tempfile.mkstemp(suffix='.h5', prefix='.repack-',
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    try:
+        with h5py.File(path, 'r') as src:
+            # PyTables indexes of tables (e.g. the shot table) are rebuilt
+            # rather than copied
+            plan = [item for item in _walk_h5(src)
+                    if not any(part.startswith('_i_')
+                               for part in item[0].split('/'))]
+
+        filters = tb.Filters(complevel=complevel, complib=complib,
+                             shuffle=shuffle, fletcher32=fletcher32)
+        digests = {}
+        indexes = {}
+        # PyTables is used to re-encode arrays as it supports all the
+        # compression libraries (blosc, lz4, ...) that phicore files may use
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            with tb.open_file(path, 'r') as src, \
+                    tb.open_file(tmp_path, 'w') as dst:
+                for table in src.walk_nodes('/', classname='Table'):
+                    if table.indexed:
+                        indexes[table._v_pathname] = \
+                            table.indexedcolpathnames
+                for item_path, kind, _ in plan:
+                    parent, name = os.path.split(item_path)
+                    if kind == 'group':
+                        dst.create_group(parent, name)
+                    elif kind == 'array':
+                        node = src.get_node(item_path)
+                        out = dst.create_carray(
+                            parent, name, atom=node.atom, shape=node.shape,
+                            filters=filters,
+                            chunkshape=_chunkshape(node, chunks, node.shape))
+                        digest = hashlib.sha1()
+                        for sl in _iter_blocks(node, working_memory):
+                            block = node[sl]
+                            digest.update(block.tobytes())
+                            out[sl] = block
+                        digests[item_path] = digest.hexdigest()
+
+        # everything else (links, strings, attributes) is copied with h5py,
+        # which keeps the mappings of virtual datasets to their sources
+        with h5py.File(path, 'r') as src, h5py.File(tmp_path, 'a') as dst:
+            for item_path, kind, extra in plan:
+                if kind in ('dataset', 'virtual'):
+                    src.copy(src[item_path], dst, name=item_path)
+                elif kind == 'hardlink':
+                    dst[item_path] = dst[extra]
+                elif kind == 'softlink':
+                    dst[item_path] = h5py.SoftLink(extra)
+                elif kind == 'external':
+                    dst[item_path] = h5py.ExternalLink(*extra)
+            _copy_attrs(src, dst)
+            for item_path, kind, _ in plan:
+                if kind in ('group', 'array', 'dataset', 'virtual'):
+                    _copy_attrs(src[item_path], dst[item_path])
+
+        if indexes:
+            with tb.open_file(tmp_path, 'a') as dst:
+                for table_path, columns in indexes.items():
+                    table = dst.get_node(table_path)
+                    for column in columns:
+                        table.cols._f_col(column).create_index()
+
+        # reading back validates the fletcher32 checksums of the new file
+        with tb.open_file(tmp_path, 'r') as dst:
+            for item_path, digest in digests.items():
+                if _digest_array(dst.get_node(item_path),
+                                 working_memory) != digest:
+                    raise IOError('checksum mismatch for {} after '
+                                  'repacking'.format(item_path))
+
+        try:
+            mode = os.stat(path).st_mode
+            os.chmod(tmp_path, mode & 0o7777)
+        except OSError:
+            pass
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    size_after = os.path.getsize(path)
+    return {'path': path,
+            'size_before': size_before,
+            'size_after': size_after,
+            'saved': size_before - size_after}
+
+
+def _repack_file_safe(args) -> Dict[str, Any]:
+    path, kwargs = args
+    try:
+        return _repack_file(path, **kwargs)
+    except Exception as exc:
+        return {'path': path, 'error': '{}: {}'.format(type(exc).__name__,
+                                                       exc)}
+
+
+def repack(paths: Union[str, Sequence[str]],
+           complib: str = 'zlib',
+           complevel: int = 5,
+           fletcher32: bool = True,
+           shuffle: bool = True,
+           chunks: Union[str, Tuple[int, ...]] = 'auto',
+           n_jobs: Optional[int] = 1,
+           working_memory: float = 64) -> List[Dict[str, Any]]:
+    """Rewrite phicore files with new compression and chunking settings
+
+    Each file is copied into a temporary file next to it, with all
+    ``/data``, ``/scales`` and ``/diag`` content, links and attributes.
+    Array datasets are re-encoded with the requested filters, the copy is
+    verified against checksums of the original content, and the original
+    file is then atomically replaced. As HDF5 never reclaims the space of
+    deleted or rewritten objects, this also shrinks files that were
+    modified in place. Virtual datasets are kept as mappings to their
+    source files, which are not modified.
+
+    Parameters
+    ----------
+    paths : str or list of str
+      the files to repack
+    complib : str
+      compression library to use (see pytables.Filters). Only 'zlib' can
+      be decoded by h5py, and thus by the default backend of
+      :meth:`PhiDataFile.read_xarray <phicore.io.PhiDataFile.read_xarray>`,
+      other libraries (e.g. the faster 'blosc:lz4') require reading with
+      ``backend='pytables'`` or importing ``hdf5plugin``.
+    complevel : int
+      the compression level (see pytables.Filters)
+    fletcher32 : bool
+      use fletcher32 checksums
+    shuffle : bool
+      use the shuffle filter (see pytables.Filters)
+    chunks : {'auto', 'keep'} or tuple
+      chunking policy: let PyTables compute the chunk shape ('auto'),
+      keep the existing one ('keep'), or use the given chunk shape for
+      all arrays of matching dimensionality (clipped to their shape)
+    n_jobs : int, optional
+      number of files repacked in parallel processes. None uses as many
+      processes as CPUs.
+    working_memory : float
+      maximum amount of memory in MiB used to copy each dataset
+
+    Returns
+    -------
+    report : list of dict
+      for each file, its ``path``, ``size_before``, ``size_after`` and
+      ``saved`` bytes, or an ``error`` message if repacking failed (in
+      which case the original file is left untouched)
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    _chunkshape(None, chunks, ())  # validate the chunks policy early
+    if complevel > 0 and complib != 'zlib':
+        warnings.warn("files compressed with {} cannot be read by h5py "
+                      "(the default backend of read_xarray) unless "
+                      "hdf5plugin is imported, use backend='pytables' to "
+                      "read them or complib='zlib'".format(complib))
+
+    kwargs = dict(complib=complib, complevel=complevel,
+                  fletcher32=fletcher32, shuffle=shuffle, chunks=chunks,
+                  working_memory=working_memory)
+    tasks = [(path, kwargs) for path in paths]
+
+    if n_jobs == 1 or len(tasks) <= 1:
+        return [_repack_file_safe(task) for task in tasks]
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(_repack_file_safe, tasks))
+
+
+def _verify_file(args) -> Dict[str, Any]:
+    from .io import PhiDataFile
+
+    path, working_memory = args
+    try:
+        fh = PhiDataFile(path, 'r')
+    except Exception as exc:
+        return {'path': path, 'ok': False,
+                'errors': [{'location': '/',
+                            'error': 'cannot open file: {}'.format(exc)}],
+                'n_datasets': 0, 'n_bytes': 0, 'elapsed': 0.}
+    return fh.verify(working_memory=working_memory)
+
+
+def verify(paths: Union[str, Sequence[str]],
+           n_jobs: Optional[int] = 1,
+           working_memory: float = 64) -> List[Dict[str, Any]]:
+    """Check the integrity of phicore files
+
+    Each file is checked with :meth:`phicore.io.PhiDataFile.verify`, which
+    reads all the data in bounded memory to validate checksums and checks
+    the structure of the file against the phicore file format.
+
+    Parameters
+    ----------
+    paths : str or list of str
+      the files to verify
+    n_jobs : int, optional
+      number of files verified in parallel processes. None uses as many
+      processes as CPUs.
+    working_memory : float
+      maximum amount of memory in MiB used to read each block of data
+
+    Returns
+    -------
+    report : list of dict
+      the JSON serializable report of each file, see
+      :meth:`phicore.io.PhiDataFile.verify`
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    tasks = [(path, working_memory) for path in paths]
+
+    if n_jobs == 1 or len(tasks) <= 1:
+        return [_verify_file(task) for task in tasks]
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(_verify_file, tasks))
+
+
+def convert(src: str,
+            dst: str,
+            store: Optional[str] = None,
+            force: bool = False,
+            complib: str = 'zlib',
+            complevel: int = 0,
+            working_memory: float = 64):
+    """Convert a phicore file between HDF5 and a directory store
+
+    All the ``/data``, ``/scales`` and ``/diag`` content and attributes
+    are copied. Arrays are copied in blocks of at most ``working_memory``
+    MiB. Hard links (e.g. scales shared by several variables) are stored
+    as copies in directory stores, and the shot table is re-indexed when
+    converting to HDF5.
+
+    Parameters
+    ----------
+    src : str
+      the HDF5 file or directory store to convert
+    dst : str
+      path of the converted file
+    store : {'hdf5', 'directory'}, optional
+      kind of the converted file. By default, HDF5 files are converted to
+      directory stores and directory stores to HDF5 files.
+    force : bool
+      overwrite ``dst`` if it exists
+    complib : str
+      compression library of the converted arrays (see pytables.Filters),
+      directory stores only support 'zlib'
+    complevel : int
+      the compression level (see pytables.Filters)
+    working_memory : float
+      maximum amount of memory in MiB used to copy each dataset
+
+    Returns
+    -------
+    fh : PhiDataFile
+      the converted file
+    """
+    from .io import (PhiDataFile, _SHOTS_TABLE, _create_shot_table,
+                     _missing_sources)
+
+    src_fh = PhiDataFile(src, 'r')
+    if store is None:
+        store = 'directory' if src_fh.store == 'hdf5' else 'hdf5'
+    with src_fh.open('r') as fh:
+        if src_fh.store == 'hdf5':
+            # PyTables indexes of tables are rebuilt rather than copied
+            plan = [item for item in _walk_h5(fh)
+                    if not any(part.startswith('_i_')
+                               for part in item[0].split('/'))]
+        else:
+            plan = _walk_store(fh)
+        for path, kind, _ in plan:
+            if kind in ('softlink', 'external'):
+                raise ValueError('{} is a {} link, which cannot be converted'
+                                 .format(path, kind[:-4]))
+            # the values of virtual datasets are copied, which requires
+            # all their sources
+            missing = [] if kind != 'virtual' else \
+                _missing_sources(fh[path], src_fh.fullpath)
+            if missing:
+                raise ValueError('virtual sources {} of {} not found'
+                                 .format(', '.join(missing), path))
+
+    dst_fh = PhiDataFile(dst, 'w', force=force, store=store)
+    # array values are copied with the backends supporting compression,
+    # everything else with the h5py-like ones
+    src_backend = src_fh._backend('pytables')
+    dst_backend = dst_fh._backend('pytables')
+    rebuild_shots = store == 'hdf5' and any(path == _SHOTS_TABLE
+                                            for path, _, _ in plan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with src_fh.open('r', backend=src_backend.name) as src_h, \
+                dst_fh.open('a', backend=dst_backend.name) as dst_h:
+            for path, kind, _ in plan:
+                if path == _SHOTS_TABLE and rebuild_shots:
+                    _create_shot_table(dst_h, src_backend.read(
+                        src_backend.get_node(src_h, path)))
+                if kind not in ('array', 'virtual'):
+                    continue
+                node = src_backend.get_node(src_h, path)
+                out = dst_backend.create_dataset(
+                    dst_h, path, shape=node.shape, dtype=node.dtype,
+                    complib=complib, complevel=complevel)
+                for sl in _iter_blocks(node, working_memory):
+                    out[sl] = src_backend.read(node, (sl,))
+
+    src_backend = src_fh._backend('h5py')
+    dst_backend = dst_fh._backend('h5py')
+    with src_fh.open('r') as src_h, dst_fh.open('a') as dst_h:
+        dst_h.attrs.update(src_backend.attrs(src_h))
+        for path, kind, extra in plan:
+            if path == _SHOTS_TABLE and rebuild_shots:
+                continue
+            if kind == 'hardlink':
+                dst_h[path] = dst_h[extra]
+                continue
+            node = src_backend.get_node(src_h, path)
+            if kind == 'group':
+                dst_h.require_group(path)
+            elif kind == 'dataset':
+                dst_backend.create_dataset(dst_h, path,
+                                           src_backend.read(node),
+                                           fletcher32=False)
+            dst_backend.get_node(dst_h, path).attrs.update(
+                src_backend.attrs(node))
+    return dst_fh
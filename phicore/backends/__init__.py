@@ -0,0 +1,72 @@
+# CeCILL-B license LIDYL, CEA
+
+"""Storage backends of phicore files
+
+:class:`phicore.io.PhiDataFile` accesses its store through a
+:class:`Backend` selected by name (the ``backend`` parameter of its
+methods). The 'h5py' and 'pytables' backends read and write HDF5 files,
+the 'directory' backend chunked directory stores. A new storage engine is
+added by subclassing :class:`Backend` and registering an instance with
+:func:`register_backend`.
+"""
+
+from .base import Backend
+from .hdf5 import H5pyBackend, PyTablesBackend
+from .directory import DirectoryBackend, is_directory_store
+
+
+# registered backends by name
+_BACKENDS = {}
+# backend used for each kind of store when the requested one cannot
+# access it
+_DEFAULT_BACKENDS = {'hdf5': 'h5py', 'directory': 'directory'}
+
+
+def register_backend(backend: Backend) -> None:
+    """Make ``backend`` available under its ``name``
+
+    Parameters
+    ----------
+    backend : Backend
+      an instance of a :class:`Backend` subclass
+    """
+    _BACKENDS[backend.name] = backend
+    _DEFAULT_BACKENDS.setdefault(backend.store, backend.name)
+
+
+def get_backend(name: str, store: str = 'hdf5') -> Backend:
+    """Backend registered under ``name``
+
+    Parameters
+    ----------
+    name : str
+      name of the backend, e.g. 'h5py' or 'pytables'
+    store : str
+      kind of store to access. When backend ``name`` cannot access it
+      (e.g. 'pytables' for a directory store), the default backend of
+      ``store`` is returned instead, so that the default backends of the
+      :class:`phicore.io.PhiDataFile` methods work with all stores.
+
+    Returns
+    -------
+    backend : Backend
+      the registered instance
+    """
+    if name not in _BACKENDS:
+        raise ValueError('unknown backend {}, expected one of {}'
+                         .format(name, sorted(_BACKENDS)))
+    if store not in _DEFAULT_BACKENDS:
+        raise ValueError('unknown store {}, expected one of {}'
+                         .format(store, sorted(_DEFAULT_BACKENDS)))
+    backend = _BACKENDS[name]
+    if backend.store != store:
+        backend = _BACKENDS[_DEFAULT_BACKENDS[store]]
+    return backend
+
+
+register_backend(H5pyBackend())
+register_backend(PyTablesBackend())
+register_backend(DirectoryBackend())
+
+__all__ = ['Backend', 'H5pyBackend', 'PyTablesBackend', 'DirectoryBackend',
+           'get_backend', 'register_backend', 'is_directory_store']
@@ -0,0 +1,139 @@
+# CeCILL-B license LIDYL, CEA
+
+from typing import Optional, Tuple, List, Dict, Any
+
+
+class Backend(object):
+    """Storage engine used by :class:`phicore.io.PhiDataFile`
+
+    A backend opens a kind of store (``store``, e.g. 'hdf5') and gives
+    access to its nodes, identified by their absolute path (e.g.
+    ``/data/I``). The default implementations of the node methods assume
+    handles following the h5py API, so that such backends only need to
+    implement :meth:`open` and :meth:`create_dataset`.
+    """
+    #: name under which the backend is registered
+    name = None  # type: Optional[str]
+    #: kind of store accessed by the backend
+    store = None  # type: Optional[str]
+
+    def open(self, target, mode: str, filters=None):
+        """Open a store
+
+        Parameters
+        ----------
+        target : {str, io.BytesIO}
+          path of the store, or a buffer holding its in-memory image
+        mode : str
+          'r', 'r+', 'a' or 'w'
+        filters : obj, optional
+          default compression filters, only used by PyTables
+
+        Returns
+        -------
+        fh : obj
+          a handle on the root of the store, usable as a context manager
+        """
+        raise NotImplementedError
+
+    def open_for_create(self, target, filters=None):
+        """Open a store to only create new nodes in it
+
+        The default implementation opens ``target`` in 'a' mode. Backends
+        for which opening an in-memory image is costly can instead return
+        a handle on an empty store whose nodes are added to ``target`` on
+        close, since the handle is not used to access existing nodes.
+
+        Parameters
+        ----------
+        target : {str, io.BytesIO}
+          path of the store, or a buffer holding its in-memory image
+        filters : obj, optional
+          default compression filters, only used by PyTables
+
+        Returns
+        -------
+        fh : obj
+          a handle on the root of the store, usable as a context manager
+        """
+        return self.open(target, 'a', filters=filters)
+
+    def create_dataset(self, fh, name: str, data=None,
+                       shape: Optional[Tuple[int, ...]] = None, dtype=None,
+                       fletcher32: bool = True, complib: str = 'blosc:lz4',
+                       complevel: int = 0, chunks=None, **args):
+        """Create a dataset, and its parent groups
+
+        Either ``data`` or ``shape`` and ``dtype`` (for an empty dataset)
+        must be given. See :meth:`phicore.io.PhiDataFile.create_dataset`
+        for the other parameters.
+
+        Returns
+        -------
+        node : obj
+          the new dataset
+        """
+        raise NotImplementedError
+
+    def get_node(self, fh, path: str):
+        """Group or dataset at ``path``"""
+        return fh[path]
+
+    def contains(self, fh, path: str) -> bool:
+        """Whether a node exists at ``path``"""
+        return path in fh
+
+    def remove(self, fh, path: str) -> None:
+        """Remove the node at ``path``, recursively for groups"""
+        del fh[path]
+
+    def list_nodes(self, fh, path: str) -> List[str]:
+        """Sorted names of the children of the group at ``path``"""
+        return sorted(fh[path].keys())
+
+    def attrs(self, node) -> Dict[str, Any]:
+        """Attributes of a node"""
+        return dict(node.attrs.items())
+
+    def missing_sources(self, node, fullpath: str,
+                        index: Tuple[Any, ...] = ()) -> List[str]:
+        """Sources of a virtual dataset that cannot be found
+
+        The default implementation supports h5py datasets, other nodes
+        are not virtual.
+
+        Parameters
+        ----------
+        node : obj
+          a node returned by :meth:`get_node`
+        fullpath : str
+          path of the store, from which relative source paths are resolved
+        index : tuple
+          normalized index of the region to check, by default the whole
+          dataset
+
+        Returns
+        -------
+        missing : list of str
+          the missing sources, as ``<file>:<dataset>``
+        """
+        from ..io import _missing_sources
+        return _missing_sources(node, fullpath, index)
+
+    def read(self, node, index: Tuple[Any, ...] = ()):
+        """Read a hyperslab of a dataset
+
+        Parameters
+        ----------
+        node : obj
+          a dataset returned by :meth:`get_node`
+        index : tuple
+          ints and slices (with positive steps) selecting the hyperslab.
+          By default the whole dataset is read.
+
+        Returns
+        -------
+        values : numpy.ndarray
+          the selected values
+        """
+        return node[index]
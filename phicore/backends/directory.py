@@ -0,0 +1,582 @@
+# CeCILL-B license LIDYL, CEA
+
+"""Chunked directory stores
+
+A directory store keeps the layout of a phicore HDF5 file (``/data``,
+``/scales``, ``/diag``) in a directory tree: each group is a directory
+and each dataset a directory holding one file per chunk. Since a chunk is
+only ever written by replacing its file, several processes can write
+disjoint chunk-aligned regions of the same store in parallel, without
+the global lock of the HDF5 library.
+"""
+
+import os
+import json
+import uuid
+import zlib
+import base64
+import shutil
+import struct
+import operator
+import itertools
+
+from collections.abc import MutableMapping
+from typing import Optional, Tuple, List, Dict, Any
+
+from .base import Backend
+
+
+_ATTRS_FILE = '.attrs.json'
+_ARRAY_FILE = '.array.json'
+# target size in bytes of automatically chosen chunks
+_CHUNK_BYTES = 2 ** 20
+
+
+def _write_atomic(path: str, content: bytes) -> None:
+    """Replace the file at ``path``, never leaving it partially written"""
+    tmp_path = os.path.join(os.path.dirname(path), '.{}.{}.tmp'.format(
+        os.path.basename(path), uuid.uuid4().hex))
+    with open(tmp_path, 'wb') as fd:
+        fd.write(content)
+    os.replace(tmp_path, path)
+
+
+def _encode_attr(value):
+    """Convert an attribute value to a JSON serializable object"""
+    import h5py
+    import numpy as np
+
+    if isinstance(value, h5py.Empty):
+        # e.g. the empty titles of PyTables nodes
+        return {'__empty__': value.dtype.str}
+    if isinstance(value, (np.ndarray, np.generic)):
+        array = np.asarray(value)
+        return {'__ndarray__': [_encode_attr(el)
+                                for el in array.ravel().tolist()],
+                'dtype': array.dtype.str, 'shape': list(array.shape),
+                'scalar': isinstance(value, np.generic)}
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, complex):
+        return {'__complex__': [value.real, value.imag]}
+    if isinstance(value, (list, tuple)):
+        return [_encode_attr(el) for el in value]
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    raise TypeError('attributes of type {} are not supported by directory '
+                    'stores'.format(type(value).__name__))
+
+
+def _decode_attr(value):
+    """Inverse of :func:`_encode_attr`"""
+    import h5py
+    import numpy as np
+
+    if isinstance(value, list):
+        return [_decode_attr(el) for el in value]
+    if not isinstance(value, dict):
+        return value
+    if '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    if '__complex__' in value:
+        return complex(*value['__complex__'])
+    if '__empty__' in value:
+        return h5py.Empty(value['__empty__'])
+    array = np.array([_decode_attr(el) for el in value['__ndarray__']],
+                     dtype=value['dtype']).reshape(value['shape'])
+    if value['scalar']:
+        return array[()]
+    return array
+
+
+def _dtype_to_json(dtype):
+    if dtype.names is not None:
+        return dtype.descr
+    return dtype.str
+
+
+def _dtype_from_json(value):
+    import numpy as np
+
+    if isinstance(value, str):
+        return np.dtype(value)
+    return np.dtype([tuple(el[:2]) + tuple(tuple(shape) for shape in el[2:])
+                     for el in value])
+
+
+def _auto_chunks(shape: Tuple[int, ...], itemsize: int) -> Tuple[int, ...]:
+    """Chunk shape of about ``_CHUNK_BYTES``, halving the longest axes"""
+    chunks = [max(1, size) for size in shape]
+    n_items = 1
+    for size in chunks:
+        n_items *= size
+    while n_items * itemsize > _CHUNK_BYTES and max(chunks) > 1:
+        axis = chunks.index(max(chunks))
+        n_items = n_items // chunks[axis] * ((chunks[axis] + 1) // 2)
+        chunks[axis] = (chunks[axis] + 1) // 2
+    return tuple(chunks)
+
+
+def _selection(index, shape: Tuple[int, ...]):
+    """Convert an index of ints and slices to ``(start, step, count,
+    is_int)`` tuples for each axis"""
+    if not isinstance(index, tuple):
+        index = (index,)
+    if any(el is Ellipsis for el in index):
+        position = [el is Ellipsis for el in index].index(True)
+        n_missing = len(shape) - len(index) + 1
+        index = (index[:position] + (slice(None),) * n_missing
+                 + index[position + 1:])
+    if len(index) > len(shape):
+        raise IndexError('too many indices ({}) for a {}D dataset'
+                         .format(len(index), len(shape)))
+    index = index + (slice(None),) * (len(shape) - len(index))
+
+    out = []
+    for idx, size in zip(index, shape):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(size)
+            if step < 1:
+                raise IndexError('only positive slice steps are supported')
+            out.append((start, step, len(range(start, stop, step)), False))
+            continue
+        try:
+            idx = operator.index(idx)
+        except TypeError:
+            raise TypeError('index elements must be int or slice, got {}'
+                            .format(type(idx).__name__))
+        if not -size <= idx < size:
+            raise IndexError('index {} is out of bounds for axis with size '
+                             '{}'.format(idx, size))
+        out.append((idx % size, 1, 1, True))
+    return out
+
+
+class _Attributes(MutableMapping):
+    """Attributes of a node, stored in a JSON file
+
+    The file is read on each access, so that changes made by other
+    processes are visible, and replaced atomically on each change.
+    """
+    def __init__(self, node):
+        self._node = node
+        self._path = os.path.join(node._dirname, _ATTRS_FILE)
+
+    def _load(self) -> Dict[str, Any]:
+        with open(self._path, 'r') as fd:
+            return json.load(fd)
+
+    def _dump(self, attrs: Dict[str, Any]) -> None:
+        self._node._check_writable()
+        _write_atomic(self._path, json.dumps(attrs).encode('utf-8'))
+
+    def __getitem__(self, key: str):
+        return _decode_attr(self._load()[key])
+
+    def __setitem__(self, key: str, value) -> None:
+        self.update({key: value})
+
+    def __delitem__(self, key: str) -> None:
+        attrs = self._load()
+        del attrs[key]
+        self._dump(attrs)
+
+    def __iter__(self):
+        return iter(list(self._load()))
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+    def __contains__(self, key) -> bool:
+        return key in self._load()
+
+    def items(self):
+        return [(key, _decode_attr(val))
+                for key, val in self._load().items()]
+
+    def update(self, *args, **kwargs) -> None:
+        """Set several attributes in a single write"""
+        attrs = self._load()
+        for key, value in dict(*args, **kwargs).items():
+            attrs[key] = _encode_attr(value)
+        self._dump(attrs)
+
+
+class _Node(object):
+    def __init__(self, root: str, name: str, writable: bool):
+        self._root = root
+        self.name = name
+        self._writable = writable
+
+    @property
+    def _dirname(self) -> str:
+        return os.path.join(self._root, *self.name.strip('/').split('/'))
+
+    @property
+    def attrs(self) -> _Attributes:
+        return _Attributes(self)
+
+    @property
+    def parent(self) -> 'DirectoryGroup':
+        return DirectoryGroup(self._root, os.path.dirname(self.name),
+                              self._writable)
+
+    def _check_writable(self) -> None:
+        if not self._writable:
+            raise IOError('{} is opened read-only'.format(self._root))
+
+
+class DirectoryArray(_Node):
+    """Dataset of a directory store, with an h5py-like interface
+
+    Datasets are indexed with ints and slices (with positive steps). Only
+    the chunks intersecting the selected region are read or written.
+    """
+    def __init__(self, root: str, name: str, writable: bool):
+        super(DirectoryArray, self).__init__(root, name, writable)
+        with open(os.path.join(self._dirname, _ARRAY_FILE), 'r') as fd:
+            meta = json.load(fd)
+        self.shape = tuple(meta['shape'])
+        self.dtype = _dtype_from_json(meta['dtype'])
+        self.chunks = tuple(meta['chunks'])
+        self.compression = meta['compression']
+        self.compression_opts = meta['compression_opts']
+        self.fletcher32 = meta['checksum'] is not None
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        size = 1
+        for el in self.shape:
+            size *= el
+        return size
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def _chunk_path(self, key: Tuple[int, ...]) -> str:
+        return os.path.join(self._dirname,
+                            '.'.join(str(el) for el in key) or '0')
+
+    def _chunk_shape(self, key: Tuple[int, ...]) -> Tuple[int, ...]:
+        return tuple(min(chunk, size - idx * chunk) for idx, chunk, size
+                     in zip(key, self.chunks, self.shape))
+
+    def _read_chunk(self, key: Tuple[int, ...]):
+        """Values of a chunk, or None if it was never written"""
+        import numpy as np
+
+        try:
+            with open(self._chunk_path(key), 'rb') as fd:
+                content = fd.read()
+        except FileNotFoundError:
+            return None
+        if self.fletcher32:
+            content, checksum = content[:-4], content[-4:]
+            if struct.pack('<I', zlib.crc32(content)) != checksum:
+                raise IOError('checksum mismatch in chunk {} of {}'
+                              .format(key, self.name))
+        if self.compression is not None:
+            content = zlib.decompress(content)
+        return np.frombuffer(content, dtype=self.dtype) \
+            .reshape(self._chunk_shape(key))
+
+    def _write_chunk(self, key: Tuple[int, ...], values) -> None:
+        import numpy as np
+
+        content = np.ascontiguousarray(values, dtype=self.dtype).tobytes()
+        if self.compression is not None:
+            content = zlib.compress(content, self.compression_opts)
+        if self.fletcher32:
+            content += struct.pack('<I', zlib.crc32(content))
+        _write_atomic(self._chunk_path(key), content)
+
+    def _iter_chunks(self, selection):
+        """Yield the chunks intersecting a selection
+
+        For each chunk, yields its key, the index of the selected values
+        in the chunk and their index in the selected region.
+        """
+        ranges = []
+        for (start, step, count, _), chunk in zip(selection, self.chunks):
+            if count == 0:
+                return
+            last = start + (count - 1) * step
+            ranges.append(range(start // chunk, last // chunk + 1))
+        for key in itertools.product(*ranges):
+            src = []
+            dst = []
+            for idx, (start, step, count, _), chunk in zip(key, selection,
+                                                           self.chunks):
+                low = idx * chunk
+                # positions of the first and after the last selected
+                # values of the chunk in the selected region
+                first = max(0, -(-(low - start) // step))
+                stop = min(count, -(-(low + chunk - start) // step))
+                if first >= stop:
+                    break
+                offset = start + first * step - low
+                src.append(slice(offset,
+                                 offset + (stop - first - 1) * step + 1,
+                                 step))
+                dst.append(slice(first, stop))
+            else:
+                yield key, tuple(src), tuple(dst)
+
+    def __getitem__(self, index):
+        import numpy as np
+
+        selection = _selection(index, self.shape)
+        out = np.zeros([el[2] for el in selection], dtype=self.dtype)
+        for key, src, dst in self._iter_chunks(selection):
+            values = self._read_chunk(key)
+            if values is not None:
+                out[dst] = values[src]
+        return out[tuple(0 if el[3] else slice(None) for el in selection)]
+
+    def __setitem__(self, index, values) -> None:
+        import numpy as np
+
+        self._check_writable()
+        selection = _selection(index, self.shape)
+        shape = [el[2] for el in selection]
+        values = np.broadcast_to(
+            np.asarray(values, dtype=self.dtype),
+            [size for size, el in zip(shape, selection) if not el[3]]) \
+            .reshape(shape)
+        for key, src, dst in self._iter_chunks(selection):
+            chunk_shape = self._chunk_shape(key)
+            if all(sl.step == 1 and sl.stop - sl.start == size
+                   for sl, size in zip(src, chunk_shape)):
+                chunk = values[dst]
+            else:
+                chunk = self._read_chunk(key)
+                if chunk is None:
+                    chunk = np.zeros(chunk_shape, dtype=self.dtype)
+                else:
+                    chunk = chunk.copy()
+                chunk[src] = values[dst]
+            self._write_chunk(key, chunk)
+
+    def __array__(self, dtype=None):
+        import numpy as np
+        return np.asarray(self[()], dtype=dtype)
+
+    def __repr__(self) -> str:
+        return '<DirectoryArray {}: shape {}, type {}>'.format(
+            self.name, self.shape, self.dtype.str)
+
+
+class DirectoryGroup(_Node):
+    """Group of a directory store, with an h5py-like interface
+
+    Paths starting with '/' are relative to the root of the store. Hard
+    links (``group[path] = node``) are stored as copies.
+    """
+    def _path(self, path: str) -> str:
+        if not path.startswith('/'):
+            path = self.name.rstrip('/') + '/' + path
+        return '/' + '/'.join(el for el in path.split('/') if el)
+
+    def _node_dir(self, path: str) -> str:
+        return os.path.join(self._root, *path.strip('/').split('/'))
+
+    def __contains__(self, path: str) -> bool:
+        return os.path.exists(os.path.join(self._node_dir(self._path(path)),
+                                           _ATTRS_FILE))
+
+    def __getitem__(self, path: str):
+        path = self._path(path)
+        dirname = self._node_dir(path)
+        if not os.path.exists(os.path.join(dirname, _ATTRS_FILE)):
+            raise KeyError('{} not found in {}'.format(path, self._root))
+        if os.path.exists(os.path.join(dirname, _ARRAY_FILE)):
+            return DirectoryArray(self._root, path, self._writable)
+        return DirectoryGroup(self._root, path, self._writable)
+
+    def get(self, path: str, default=None):
+        if path in self:
+            return self[path]
+        return default
+
+    def keys(self) -> List[str]:
+        return sorted(name for name in os.listdir(self._dirname)
+                      if not name.startswith('.')
+                      and name in self)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def values(self):
+        return [self[name] for name in self.keys()]
+
+    def _create_node(self, path: str) -> str:
+        """Create the directory of a new node and its parent groups"""
+        self._check_writable()
+        if path in self:
+            raise ValueError('Unable to create {} (name already exists)'
+                             .format(path))
+        parent = self._path(path).rsplit('/', 1)[0]
+        if parent and parent not in self:
+            self.create_group(parent)
+        elif parent and os.path.exists(os.path.join(
+                self._node_dir(parent), _ARRAY_FILE)):
+            raise ValueError('Unable to create {} ({} is a dataset)'
+                             .format(path, parent))
+        dirname = self._node_dir(self._path(path))
+        os.makedirs(dirname, exist_ok=True)
+        return dirname
+
+    def create_group(self, path: str) -> 'DirectoryGroup':
+        dirname = self._create_node(path)
+        _write_atomic(os.path.join(dirname, _ATTRS_FILE), b'{}')
+        return self[path]
+
+    def require_group(self, path: str) -> 'DirectoryGroup':
+        if path in self:
+            return self[path]
+        return self.create_group(path)
+
+    def create_dataset(self, path: str, shape=None, dtype=None, data=None,
+                       chunks=None, fletcher32: bool = False,
+                       compression: Optional[str] = None,
+                       compression_opts: Optional[int] = None
+                       ) -> DirectoryArray:
+        """Create a dataset, see h5py.Group.create_dataset
+
+        Only the 'gzip' (or equivalently 'zlib') compression is
+        supported, and ``fletcher32`` enables CRC32 checksums.
+        """
+        import numpy as np
+
+        if data is not None:
+            data = np.asarray(data, dtype=dtype)
+            shape, dtype = data.shape, data.dtype
+        if shape is None or dtype is None:
+            raise TypeError('either data or shape and dtype must be given')
+        shape = tuple(int(el) for el in shape)
+        dtype = np.dtype(dtype)
+        if dtype.hasobject:
+            raise TypeError('object arrays are not supported by directory '
+                            'stores')
+        if compression not in (None, 'gzip', 'zlib'):
+            raise ValueError('compression {} is not supported by directory '
+                             'stores, use zlib'.format(compression))
+        if chunks in (None, True):
+            chunks = _auto_chunks(shape, dtype.itemsize)
+        elif len(chunks) != len(shape):
+            raise ValueError('chunks {} do not match the shape {}'
+                             .format(chunks, shape))
+        meta = {'shape': shape, 'dtype': _dtype_to_json(dtype),
+                'chunks': [max(1, min(int(chunk), max(size, 1)))
+                           for chunk, size in zip(chunks, shape)],
+                'compression': None if compression is None else 'zlib',
+                'compression_opts': (None if compression is None
+                                     else int(4 if compression_opts is None
+                                              else compression_opts)),
+                'checksum': 'crc32' if fletcher32 else None}
+
+        dirname = self._create_node(path)
+        _write_atomic(os.path.join(dirname, _ARRAY_FILE),
+                      json.dumps(meta).encode('utf-8'))
+        _write_atomic(os.path.join(dirname, _ATTRS_FILE), b'{}')
+        node = self[path]
+        if data is not None and data.size:
+            node[()] = data
+        return node
+
+    def __setitem__(self, path: str, value) -> None:
+        if isinstance(value, _Node):
+            self._check_writable()
+            if path in self:
+                raise ValueError('Unable to create {} (name already exists)'
+                                 .format(path))
+            parent = self._path(path).rsplit('/', 1)[0]
+            if parent:
+                self.require_group(parent)
+            shutil.copytree(value._dirname,
+                            self._node_dir(self._path(path)))
+        else:
+            self.create_dataset(path, data=value)
+
+    def __delitem__(self, path: str) -> None:
+        self._check_writable()
+        if path not in self:
+            raise KeyError('{} not found in {}'.format(path, self._root))
+        shutil.rmtree(self._node_dir(self._path(path)))
+
+    def close(self) -> None:
+        """Nothing to release, the store is accessed file by file"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def __repr__(self) -> str:
+        return '<DirectoryGroup {} of {}>'.format(self.name, self._root)
+
+
+def is_directory_store(path: str) -> bool:
+    """Whether ``path`` is the root of a directory store"""
+    return os.path.isfile(os.path.join(path, _ATTRS_FILE))
+
+
+class DirectoryBackend(Backend):
+    """Chunked directory stores, see :mod:`phicore.backends.directory`
+
+    Only the zlib compression is supported (``complib='zlib'``), and
+    ``fletcher32`` enables CRC32 checksums of the chunks.
+    """
+    name = 'directory'
+    store = 'directory'
+
+    def open(self, target, mode: str, filters=None):
+        if not isinstance(target, str):
+            raise ValueError('directory stores cannot be kept in memory')
+        if mode in ('w', 'w+'):
+            if os.path.exists(target):
+                if not (is_directory_store(target)
+                        or (os.path.isdir(target) and not os.listdir(target))):
+                    raise IOError('{} exists and is not a directory store'
+                                  .format(target))
+                shutil.rmtree(target)
+            os.makedirs(target)
+            _write_atomic(os.path.join(target, _ATTRS_FILE), b'{}')
+        elif not is_directory_store(target):
+            if mode in ('a', 'a+') and not os.path.exists(target):
+                return self.open(target, 'w')
+            raise IOError('{} is not a directory store'.format(target))
+        return DirectoryGroup(target, '/', mode != 'r')
+
+    def create_dataset(self, fh, name: str, data=None,
+                       shape: Optional[Tuple[int, ...]] = None, dtype=None,
+                       fletcher32: bool = True, complib: str = 'blosc:lz4',
+                       complevel: int = 0, chunks=None, **args):
+        if complevel > 0 and complib.split(':')[0] != 'zlib':
+            raise ValueError("The directory backend only supports the zlib "
+                             "compression, set 'complib' to 'zlib' or "
+                             "'complevel' to 0.")
+        return fh.create_dataset(name, shape=shape, dtype=dtype, data=data,
+                                 chunks=chunks, fletcher32=fletcher32,
+                                 compression='zlib' if complevel else None,
+                                 compression_opts=complevel or None, **args)
+
+    def list_nodes(self, fh, path: str) -> List[str]:
+        return fh[path].keys()
+
+    def missing_sources(self, node, fullpath: str,
+                        index: Tuple[Any, ...] = ()) -> List[str]:
+        # directory stores have no virtual datasets
+        return []
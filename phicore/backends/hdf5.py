@@ -0,0 +1,208 @@
+# CeCILL-B license LIDYL, CEA
+
+"""Backends reading and writing HDF5 files with h5py or PyTables"""
+
+import io
+import os
+import warnings
+import contextlib
+
+from typing import Optional, Tuple, List, Dict, Any
+
+from .base import Backend
+
+
+def _open_image(buf, mode: str, filters=None):
+    """Open the in-memory image of a file with PyTables
+
+    Changes are copied back to ``buf`` on close.
+    """
+    import tables as tb
+
+    class _ImageFile(tb.File):
+        def close(self):
+            if self.isopen and self.mode != 'r':
+                self.flush()
+                image = self.get_file_image()
+                buf.seek(0)
+                buf.truncate()
+                buf.write(image)
+            super(_ImageFile, self).close()
+
+    # the name is only used by PyTables to track open files
+    return _ImageFile('<in-memory {}>'.format(id(buf)), mode,
+                      filters=filters, driver='H5FD_CORE',
+                      driver_core_image=buf.getvalue(),
+                      driver_core_backing_store=0)
+
+
+def _copy_new_nodes(src, dst) -> None:
+    """Copy the nodes of the h5py group ``src`` missing from ``dst``"""
+    for name, node in src.items():
+        if name not in dst:
+            src.copy(node, dst, name=name)
+        elif hasattr(node, 'keys'):
+            _copy_new_nodes(node, dst[name])
+
+
+def _open_scratch_image(buf, filters=None):
+    """Open an empty in-memory file with PyTables
+
+    Its nodes are copied (with h5py, which copies compressed chunks as
+    they are) to the image in ``buf`` on close, so that the cost of
+    creating datasets does not depend on the size of the image.
+    """
+    import h5py
+    import tables as tb
+
+    class _ScratchFile(tb.File):
+        def close(self):
+            if not self.isopen:
+                return
+            self.flush()
+            image = self.get_file_image()
+            super(_ScratchFile, self).close()
+            with h5py.File(io.BytesIO(image), 'r') as src, \
+                    h5py.File(buf, 'a') as dst:
+                _copy_new_nodes(src, dst)
+
+    return _ScratchFile('<in-memory scratch {}>'.format(id(buf)), 'w',
+                        filters=filters, driver='H5FD_CORE',
+                        driver_core_backing_store=0)
+
+
+@contextlib.contextmanager
+def _ignore_unsupported_attrs():
+    """Ignore the warnings of PyTables about attributes it cannot read
+    (e.g. booleans written by h5py, see :func:`_h5py_booleans`)"""
+    import tables as tb
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', tb.DataTypeWarning)
+        yield
+
+
+def _open_h5py(tb_file):
+    """Open a file opened with PyTables with h5py, read only"""
+    import h5py
+
+    if tb_file.params.get('DRIVER') == 'H5FD_CORE':
+        return h5py.File(io.BytesIO(tb_file.get_file_image()), 'r')
+    return h5py.File(tb_file.filename, 'r')
+
+
+def _h5py_booleans(node, names: List[str]) -> Dict[str, Any]:
+    """Boolean attributes among ``names`` of a PyTables node, read with
+    h5py
+
+    h5py stores booleans as HDF5 enums, which PyTables reads as None.
+    """
+    import numpy as np
+
+    out = {}
+    with _open_h5py(node._v_file) as fh:
+        attrs = fh[node._v_pathname].attrs
+        for name in names:
+            value = attrs[name]
+            if np.asarray(value).dtype == np.bool_:
+                out[name] = value
+    return out
+
+
+class H5pyBackend(Backend):
+    """HDF5 files accessed with h5py
+
+    Compression is not supported when writing, but attributes of any type
+    are.
+    """
+    name = 'h5py'
+    store = 'hdf5'
+
+    def open(self, target, mode: str, filters=None):
+        import h5py
+        return h5py.File(target, mode)
+
+    def create_dataset(self, fh, name: str, data=None,
+                       shape: Optional[Tuple[int, ...]] = None, dtype=None,
+                       fletcher32: bool = True, complib: str = 'blosc:lz4',
+                       complevel: int = 0, chunks=None, **args):
+        if complevel > 0:
+            raise ValueError("The h5py backend doesn't support "
+                             "compression, either set the backend "
+                             "to 'pytables' or 'complevel' to 0.")
+        return fh.create_dataset(name, shape=shape, dtype=dtype, data=data,
+                                 chunks=chunks, fletcher32=fletcher32,
+                                 **args)
+
+
+class PyTablesBackend(Backend):
+    """HDF5 files accessed with PyTables
+
+    Supports all the compression libraries of PyTables (blosc, zlib, ...).
+    """
+    name = 'pytables'
+    store = 'hdf5'
+
+    def open(self, target, mode: str, filters=None):
+        import tables as tb
+        if isinstance(target, io.BytesIO):
+            return _open_image(target, mode, filters=filters)
+        return tb.open_file(target, mode=mode, filters=filters)
+
+    def open_for_create(self, target, filters=None):
+        if isinstance(target, io.BytesIO):
+            return _open_scratch_image(target, filters=filters)
+        return self.open(target, 'a', filters=filters)
+
+    def create_dataset(self, fh, name: str, data=None,
+                       shape: Optional[Tuple[int, ...]] = None, dtype=None,
+                       fletcher32: bool = True, complib: str = 'blosc:lz4',
+                       complevel: int = 0, chunks=None, **args):
+        import numpy as np
+        import tables as tb
+
+        filters = tb.Filters(fletcher32=fletcher32, complib=complib,
+                             complevel=complevel)
+        atom = None if dtype is None else tb.Atom.from_dtype(np.dtype(dtype))
+        base_location, array_name = os.path.split(name)
+        return fh.create_carray(base_location, array_name, atom=atom,
+                                shape=shape, obj=data, chunkshape=chunks,
+                                filters=filters, createparents=True)
+
+    def get_node(self, fh, path: str):
+        with _ignore_unsupported_attrs():
+            return fh.get_node(path)
+
+    def remove(self, fh, path: str) -> None:
+        fh.remove_node(path, recursive=True)
+
+    def list_nodes(self, fh, path: str) -> List[str]:
+        with _ignore_unsupported_attrs():
+            return sorted(node._v_name for node in fh.list_nodes(path))
+
+    def attrs(self, node) -> Dict[str, Any]:
+        # includes the system attributes of PyTables (CLASS, TITLE, ...)
+        attrs = node._v_attrs
+        with _ignore_unsupported_attrs():
+            out = {key: attrs[key] for key in attrs._v_attrnames}
+        unsupported = [key for key, val in out.items() if val is None]
+        if unsupported:
+            out.update(_h5py_booleans(node, unsupported))
+        return out
+
+    def missing_sources(self, node, fullpath: str,
+                        index: Tuple[Any, ...] = ()) -> List[str]:
+        import tables as tb
+        from ..io import _missing_sources
+
+        # PyTables does not expose the layout of datasets, but virtual
+        # ones are not chunked, unlike all the arrays phicore writes
+        if not isinstance(node, tb.Leaf) or node.chunkshape is not None:
+            return []
+        with _open_h5py(node._v_file) as fh:
+            return _missing_sources(fh[node._v_pathname], fullpath, index)
+
+    def read(self, node, index: Tuple[Any, ...] = ()):
+        if not index:
+            return node.read()
+        return node[index]
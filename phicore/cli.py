@@ -0,0 +1,163 @@
+# CeCILL-B license LIDYL, CEA
+
+"""Command line interface, available as the ``phicore`` command"""
+
+import sys
+import json
+import argparse
+
+from typing import Optional, List
+
+
+def _format_size(n_bytes: float) -> str:
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(n_bytes) < 1024:
+            return '{:.1f} {}'.format(n_bytes, unit)
+        n_bytes /= 1024
+    return '{:.1f} TiB'.format(n_bytes)
+
+
+def _parse_chunks(value: str):
+    if value in ('auto', 'keep'):
+        return value
+    try:
+        return tuple(int(el) for el in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "chunks must be 'auto', 'keep' or a comma separated list of "
+            "integers, got {!r}".format(value))
+
+
+def _repack(args) -> int:
+    from .archive import repack
+
+    report = repack(args.paths, complib=args.complib,
+                    complevel=args.complevel,
+                    fletcher32=not args.no_fletcher32,
+                    shuffle=not args.no_shuffle, chunks=args.chunks,
+                    n_jobs=args.n_jobs,
+                    working_memory=args.working_memory)
+    n_errors = 0
+    total_saved = 0
+    for item in report:
+        if 'error' in item:
+            n_errors += 1
+            print('{}: FAILED {}'.format(item['path'], item['error']))
+        else:
+            total_saved += item['saved']
+            print('{}: {} -> {} (saved {})'.format(
+                item['path'], _format_size(item['size_before']),
+                _format_size(item['size_after']),
+                _format_size(item['saved'])))
+    print('Total space saved: {}'.format(_format_size(total_saved)))
+    return int(n_errors > 0)
+
+
+def _verify(args) -> int:
+    from .archive import verify
+
+    report = verify(args.paths, n_jobs=args.n_jobs,
+                    working_memory=args.working_memory)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+    return int(not all(item['ok'] for item in report))
+
+
+def _convert(args) -> int:
+    from .archive import convert
+
+    fh = convert(args.src, args.dst, store=args.store, force=args.force,
+                 complib=args.complib, complevel=args.complevel,
+                 working_memory=args.working_memory)
+    print('{} -> {} ({})'.format(args.src, fh.fullpath, fh.store))
+    return 0
+
+
+def _get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='phicore', description='Tools for phicore data files')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    repack_parser = subparsers.add_parser(
+        'repack', help='rewrite files with new compression settings',
+        description='Rewrite phicore files with new compression and '
+                    'chunking settings, reclaiming unused space.')
+    repack_parser.add_argument('paths', nargs='+', help='files to repack')
+    repack_parser.add_argument('--complib', default='zlib',
+                               help='compression library (default: '
+                                    '%(default)s)')
+    repack_parser.add_argument('--complevel', type=int, default=5,
+                               help='compression level (default: '
+                                    '%(default)s)')
+    repack_parser.add_argument('--chunks', type=_parse_chunks,
+                               default='auto',
+                               help="chunking policy: 'auto', 'keep' or a "
+                                    "chunk shape such as 64,64,16 "
+                                    "(default: %(default)s)")
+    repack_parser.add_argument('--no-fletcher32', action='store_true',
+                               help='disable fletcher32 checksums')
+    repack_parser.add_argument('--no-shuffle', action='store_true',
+                               help='disable the shuffle filter')
+    repack_parser.add_argument('-j', '--n-jobs', type=int, default=1,
+                               help='number of files processed in parallel '
+                                    '(default: %(default)s)')
+    repack_parser.add_argument('--working-memory', type=float, default=64,
+                               help='memory budget in MiB per dataset copy '
+                                    '(default: %(default)s)')
+    repack_parser.set_defaults(func=_repack)
+
+    verify_parser = subparsers.add_parser(
+        'verify', help='check the integrity of files',
+        description='Check checksums and the file format structure of '
+                    'phicore files, and print a JSON report. The exit '
+                    'code is 1 if any file has errors.')
+    verify_parser.add_argument('paths', nargs='+', help='files to verify')
+    verify_parser.add_argument('-j', '--n-jobs', type=int, default=1,
+                               help='number of files processed in parallel '
+                                    '(default: %(default)s)')
+    verify_parser.add_argument('--working-memory', type=float, default=64,
+                               help='memory budget in MiB per read block '
+                                    '(default: %(default)s)')
+    verify_parser.add_argument('-o', '--output',
+                               help='write the JSON report to this file '
+                                    'instead of the standard output')
+    verify_parser.set_defaults(func=_verify)
+
+    convert_parser = subparsers.add_parser(
+        'convert', help='convert files between HDF5 and directory stores',
+        description='Copy a phicore HDF5 file to a chunked directory '
+                    'store, or a directory store to an HDF5 file.')
+    convert_parser.add_argument('src', help='file or store to convert')
+    convert_parser.add_argument('dst', help='path of the converted file')
+    convert_parser.add_argument('--store', choices=['hdf5', 'directory'],
+                                help='kind of the converted file (default: '
+                                     'the other kind)')
+    convert_parser.add_argument('-f', '--force', action='store_true',
+                                help='overwrite dst if it exists')
+    convert_parser.add_argument('--complib', default='zlib',
+                                help='compression library (default: '
+                                     '%(default)s)')
+    convert_parser.add_argument('--complevel', type=int, default=0,
+                                help='compression level (default: '
+                                     '%(default)s)')
+    convert_parser.add_argument('--working-memory', type=float, default=64,
+                                help='memory budget in MiB per dataset copy '
+                                     '(default: %(default)s)')
+    convert_parser.set_defaults(func=_convert)
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Entry point of the ``phicore`` command"""
+    args = _get_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
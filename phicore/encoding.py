@@ -0,0 +1,650 @@
+# CeCILL-B license LIDYL, CEA
+
+"""Storage encodings of data variables
+
+An encoded variable stores an ``encoding`` attribute naming the encoding,
+and its parameters in attributes prefixed with ``encoding_``. These are
+not returned as user attributes by
+:meth:`PhiDataFile.read_xarray <phicore.io.PhiDataFile.read_xarray>`,
+which decodes the data transparently.
+"""
+
+import math
+
+from typing import Tuple, Dict, Any
+
+
+def is_encoding_attr(key: str) -> bool:
+    """Whether an attribute describes the encoding of a variable"""
+    return key == 'encoding' or key.startswith('encoding_')
+
+
+def node_attrs(node):
+    """Attributes of an h5py or PyTables node (including groups)"""
+    if hasattr(node, '_v_attrs'):
+        return node._v_attrs
+    return node.attrs
+
+
+def _child(node, name: str):
+    """Child of an h5py or PyTables group"""
+    if hasattr(node, '_f_get_child'):
+        return node._f_get_child(name)
+    return node[name]
+
+
+def _str_attr(node, key: str) -> str:
+    value = node_attrs(node)[key]
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return str(value)
+
+
+def variable_shape(node) -> Tuple[int, ...]:
+    """Shape of the (decoded) data of a variable"""
+    attrs = node_attrs(node)
+    if 'encoding_shape' in attrs:
+        return tuple(int(el) for el in attrs['encoding_shape'])
+    return tuple(node.shape)
+
+
+def _bitround(values, keepbits: int):
+    """Round the mantissa of finite floats to ``keepbits`` bits
+
+    Rounding is to the nearest, ties to even, so that the relative error
+    is at most ``2**-(keepbits + 1)``.
+    """
+    import numpy as np
+
+    values = np.array(values)  # copy
+    n_mantissa = np.finfo(values.dtype).nmant
+    if keepbits >= n_mantissa:
+        return values
+    finite = np.isfinite(values)
+    bits = values.view('u{}'.format(values.dtype.itemsize))
+    uint = bits.dtype.type
+    drop = n_mantissa - keepbits
+    half = uint((1 << (drop - 1)) - 1)
+    mask = ~uint((1 << drop) - 1)
+    rounded = (bits + ((bits >> uint(drop)) & uint(1)) + half) & mask
+    bits[finite] = rounded[finite]
+    return values
+
+
+def quantize(values,
+             mode: str,
+             precision: float) -> Tuple[Any, Dict[str, Any]]:
+    """Lossy quantization of floating point data with an error bound
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+      the floating point data
+    mode : {'absolute', 'relative'}
+      'absolute' stores ``round((values - offset) / scale)`` as the
+      smallest unsigned integer type that fits (scale-offset encoding),
+      so that the absolute error is at most ``precision``. 'relative'
+      rounds the mantissa of values to the number of bits needed for a
+      relative error of at most ``precision`` (bit rounding), which keeps
+      the dtype but greatly improves compression with the shuffle filter.
+      NaN and infinite values are preserved by both modes.
+    precision : float
+      the maximum absolute or relative error
+
+    Returns
+    -------
+    stored : numpy.ndarray
+      the data to store
+    attrs : dict
+      the encoding attributes to store along with the data
+    """
+    import numpy as np
+
+    values = np.asarray(values)
+    if values.dtype.kind != 'f':
+        raise ValueError('quantization requires floating point data, got '
+                         'dtype {}'.format(values.dtype))
+    if not precision > 0:
+        raise ValueError('precision must be positive, got {}'
+                         .format(precision))
+
+    if mode == 'relative':
+        keepbits = max(0, int(math.ceil(-math.log2(precision) - 1)))
+        attrs = {'encoding': 'bit-round', 'encoding_keepbits': keepbits,
+                 'encoding_precision': precision}
+        return _bitround(values, keepbits), attrs
+    elif mode != 'absolute':
+        raise ValueError("quantize must be one of {{'absolute', "
+                         "'relative'}}, got {!r}".format(mode))
+
+    finite = np.isfinite(values)
+    if finite.any():
+        offset = float(values[finite].min())
+        span = float(values[finite].max()) - offset
+    else:
+        offset, span = 0., 0.
+    # leave room for the rounding error of the cast back to the dtype
+    margin = np.finfo(values.dtype).eps * max(abs(offset),
+                                              abs(offset + span))
+    scale = 2 * (precision - margin)
+    if scale <= 0:
+        raise ValueError('precision {} cannot be guaranteed with dtype {}'
+                         .format(precision, values.dtype))
+    # the last 3 integer values are reserved for NaN, +inf and -inf
+    n_levels = int(math.floor(span / scale + 0.5)) + 1
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if n_levels + 3 <= np.iinfo(dtype).max + 1:
+            break
+    else:
+        raise ValueError('precision {} is too small for the range of the '
+                         'data'.format(precision))
+    fill = int(np.iinfo(dtype).max)
+
+    stored = np.full(values.shape, fill, dtype=dtype)
+    stored[finite] = np.round((values[finite].astype(np.float64) - offset)
+                              / scale)
+    stored[np.isposinf(values)] = fill - 1
+    stored[np.isneginf(values)] = fill - 2
+
+    attrs = {'encoding': 'scale-offset', 'encoding_scale': scale,
+             'encoding_offset': offset, 'encoding_fill': fill,
+             'encoding_dtype': values.dtype.str,
+             'encoding_precision': precision}
+
+    decoded = dequantize(stored, attrs)
+    if np.any(np.abs(decoded[finite] - values[finite]) > precision):
+        raise ValueError('precision {} cannot be guaranteed with dtype {}'
+                         .format(precision, values.dtype))
+    return stored, attrs
+
+
+def dequantize(stored, attrs: Dict[str, Any]):
+    """Decode data stored with the 'scale-offset' encoding"""
+    import numpy as np
+
+    stored = np.asarray(stored)
+    fill = attrs['encoding_fill']
+    dtype = attrs['encoding_dtype']
+    if isinstance(dtype, bytes):
+        dtype = dtype.decode('utf-8')
+    values = np.asarray(stored * attrs['encoding_scale']
+                        + attrs['encoding_offset']).astype(dtype)
+    values[stored == fill] = np.nan
+    values[stored == fill - 1] = np.inf
+    values[stored == fill - 2] = -np.inf
+    return values
+
+
+def _zigzag(residuals):
+    """Map unsigned residuals so that small negative ones stay small"""
+
+    signed = residuals.view('i{}'.format(residuals.dtype.itemsize))
+    shift = 8 * residuals.dtype.itemsize - 1
+    return ((signed << 1) ^ (signed >> shift)).view(residuals.dtype)
+
+
+def _unzigzag(stored):
+    """Inverse of _zigzag"""
+    uint = stored.dtype.type
+    return (stored >> uint(1)) ^ (uint(0) - (stored & uint(1)))
+
+
+def delta_encode(values,
+                 axis: int,
+                 keyframe_interval: int) -> Tuple[Any, Dict[str, Any]]:
+    """Lossless temporal delta encoding along an axis
+
+    Every ``keyframe_interval``-th frame along ``axis`` (starting with the
+    first one) is stored as is, and other frames as the difference with
+    the previous frame. Differences are computed on the bit patterns of
+    the values viewed as unsigned integers, with wraparound, so that the
+    encoding is exact for both integer and floating point data, and are
+    zigzag encoded (0, -1, 1, -2, ... are stored as 0, 1, 2, 3, ...). Small
+    differences between correlated frames compress much better than the
+    frames themselves.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+      the integer or floating point data
+    axis : int
+      the axis along which consecutive frames are correlated
+    keyframe_interval : int
+      the distance between keyframes. Decoding a frame requires reading
+      at most ``keyframe_interval`` frames.
+
+    Returns
+    -------
+    stored : numpy.ndarray
+      the unsigned integer data to store
+    attrs : dict
+      the encoding attributes to store along with the data
+    """
+    import numpy as np
+
+    values = np.asarray(values)
+    if values.dtype.kind not in 'iuf':
+        raise ValueError('delta encoding requires integer or floating point '
+                         'data, got dtype {}'.format(values.dtype))
+    if not 0 <= axis < values.ndim:
+        raise ValueError('axis {} is out of bounds for {}D data'
+                         .format(axis, values.ndim))
+    keyframe_interval = int(keyframe_interval)
+    if keyframe_interval < 1:
+        raise ValueError('keyframe_interval must be at least 1, got {}'
+                         .format(keyframe_interval))
+
+    bits = np.ascontiguousarray(values).view(
+        'u{}'.format(values.dtype.itemsize))
+    stored = np.array(bits)
+    current = [slice(None)] * values.ndim
+    previous = [slice(None)] * values.ndim
+    current[axis] = slice(1, None)
+    previous[axis] = slice(None, -1)
+    stored[tuple(current)] = _zigzag(stored[tuple(current)]
+                                     - bits[tuple(previous)])
+    keyframes = [slice(None)] * values.ndim
+    keyframes[axis] = slice(None, None, keyframe_interval)
+    stored[tuple(keyframes)] = bits[tuple(keyframes)]
+
+    attrs = {'encoding': 'delta', 'encoding_axis': axis,
+             'encoding_keyframe_interval': keyframe_interval,
+             'encoding_dtype': values.dtype.str}
+    return stored, attrs
+
+
+def _read_delta(node, index: Tuple[Any, ...]):
+    """Decode a subset of a variable stored with delta_encode"""
+    import numpy as np
+
+    attrs = node_attrs(node)
+    axis = int(attrs['encoding_axis'])
+    interval = int(attrs['encoding_keyframe_interval'])
+    dtype = _str_attr(node, 'encoding_dtype')
+    if not index:
+        index = tuple(slice(0, size, 1) for size in node.shape)
+
+    selection = index[axis]
+    if isinstance(selection, slice):
+        positions = np.arange(node.shape[axis])[selection]
+    else:
+        positions = np.asarray([selection])
+    if len(positions):
+        # start from the keyframe preceding the first selected frame
+        start = positions[0] // interval * interval
+        stop = positions[-1] + 1
+    else:
+        start = stop = 0
+    read_index = list(index)
+    read_index[axis] = slice(int(start), int(stop))
+    stored = node[tuple(read_index)]
+
+    # integer indices before axis have dropped dimensions
+    out_axis = axis - sum(not isinstance(idx, slice) for idx in index[:axis])
+    # frames are accumulated from each keyframe (with wraparound)
+    decoded = np.empty_like(stored)
+    for seg_start in range(start, stop, interval):
+        seg = [slice(None)] * stored.ndim
+        seg[out_axis] = slice(seg_start - start,
+                              min(seg_start + interval, stop) - start)
+        # the first frame of each segment is a keyframe
+        residuals = np.array(stored[tuple(seg)])
+        rest = [slice(None)] * stored.ndim
+        rest[out_axis] = slice(1, None)
+        residuals[tuple(rest)] = _unzigzag(residuals[tuple(rest)])
+        np.cumsum(residuals, axis=out_axis, dtype=stored.dtype,
+                  out=decoded[tuple(seg)])
+    decoded = decoded.view(dtype)
+
+    take = [slice(None)] * decoded.ndim
+    if isinstance(selection, slice):
+        take[out_axis] = positions - start
+    else:
+        take[out_axis] = int(selection - start)
+    return decoded[tuple(take)]
+
+
+COMPLEX_PLANES = {'real-imag': ('real', 'imag'),
+                  'amp-phase': ('amplitude', 'phase')}
+
+
+def split_complex(values,
+                  mode: str,
+                  dtype=None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Split complex data into two real planes
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+      the complex data
+    mode : {'real-imag', 'amp-phase'}
+      store the real and imaginary parts, or the amplitude and the phase
+      (in radians, in [-pi, pi])
+    dtype : str or numpy.dtype, optional
+      complex dtype of the decoded data, e.g. 'complex64' to halve the
+      storage of complex128 data. By default the dtype of ``values``.
+
+    Returns
+    -------
+    planes : dict
+      mapping of plane names to real arrays
+    attrs : dict
+      the encoding attributes of the variable
+    """
+    import numpy as np
+
+    values = np.asarray(values)
+    if values.dtype.kind != 'c':
+        raise ValueError('complex storage requires complex data, got '
+                         'dtype {}'.format(values.dtype))
+    if mode not in COMPLEX_PLANES:
+        raise ValueError('complex storage must be one of {}, got {!r}'
+                         .format(sorted(COMPLEX_PLANES), mode))
+    dtype = np.dtype(values.dtype if dtype is None else dtype)
+    if dtype.kind != 'c':
+        raise ValueError('complex_dtype must be a complex dtype, got {}'
+                         .format(dtype))
+    values = values.astype(dtype, copy=False)
+
+    if mode == 'real-imag':
+        planes = (values.real, values.imag)
+    else:
+        planes = (np.abs(values), np.angle(values))
+    planes = {name: np.ascontiguousarray(plane)
+              for name, plane in zip(COMPLEX_PLANES[mode], planes)}
+    attrs = {'encoding': 'complex', 'encoding_planes': mode,
+             'encoding_dtype': dtype.str,
+             'encoding_shape': np.asarray(values.shape, dtype=np.int64)}
+    return planes, attrs
+
+
+def merge_complex(planes: Dict[str, Any], mode: str, dtype):
+    """Reassemble complex data from planes created by split_complex"""
+    import numpy as np
+
+    if mode == 'real-imag':
+        values = np.asarray(planes['real'] + 1j * planes['imag'])
+    else:
+        values = np.asarray(planes['amplitude']
+                            * np.exp(1j * planes['phase']))
+    return values.astype(dtype)
+
+
+ROI_MODES = ('variable', 'frame')
+
+
+def _to_frames(values, axes):
+    """Reshape to ``(n_frames,) + spatial shape``, with frames in C order"""
+    import numpy as np
+
+    ndim = np.ndim(values)
+    values = np.moveaxis(values, list(axes),
+                         list(range(ndim - len(axes), ndim)))
+    frame_shape = values.shape[:ndim - len(axes)]
+    return values.reshape((-1,) + values.shape[ndim - len(axes):]), \
+        frame_shape
+
+
+def _from_frames(frames, frame_shape, axes):
+    """Inverse of _to_frames"""
+    import numpy as np
+
+    values = frames.reshape(tuple(frame_shape) + frames.shape[1:])
+    ndim = values.ndim
+    return np.moveaxis(values, list(range(ndim - len(axes), ndim)),
+                       list(axes))
+
+
+def _detect_bounds(frames, mode: str, threshold: float):
+    """Bounding boxes of the pixels deviating from the background
+
+    Returns the ``(starts, stops)`` integer arrays of shape
+    ``(n_frames, n_axes)``, with ``starts == stops`` for empty frames.
+    """
+    import numpy as np
+
+    spatial = tuple(range(1, frames.ndim))
+    background = np.nanmedian(frames, axis=spatial, keepdims=True)
+    deviation = np.abs(frames - background)
+    noise = 1.4826 * np.nanmedian(deviation, axis=spatial, keepdims=True)
+    mask = deviation > threshold * noise
+    if mode == 'variable':
+        mask = mask.any(axis=0, keepdims=True)
+
+    starts = np.zeros((len(mask), frames.ndim - 1), dtype=np.int64)
+    stops = np.zeros_like(starts)
+    for axis in range(frames.ndim - 1):
+        other = tuple(el for el in spatial if el != axis + 1)
+        profile = mask.any(axis=other) if other else mask
+        for idx, row in enumerate(profile):
+            nonzero = np.flatnonzero(row)
+            if len(nonzero):
+                starts[idx, axis] = nonzero[0]
+                stops[idx, axis] = nonzero[-1] + 1
+    n_frames = len(frames)
+    return (np.broadcast_to(starts, (n_frames,) + starts.shape[1:]),
+            np.broadcast_to(stops, (n_frames,) + stops.shape[1:]))
+
+
+def split_roi(values,
+              axes,
+              roi='variable',
+              threshold: float = 5.) -> Tuple[Dict[str, Any],
+                                              Dict[str, Any]]:
+    """Keep only a region of interest of images and a background level
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+      the real data
+    axes : list of int
+      the spatial axes of the images, other axes index the frames
+    roi : {'variable', 'frame'} or dict
+      'variable' detects a single bounding box containing the pixels
+      that deviate from the background in any frame, 'frame' detects a
+      bounding box in each frame. Pixels deviate from the background when
+      they differ from the median of the frame by more than ``threshold``
+      times the noise (estimated from the median absolute deviation).
+      A dict maps spatial axes to index slices giving the bounding box
+      explicitly, either a single slice for all frames or a list with one
+      slice per frame (frames in C order). Boxes of all frames are
+      enlarged to a common size, around their center.
+    threshold : float
+      detection threshold in units of the noise
+
+    Returns
+    -------
+    planes : dict
+      the ``block`` array with the box of each frame, the ``offsets`` of
+      the boxes with shape ``(n_frames, len(axes))`` and the
+      ``background`` level of each frame, i.e. the median of the pixels
+      outside of its box
+    attrs : dict
+      the encoding attributes of the variable
+    """
+    import numpy as np
+
+    values = np.asarray(values)
+    if values.dtype.kind not in 'iuf':
+        raise ValueError('ROI storage requires real data, got dtype {}'
+                         .format(values.dtype))
+    axes = [int(el) for el in axes]
+    frames, frame_shape = _to_frames(values, axes)
+    n_frames = len(frames)
+    spatial_shape = np.asarray(frames.shape[1:], dtype=np.int64)
+
+    if isinstance(roi, dict):
+        unknown = set(roi) - set(axes)
+        if unknown:
+            raise ValueError('ROI axes {} are not spatial axes {}'
+                             .format(sorted(unknown), axes))
+        starts = np.zeros((n_frames, len(axes)), dtype=np.int64)
+        stops = np.broadcast_to(spatial_shape, starts.shape).copy()
+        for pos, axis in enumerate(axes):
+            bounds = roi.get(axis, slice(None))
+            if isinstance(bounds, slice):
+                bounds = [bounds] * n_frames
+            if len(bounds) != n_frames:
+                raise ValueError('expected one ROI slice per frame ({}), '
+                                 'got {}'.format(n_frames, len(bounds)))
+            for idx, sl in enumerate(bounds):
+                start, stop, step = sl.indices(int(spatial_shape[pos]))
+                if step != 1 or stop <= start:
+                    raise ValueError('ROI slices must be non empty with a '
+                                     'step of 1, got {}'.format(sl))
+                starts[idx, pos], stops[idx, pos] = start, stop
+    elif roi in ROI_MODES:
+        starts, stops = _detect_bounds(frames, roi, threshold)
+    else:
+        raise ValueError("roi must be one of {} or a dict, got {!r}"
+                         .format(ROI_MODES, roi))
+
+    extents = stops - starts
+    size = np.maximum(extents.max(axis=0), 1)
+    offsets = np.clip(starts - (size - extents) // 2, 0, spatial_shape - size)
+
+    block = np.empty((n_frames,) + tuple(size), dtype=values.dtype)
+    background = np.empty(n_frames, dtype=values.dtype)
+    for idx, frame in enumerate(frames):
+        box = tuple(slice(start, start + length)
+                    for start, length in zip(offsets[idx], size))
+        block[idx] = frame[box]
+        outside = np.ones(frame.shape, dtype=bool)
+        outside[box] = False
+        level = np.nanmedian(frame[outside] if outside.any() else frame)
+        if values.dtype.kind in 'biu':
+            level = np.round(level)
+        background[idx] = level
+
+    planes = {'block': np.ascontiguousarray(_from_frames(block, frame_shape,
+                                                         axes)),
+              'offsets': offsets,
+              'background': background}
+    attrs = {'encoding': 'roi', 'encoding_dtype': values.dtype.str,
+             'encoding_shape': np.asarray(values.shape, dtype=np.int64),
+             'encoding_roi_axes': np.asarray(axes, dtype=np.int64),
+             'encoding_roi_size': size}
+    return planes, attrs
+
+
+def _roi_frames(node, index: Tuple[Any, ...]):
+    """Frames selected by a normalized index, with their ROI offsets"""
+    import numpy as np
+
+    attrs = node_attrs(node)
+    shape = variable_shape(node)
+    axes = [int(el) for el in attrs['encoding_roi_axes']]
+    frame_axes = [axis for axis in range(len(shape)) if axis not in axes]
+    frame_ids = np.arange(int(np.prod([shape[axis] for axis in frame_axes])))
+    frame_ids = frame_ids.reshape([shape[axis] for axis in frame_axes])
+    frame_ids = frame_ids[tuple(index[axis] for axis in frame_axes)]
+    offsets = _child(node, 'offsets')[:][np.ravel(frame_ids)]
+    return frame_ids, offsets
+
+
+def roi_index(node, index: Tuple[Any, ...]) -> Tuple[Any, ...]:
+    """Restrict a normalized index to the region of interest
+
+    The slices along spatial axes are restricted to the union of the
+    bounding boxes of the selected frames.
+    """
+    import numpy as np
+
+    attrs = node_attrs(node)
+    shape = variable_shape(node)
+    if not index:
+        index = tuple(slice(0, size, 1) for size in shape)
+    axes = [int(el) for el in attrs['encoding_roi_axes']]
+    size = attrs['encoding_roi_size']
+    _, offsets = _roi_frames(node, index)
+
+    index = list(index)
+    for pos, axis in enumerate(axes):
+        if not isinstance(index[axis], slice):
+            continue
+        lower = offsets[:, pos].min()
+        upper = offsets[:, pos].max() + size[pos]
+        positions = np.arange(shape[axis])[index[axis]]
+        positions = positions[(positions >= lower) & (positions < upper)]
+        if len(positions):
+            index[axis] = slice(int(positions[0]), int(positions[-1]) + 1,
+                                index[axis].step)
+        else:
+            index[axis] = slice(int(lower), int(lower), 1)
+    return tuple(index)
+
+
+def _read_roi(node, index: Tuple[Any, ...]):
+    """Reconstruct a subset of a variable stored with split_roi"""
+    import numpy as np
+
+    attrs = node_attrs(node)
+    shape = variable_shape(node)
+    dtype = _str_attr(node, 'encoding_dtype')
+    axes = [int(el) for el in attrs['encoding_roi_axes']]
+    size = attrs['encoding_roi_size']
+    if not index:
+        index = tuple(slice(0, length, 1) for length in shape)
+    # integers are converted to slices of length 1 and dropped at the end
+    full_index = tuple(slice(idx, idx + 1, 1) if not isinstance(idx, slice)
+                       else idx for idx in index)
+
+    frame_ids, offsets = _roi_frames(node, full_index)
+    background = _child(node, 'background')[:][np.ravel(frame_ids)]
+    block_index = tuple(slice(None) if axis in axes else full_index[axis]
+                        for axis in range(len(shape)))
+    block, frame_shape = _to_frames(
+        read_encoded(_child(node, 'block'), block_index), axes)
+
+    positions = [np.arange(shape[axis])[full_index[axis]] for axis in axes]
+    out = np.empty((len(block),) + tuple(len(el) for el in positions),
+                   dtype=dtype)
+    out[...] = background.astype(dtype).reshape((-1,) + (1,) * len(axes))
+    for idx in range(len(block)):
+        local = [el - offset for el, offset in zip(positions, offsets[idx])]
+        inside = [(el >= 0) & (el < length)
+                  for el, length in zip(local, size)]
+        out[idx][np.ix_(*inside)] = block[idx][np.ix_(*[
+            el[mask] for el, mask in zip(local, inside)])]
+
+    out = _from_frames(out, frame_shape, axes)
+    return out[tuple(slice(None) if isinstance(idx, slice) else 0
+                     for idx in index)]
+
+
+def read_encoded(node, index: Tuple[Any, ...] = ()):
+    """Read and decode a subset of an encoded variable
+
+    Parameters
+    ----------
+    node : h5py.Dataset or tables.Leaf
+      the stored variable
+    index : tuple
+      normalized index (see ``phicore.io._normalize_index``), or an
+      empty tuple to read everything
+    """
+    attrs = node_attrs(node)
+    if 'encoding' not in attrs:
+        return node[index] if index else node[:]
+    encoding = _str_attr(node, 'encoding')
+
+    if encoding == 'complex':
+        mode = _str_attr(node, 'encoding_planes')
+        planes = {name: read_encoded(_child(node, name), index)
+                  for name in COMPLEX_PLANES[mode]}
+        return merge_complex(planes, mode, _str_attr(node, 'encoding_dtype'))
+    elif encoding == 'roi':
+        return _read_roi(node, index)
+    elif encoding == 'delta':
+        return _read_delta(node, index)
+
+    raw = node[index] if index else node[:]
+    if encoding == 'bit-round':
+        return raw
+    elif encoding == 'scale-offset':
+        return dequantize(raw, {key: attrs[key]
+                                for key in ('encoding_scale',
+                                            'encoding_offset',
+                                            'encoding_fill',
+                                            'encoding_dtype')})
+    raise ValueError('unknown encoding {!r}'.format(encoding))
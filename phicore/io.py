@@ -1,20 +1,563 @@
 # CeCILL-B license LIDYL, CEA
 
+import io
 import os
+import math
 import time
 import warnings
-import operator
 
-from collections import namedtuple
+from collections import namedtuple, deque
 
 from typing import Optional, Tuple, List, Dict, Any
 
-
-__fileformatversion__ = 2
+from .encoding import (is_encoding_attr, quantize as _quantize,
+                       read_encoded, split_complex, split_roi, roi_index,
+                       delta_encode, node_attrs, variable_shape, _bitround)
+from .backends import get_backend, is_directory_store
+
+
+__fileformatversion__ = 3
+
+
+def _decode(value):
+    """Decode a bytes attribute to str (h5py >= 3 may already return str)"""
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def _scale_path(location: str, dim: str) -> str:
+    """Path of the scale vector for dimension ``dim`` of a variable
+
+    The variables of a shot series (in ``/data/shots/shot_<id>``) have
+    their scales in the same sub-group of ``/scales``, since revision 3 of
+    the file format. Only the name of other variables (or a bare variable
+    name) is used, so that files written before keep their layout.
+    """
+    parent, dataset_name = os.path.split(location)
+    prefix = ''
+    if parent.startswith('/data/shots/'):
+        prefix = parent[len('/data/'):].strip('/') + '/'
+    return '/scales/' + prefix + '_'.join([dataset_name, dim])
+
+
+def _normalize_index(index, shape: Tuple[int, ...]) -> Tuple[Any, ...]:
+    """Expand an ``index`` tuple of ints and slices to the full ``shape``
+
+    Integers are bounds checked and made positive, slices are
+    converted to their explicit ``(start, stop, step)`` form.
+    """
+    import numpy as np
+
+    if not isinstance(index, tuple):
+        index = (index,)
+    if len(index) > len(shape):
+        raise IndexError('too many indices ({}) for a {}D dataset'
+                         .format(len(index), len(shape)))
+    index = index + (slice(None),) * (len(shape) - len(index))
+
+    out = []
+    for idx, size in zip(index, shape):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(size)
+            if step < 1:
+                raise IndexError('only positive slice steps are supported')
+            out.append(slice(start, stop, step))
+        elif isinstance(idx, (int, np.integer)):
+            idx = int(idx)
+            if not -size <= idx < size:
+                raise IndexError('index {} is out of bounds for axis '
+                                 'with size {}'.format(idx, size))
+            out.append(idx % size)
+        else:
+            raise TypeError('index elements must be int or slice, got {}'
+                            .format(type(idx).__name__))
+    return tuple(out)
+
+
+def _overlaps(idx, low: int, high: int) -> bool:
+    """Whether a normalized int or slice index selects any of low..high"""
+    if not isinstance(idx, slice):
+        return low <= idx <= high
+    first = idx.start
+    if first < low:
+        first += -(-(low - first) // idx.step) * idx.step
+    return first < idx.stop and first <= high
+
+
+def _missing_sources(node, fullpath: str, index: Tuple[Any, ...] = (),
+                     open_sources: bool = False) -> List[str]:
+    """Sources of an h5py virtual dataset that cannot be found
+
+    Only the sources mapped to the region selected by the normalized
+    ``index`` are checked. With ``open_sources``, source files are opened
+    to check that they hold the source dataset.
+    """
+    import h5py
+
+    if not isinstance(node, h5py.Dataset) or not node.is_virtual:
+        return []
+    # relative source paths are resolved from the virtual file directory
+    directory = os.path.dirname(os.path.abspath(fullpath or ''))
+    missing = []
+    for vmap in node.virtual_sources():
+        low, high = vmap.vspace.get_select_bounds()
+        if index and not all(_overlaps(idx, lo, hi)
+                             for idx, lo, hi in zip(index, low, high)):
+            continue
+        if vmap.file_name == '.':
+            # mapped from the virtual file itself
+            continue
+        path = os.path.join(directory, vmap.file_name)
+        found = os.path.exists(path)
+        if found and open_sources:
+            try:
+                with h5py.File(path, 'r') as src:
+                    found = vmap.dset_name in src
+            except OSError:
+                found = False
+        if not found:
+            missing.append('{}:{}'.format(vmap.file_name, vmap.dset_name))
+    return missing
+
+
+def _positions_to_index(positions, dim: str):
+    """Convert sorted integer positions to an equivalent slice"""
+    import numpy as np
+
+    if len(positions) == 0:
+        raise KeyError('selection along {} is empty'.format(dim))
+    if len(positions) == 1:
+        return slice(int(positions[0]), int(positions[0]) + 1)
+    steps = np.unique(np.diff(positions))
+    if len(steps) != 1 or steps[0] < 1:
+        raise ValueError(('selection along {} does not correspond to a '
+                          'regular slice of the stored scale').format(dim))
+    return slice(int(positions[0]), int(positions[-1]) + 1, int(steps[0]))
+
+
+def _label_to_index(coord, label, dim: str):
+    """Convert a coordinate label (scalar, slice or array) to an index
+
+    Label slices are inclusive of both bounds, as in ``xarray.sel``.
+    """
+    import numpy as np
+
+    if isinstance(label, slice):
+        if label.step is not None:
+            raise ValueError('label based slices do not support a step')
+        mask = np.ones(coord.shape, dtype=bool)
+        if label.start is not None:
+            mask &= coord >= label.start
+        if label.stop is not None:
+            mask &= coord <= label.stop
+        return _positions_to_index(np.flatnonzero(mask), dim)
+
+    label = np.asarray(label)
+    if label.ndim == 0:
+        positions = np.flatnonzero(coord == label)
+        if len(positions) == 0:
+            raise KeyError('{!r} not found in the {} scale'
+                           .format(label.item(), dim))
+        return int(positions[0])
+
+    positions = []
+    for el in label:
+        match = np.flatnonzero(coord == el)
+        if len(match) == 0:
+            raise KeyError('{!r} not found in the {} scale'
+                           .format(el, dim))
+        positions.append(match[0])
+    return _positions_to_index(np.asarray(positions), dim)
+
+
+def _create_shot_table(fh, description):
+    """Create the shot table, with an index on each column, with PyTables
+
+    ``description`` is a PyTables table description or a structured dtype.
+    """
+    parent, name = os.path.split(_SHOTS_TABLE)
+    table = fh.create_table(parent, name, description,
+                            title='shot series', createparents=True)
+    for column in table.colnames:
+        table.cols._f_col(column).create_index()
+    return table
+
+
+def _remove_nodes(backend, fh, paths) -> None:
+    """Remove the existing nodes among ``paths`` from a file opened with
+    ``backend``"""
+    for path in paths:
+        if backend.contains(fh, path):
+            backend.remove(fh, path)
+
+
+def _write_metadata(fh, location: str, dataset_name: str, dims,
+                    coords: Dict[str, Any], scale_units: Dict[str, str],
+                    attrs: Dict[str, Any], scales=None, **args) -> None:
+    """Write the name, scales and attributes of a variable with h5py
+
+    ``scales`` is an optional dict shared by the variables written in a
+    batch. Scales equal to a scale already written in the batch are stored
+    as hard links to it.
+    """
+    import numpy as np
+
+    fh[location].attrs['name'] = dataset_name
+    fh[location].attrs['scales'] = [el.encode('utf8') for el in dims]
+    for key, val in coords.items():
+        scale_path = _scale_path(location, key)
+        val = np.asarray(val)
+        candidates = [] if scales is None else \
+            scales.setdefault((key, scale_units[key], val.shape), [])
+        for other, other_path in candidates:
+            if other.dtype == val.dtype and np.array_equal(other, val):
+                fh[scale_path] = fh[other_path]
+                break
+        else:
+            fh.create_dataset(scale_path, data=val, **args)
+            fh[scale_path].attrs['unit'] = scale_units[key].encode('utf-8')
+            candidates.append((val, scale_path))
+
+    # save optional attributes
+    for key, value in attrs.items():
+        if key in ['name', 'scale_units']:
+            continue
+
+        if (isinstance(value, (np.ndarray, np.str_))
+                and value.dtype.kind == 'U'
+                and value.ndim == 0):
+            value = str(value)
+
+        fh[location].attrs[key] = value
+
+
+_SPATIAL_DIMS = ('x', 'y')
+
+
+def _pyramid_path(location: str, level: int) -> str:
+    """Path of a downsampled level of a variable"""
+    return '/diag/pyramid/{}_L{}'.format(_diag_name(location), level)
+
+
+def _build_pyramid(values, dims, coords: Dict[str, Any], n_levels: int):
+    """Downsample the spatial dimensions of an array by successive factors 2
+
+    Pixels are averaged over 2x2 blocks, a trailing odd row or column is
+    dropped. Integer data is averaged in floating point and only the
+    returned levels are rounded back to its dtype, so that rounding errors
+    do not accumulate across levels. Coordinates are averaged in the same
+    way.
+
+    Returns
+    -------
+    levels : list of (values, coords) tuples
+      the downsampled data for levels 1 to ``n_levels``, stopping early
+      when a spatial dimension reaches a size of 1
+    """
+    import numpy as np
+
+    axes = [idx for idx, dim in enumerate(dims) if dim in _SPATIAL_DIMS]
+    if not axes:
+        raise ValueError('building a pyramid requires at least one of the '
+                         'spatial dimensions {}, got {}'
+                         .format(_SPATIAL_DIMS, list(dims)))
+    values = np.asarray(values)
+    dtype = values.dtype
+    if dtype.kind in 'biu':
+        values = values.astype(np.float64)
+
+    levels = []
+    for _ in range(n_levels):
+        if any(values.shape[axis] < 2 for axis in axes):
+            break
+        coords = dict(coords)
+        for axis in axes:
+            size = values.shape[axis] // 2
+            values = np.take(values, np.arange(2 * size), axis=axis)
+            shape = values.shape[:axis] + (size, 2) + values.shape[axis + 1:]
+            values = values.reshape(shape).mean(axis=axis + 1)
+            coord = np.asarray(coords[dims[axis]])[:2 * size]
+            coords[dims[axis]] = coord.reshape(size, 2).mean(axis=1)
+        if dtype.kind in 'biu':
+            levels.append((np.round(values).astype(dtype), coords))
+        else:
+            levels.append((values, coords))
+    return levels
+
+
+_SHOTS_TABLE = '/diag/shots'
+
+
+def _shot_path(shot_id: int) -> str:
+    """Path of the group holding the variables of a shot"""
+    return '/data/shots/shot_{}'.format(shot_id)
+
+
+_STATS_PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+_STATS_BINS = 256
+
+
+def _diag_name(location: str) -> str:
+    """Name under which a variable is stored in the ``/diag`` groups
+
+    This is its path relative to ``/data`` (e.g. ``sub/I`` for
+    ``/data/sub/I``), so that variables of different sub-groups do not
+    collide, or its name for variables stored elsewhere.
+    """
+    if location.startswith('/data/'):
+        return location[len('/data/'):].strip('/')
+    return os.path.basename(location)
+
+
+def _stats_path(location: str) -> str:
+    """Path of the group with the precomputed statistics of a variable"""
+    return '/diag/stats/' + _diag_name(location)
+
+
+def _find_stats(fh, location: str) -> Optional[str]:
+    """Path of the statistics of a variable in an h5py file, if any
+
+    Statistics of variables in sub-groups of ``/data`` were keyed by the
+    variable name only in earlier versions, which is used as a fallback.
+    """
+    for path in (_stats_path(location),
+                 '/diag/stats/' + os.path.basename(location)):
+        if path in fh and \
+                _decode(fh[path].attrs.get('variable')) == location:
+            return path
+    return None
+
+
+def _compute_stats(values) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Compute summary statistics of an array
+
+    Statistics are computed on finite values only, and on the modulus of
+    complex data. Per-slice statistics are computed along the last axis.
+
+    Returns
+    -------
+    attrs : dict
+      scalar statistics and percentiles
+    arrays : dict
+      histogram and per-slice statistics
+    """
+    import numpy as np
+
+    values = np.asarray(values)
+    if values.dtype.kind == 'c':
+        values = np.abs(values)
+    values = values.astype(np.float64)  # always a copy
+    values[~np.isfinite(values)] = np.nan
+    finite = values[~np.isnan(values)]
+
+    percentiles = np.asarray(_STATS_PERCENTILES, dtype=np.float64)
+    if finite.size:
+        attrs = {'min': finite.min(), 'max': finite.max(),
+                 'mean': finite.mean(), 'std': finite.std(),
+                 'percentile_values': np.percentile(finite, percentiles)}
+        hist, bin_edges = np.histogram(finite, bins=_STATS_BINS)
+    else:
+        attrs = {'min': np.nan, 'max': np.nan, 'mean': np.nan, 'std': np.nan,
+                 'percentile_values': np.full(len(percentiles), np.nan)}
+        hist = np.zeros(_STATS_BINS, dtype=np.int64)
+        bin_edges = np.linspace(0, 1, _STATS_BINS + 1)
+    attrs['count'] = finite.size
+    attrs['percentiles'] = percentiles
+
+    arrays = {'histogram': hist, 'bin_edges': bin_edges}
+    axis = tuple(range(values.ndim - 1))
+    with warnings.catch_warnings():
+        # slices with no finite values give NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        arrays['slice_min'] = np.nanmin(values, axis=axis)
+        arrays['slice_max'] = np.nanmax(values, axis=axis)
+        arrays['slice_mean'] = np.nanmean(values, axis=axis)
+        arrays['slice_std'] = np.nanstd(values, axis=axis)
+    return attrs, arrays
+
+
+def _write_stats(fh, location: str, dims, values) -> None:
+    """Compute and store the statistics of a variable with h5py"""
+    attrs, arrays = _compute_stats(values)
+    stats_path = _stats_path(location)
+    if stats_path in fh:
+        del fh[stats_path]
+    group = fh.create_group(stats_path)
+    for key, val in arrays.items():
+        group.create_dataset(key, data=val)
+    for key, val in attrs.items():
+        group.attrs[key] = val
+    group.attrs['variable'] = location
+    group.attrs['slice_dim'] = dims[-1]
+    group.attrs['stale'] = False
+
+
+_REDUCE_OPS = ('sum', 'mean', 'std', 'min', 'max')
+
+
+def _reduction_blocks(shape: Tuple[int, ...], itemsize: int, chunks,
+                      working_memory: float, split_axes: Tuple[int, ...]):
+    """Split an array in blocks of at most ``working_memory`` MiB
+
+    Only the ``split_axes`` are divided: blocks are slices along one of
+    them such that the rest of the block fits in memory, taken one index
+    at a time along the split axes before it, and covering the other axes
+    fully. Slices are aligned with ``chunks`` when the array is chunked.
+    Blocks are yielded in storage (C) order as full index tuples.
+    """
+    import itertools
+    import numpy as np
+    from .utils import gen_batches, get_chunk_n_rows
+
+    split_axes = sorted(split_axes)
+    if not split_axes:
+        yield (slice(None),) * len(shape)
+        return
+
+    def _row_bytes(pos):
+        return itemsize * int(np.prod([size for axis, size in enumerate(shape)
+                                       if axis not in split_axes[:pos + 1]]))
+
+    pos = 0
+    while (pos < len(split_axes) - 1
+           and _row_bytes(pos) > working_memory * 2 ** 20):
+        pos += 1
+    axis = split_axes[pos]
+    batch_size = get_chunk_n_rows(max(1, _row_bytes(pos)), working_memory)
+    if chunks:
+        batch_size = max(chunks[axis],
+                         batch_size // chunks[axis] * chunks[axis])
+    lead_axes = split_axes[:pos]
+    for lead in itertools.product(*[range(shape[el]) for el in lead_axes]):
+        index = [slice(None)] * len(shape)
+        for lead_axis, idx in zip(lead_axes, lead):
+            index[lead_axis] = slice(idx, idx + 1)
+        for sl in gen_batches(shape[axis], batch_size):
+            index[axis] = sl
+            yield tuple(index)
+
+
+def _reduce_block(values, op, axes: Tuple[int, ...]):
+    """Partial reduction of a block, keeping the reduced dimensions"""
+    import numpy as np
+
+    if op in ('mean', 'std'):
+        count = int(np.prod([values.shape[axis] for axis in axes]))
+        mean = values.mean(axis=axes, keepdims=True,
+                           dtype=np.result_type(values.dtype, np.float64))
+        m2 = None
+        if op == 'std':
+            m2 = (np.abs(values - mean) ** 2).sum(axis=axes, keepdims=True)
+        return count, mean, m2
+    elif op == 'sum':
+        return values.sum(axis=axes, keepdims=True)
+    elif op == 'min':
+        return values.min(axis=axes, keepdims=True)
+    elif op == 'max':
+        return values.max(axis=axes, keepdims=True)
+    return op(values, axis=axes, keepdims=True)
+
+
+def _merge_partials(left, right, op, axes: Tuple[int, ...]):
+    """Combine the partial reductions of two blocks"""
+    import numpy as np
+
+    if op in ('mean', 'std'):
+        # pairwise update of Chan et al., numerically stable
+        count_l, mean_l, m2_l = left
+        count_r, mean_r, m2_r = right
+        count = count_l + count_r
+        delta = mean_r - mean_l
+        mean = mean_l + delta * (count_r / count)
+        m2 = None
+        if op == 'std':
+            m2 = m2_l + m2_r + np.abs(delta) ** 2 * (count_l * count_r
+                                                     / count)
+        return count, mean, m2
+    elif op == 'sum':
+        return left + right
+    elif op == 'min':
+        return np.minimum(left, right)
+    elif op == 'max':
+        return np.maximum(left, right)
+    raise ValueError('partial results of {!r} cannot be merged'.format(op))
+
+
+def _finalize_partial(partial, op):
+    import numpy as np
+
+    if op == 'mean':
+        return partial[1]
+    elif op == 'std':
+        return np.sqrt(partial[2] / partial[0])
+    return partial
+
+
+# conjugate dimensions of the Fourier transform, with the units of the
+# file format specification and the factor between each coordinate and
+# the corresponding frequency in cycles (2 pi for angular frequencies)
+_FFT_PAIRS = {'t': ('w', 'f'), 'tau': ('w', 'f'), 'x': ('kx',),
+              'y': ('ky',), 'w': ('t', 'tau'), 'f': ('t', 'tau'),
+              'kx': ('x',), 'ky': ('y',)}
+_FFT_RECIPROCAL = ('w', 'f', 'kx', 'ky')
+_FFT_FACTORS = {'w': 2 * math.pi, 'kx': 2 * math.pi, 'ky': 2 * math.pi}
+_FFT_UNITS = {'t': 'fs', 'tau': 'fs', 'x': 'mm', 'y': 'mm',
+              'w': 'PHz.rad', 'f': 'PHz', 'kx': '1/mm', 'ky': '1/mm'}
+
+
+def _fft_coords(coord, dim: str, to: str, origin: Optional[float] = None):
+    """Coordinates of the transformed dimension
+
+    Returns the source sampling step and origin, and the target
+    coordinates, all in cycles units (i.e. divided by the 2 pi factor of
+    angular quantities).
+    """
+    import numpy as np
+
+    coord = np.asarray(coord, dtype=np.float64) / _FFT_FACTORS.get(dim, 1.)
+    n = len(coord)
+    if n < 2:
+        raise ValueError('the Fourier transform along {} requires at least '
+                         '2 points'.format(dim))
+    step = (coord[-1] - coord[0]) / (n - 1)
+    if step <= 0 or not np.allclose(np.diff(coord), step, rtol=1e-6,
+                                    atol=0):
+        raise ValueError('the Fourier transform along {} requires an '
+                         'increasing, uniformly sampled scale'.format(dim))
+    target_step = 1. / (n * step)
+    if origin is None:
+        target_origin = -(n // 2) * target_step
+    else:
+        target_origin = origin / _FFT_FACTORS.get(to, 1.)
+    return step, coord[0], target_origin + target_step * np.arange(n)
+
+
+def _fft_tile(values, axis: int, step: float, origin: float, target,
+              inverse: bool):
+    """Continuous Fourier transform of a tile along ``axis``
+
+    Computes ``step * sum_n values_n exp(-+2i pi target_k u_n)`` with
+    ``u_n = origin + n * step`` using a single FFT, for arbitrary grid
+    origins.
+    """
+    import numpy as np
+
+    n = values.shape[axis]
+    sign = 1 if inverse else -1
+    shape = [1] * values.ndim
+    shape[axis] = n
+    pre = np.exp(sign * 2j * np.pi * target[0] * step
+                 * np.arange(n)).reshape(shape)
+    post = (step * np.exp(sign * 2j * np.pi * target * origin)).reshape(shape)
+    if inverse:
+        return post * np.fft.ifft(values * pre, axis=axis) * n
+    return post * np.fft.fft(values * pre, axis=axis)
 
 
 class PhiDataFile(object):
-    def __init__(self, fullpath: str, mode: str = "r", force: bool = False):
+    def __init__(self, fullpath: str, mode: str = "r", force: bool = False,
+                 in_memory: bool = False, store: str = 'hdf5'):
         """Defines the structure of some archived data and methods
         associated to Input and Output.
 
@@ -27,6 +570,21 @@ class PhiDataFile(object):
           the mode in which to open the file see documentation of `open`
         force : bool
           overwrite a file even if it exists
+        in_memory : bool
+          keep the whole file in memory: an existing file is read once, all
+          methods operate on the in-memory image, and :meth:`close` writes
+          it back to ``fullpath`` in a single sequential write (unless
+          ``mode='r'``). Changes are lost if :meth:`close` is not called,
+          use the object as a context manager to do it automatically.
+        store : {'hdf5', 'directory'}
+          kind of file created with ``mode='w'``: an HDF5 file, or a
+          chunked directory store (see :mod:`phicore.backends.directory`)
+          with the same layout, in which several processes can write
+          disjoint chunk-aligned regions in parallel (with
+          :meth:`write_region`) or different variables. Existing files
+          are opened according to their kind. The h5py and PyTables
+          backends are replaced by the 'directory' backend for
+          directory stores.
         """
         self.fullpath = fullpath.replace('{date}',
                                          time.strftime('%Y-%m-%d-%H%M%S'))
@@ -35,6 +593,15 @@ class PhiDataFile(object):
             raise ValueError('Access type {} unkown. See `open` documentation.'
                              .format(mode))
         self.mode = mode
+        self.in_memory = in_memory
+        self._buffer = None
+        if mode not in ('w', 'w+') and is_directory_store(self.fullpath):
+            store = 'directory'
+        # validate the store
+        get_backend('h5py', store)
+        if in_memory and store != 'hdf5':
+            raise ValueError('in_memory is only supported for HDF5 files')
+        self.store = store
 
         if not os.path.exists(self.fullpath) and\
                 mode in ('r', 'r+', 'a', 'a+'):
@@ -53,6 +620,66 @@ class PhiDataFile(object):
         # Create file if necessary
         if self.mode in ("w", "w+"):
             self._create_file()
+        elif in_memory:
+            with open(self.fullpath, 'rb') as fd:
+                self._buffer = io.BytesIO(fd.read())
+
+    @classmethod
+    def from_bytes(cls, buf, mode: str = 'r',
+                   fullpath: Optional[str] = None) -> 'PhiDataFile':
+        """Open a file from its content, without touching the disk
+
+        Parameters
+        ----------
+        buf : bytes-like
+          the content of a phicore file, e.g. as returned by
+          :meth:`to_bytes` or received over a socket
+        mode : str
+          'r' to read only or 'a' to also modify the in-memory image
+        fullpath : str, optional
+          path where :meth:`close` writes the modified file. By default
+          it is only kept in memory.
+
+        Returns
+        -------
+        fh : PhiDataFile
+          an in-memory file
+        """
+        if mode not in ('r', 'a'):
+            raise ValueError("mode must be 'r' or 'a', got {}".format(mode))
+        out = cls.__new__(cls)
+        out.fullpath = fullpath
+        out.mode = mode
+        out.in_memory = True
+        out.store = 'hdf5'
+        out._buffer = io.BytesIO(bytes(buf))
+        return out
+
+    def to_bytes(self) -> bytes:
+        """Content of the file, as stored on disk
+
+        Returns
+        -------
+        buf : bytes
+          the file image, which can be opened with :meth:`from_bytes`
+        """
+        if self._buffer is not None:
+            return self._buffer.getvalue()
+        self._require_hdf5('to_bytes')
+        with open(self.fullpath, 'rb') as fd:
+            return fd.read()
+
+    def close(self) -> None:
+        """Write an in-memory file to ``fullpath``
+
+        This is a no-op for files stored on disk or opened read-only. The
+        in-memory image is kept, so that the file can still be used and
+        closed again to write the new changes.
+        """
+        if self._buffer is None or self.mode == 'r' or not self.fullpath:
+            return
+        with open(self.fullpath, 'wb') as fd:
+            fd.write(self._buffer.getbuffer())
 
     def open(self, mode: Optional[str] = None, backend: str = 'h5py',
              filters=None):
@@ -64,7 +691,8 @@ class PhiDataFile(object):
           mode in which to open the file. By default,
           use the mode setting provided at initialization
         backend : str
-          hdf5 backend to use {"h5py", "pytables"}
+          name of the backend to use, e.g. "h5py" or "pytables", see
+          :func:`phicore.backends.get_backend`
         filter: obj
           An instance of the Filters class (for compression, etc)
         """
@@ -80,25 +708,41 @@ class PhiDataFile(object):
                            "instead!")
                           .format(self.fullpath))
 
-        if backend == 'h5py':
-            import h5py
-            return h5py.File(self.fullpath, mode)
-        elif backend == 'pytables':
-            import tables as tb
-            return tb.open_file(self.fullpath, mode=mode, filters=filters)
-        else:
-            raise ValueError("Wrong backend {}".format(backend))
+        target = self.fullpath if self._buffer is None else self._buffer
+        return self._backend(backend).open(target, mode, filters=filters)
+
+    def _open_for_create(self, backend: str):
+        """Open the file with ``backend`` to only create new nodes, which
+        avoids copying in-memory images (see
+        :meth:`phicore.backends.Backend.open_for_create`)"""
+        target = self.fullpath if self._buffer is None else self._buffer
+        return self._backend(backend).open_for_create(target)
+
+    def _backend(self, name: str):
+        """The backend ``name``, or the default one if it cannot access the
+        kind of store of the file"""
+        return get_backend(name, self.store)
+
+    def _require_hdf5(self, feature: str) -> None:
+        if self.store != 'hdf5':
+            raise ValueError('{} is only supported for HDF5 files, {} is a '
+                             '{} store'.format(feature, self.fullpath,
+                                               self.store))
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
         return False
 
     def _create_file(self) -> None:
         """Initialize basic file structure"""
-        import h5py
-        with h5py.File(self.fullpath, 'w') as f:
+        if self.in_memory:
+            self._buffer = io.BytesIO()
+        target = self.fullpath if self._buffer is None else self._buffer
+        with self._backend('h5py').open(target, 'w') as f:
             f.create_group('data')
             f.create_group('scales')
             f.create_group('diag')
@@ -145,26 +789,10 @@ class PhiDataFile(object):
         backend : str
           the backend to use
         """
-        if backend == 'pytables':
-            import tables as tb
-            filters = tb.Filters(fletcher32=fletcher32, complib=complib,
-                                 complevel=complevel)
-            with self.open('a', backend='pytables') as fh:
-                base_location, array_name = os.path.split(name)
-                out = fh.create_carray(base_location, array_name,
-                                       obj=data, chunkshape=chunks,
-                                       filters=filters)
-        elif backend == 'h5py':
-            if complevel > 0:
-                raise ValueError("The h5py backend doesn't support "
-                                 "compression, either set the backend "
-                                 "to 'pytables' or 'complevel' to 0.")
-            with self.open('a', backend='h5py') as fh:
-                out = fh.create_dataset(name, data=data, chunks=chunks,
-                                        fletcher32=fletcher32, **args)
-        else:
-            raise ValueError("Wrong backend {}".format(backend))
-        return out
+        with self._open_for_create(backend) as fh:
+            return self._backend(backend).create_dataset(
+                fh, name, data, fletcher32=fletcher32, complib=complib,
+                complevel=complevel, chunks=chunks, **args)
 
     def write_attrs(self,
                     attrs: dict,
@@ -208,6 +836,47 @@ class PhiDataFile(object):
 
             return {key: val for key, val in attrs.items()}
 
+    def get_stats(self, location: str) -> Dict[str, Any]:
+        """ Returns the statistics of a variable computed at write time
+
+        The statistics are read from ``/diag/stats/<path>``, where
+        ``<path>`` is the path of the variable relative to ``/data``,
+        without accessing the data itself (see the ``stats`` parameter of
+        :meth:`write_xarray`).
+
+        Parameters
+        ----------
+        location : str
+          path of the variable in the hdf5 file
+
+        Returns
+        -------
+        stats : dict
+          with the ``min``, ``max``, ``mean``, ``std`` and ``count`` of
+          the finite values (of the modulus for complex data),
+          ``percentiles`` a dict mapping percentiles to their values,
+          the ``histogram`` counts and its ``bin_edges``, the ``slice_min``,
+          ``slice_max``, ``slice_mean`` and ``slice_std`` arrays along the
+          last dimension ``slice_dim``, and ``stale``, which is True if
+          the variable was modified after computing the statistics.
+        """
+        with self.open('r') as fh:
+            stats_path = _find_stats(fh, location)
+            if stats_path is None:
+                raise KeyError('No statistics stored for {}, use '
+                               'write_xarray(..., stats=True)'
+                               .format(location))
+            group = fh[stats_path]
+            stats = {key: group[key][:] for key in group}
+            for key, val in group.attrs.items():
+                stats[key] = _decode(val)
+
+        stats['percentiles'] = dict(zip(stats['percentiles'].tolist(),
+                                        stats.pop('percentile_values')))
+        stats['stale'] = bool(stats['stale'])
+        del stats['variable']
+        return stats
+
     def list_xarray(self, location: str = '/data/') -> List[str]:
         """ List valid xarrays in designated folder. Returns full path.
 
@@ -223,10 +892,12 @@ class PhiDataFile(object):
         if not location.endswith('/'):
             location += '/'
 
+        backend = self._backend('h5py')
         with self.open('r', backend='h5py') as fh:
-            for dset in fh[location].keys():
-                if "scales" in fh[location + dset].attrs:
-                    output_list.append(fh[location + dset].name)
+            for dset in backend.list_nodes(fh, location):
+                node = backend.get_node(fh, location + dset)
+                if 'scales' in backend.attrs(node):
+                    output_list.append(location + dset)
 
         return output_list
 
@@ -237,6 +908,17 @@ class PhiDataFile(object):
                      backend: str = 'pytables',
                      complib: str = "blosc:lz4",
                      complevel: int = 0,
+                     stats: bool = False,
+                     pyramid_levels: int = 0,
+                     quantize: Optional[str] = None,
+                     precision: Optional[float] = None,
+                     complex_storage: Optional[str] = None,
+                     complex_dtype=None,
+                     plane_options: Optional[Dict[str, Dict[str, Any]]] = None,
+                     roi=None,
+                     roi_threshold: float = 5.,
+                     delta_dim: Optional[str] = None,
+                     keyframe_interval: int = 16,
                      **args) -> None:
         """ Write an xarray to hdf5
 
@@ -266,9 +948,231 @@ class PhiDataFile(object):
 
         backend : str
           the backend to use
+
+        stats : bool
+          compute summary statistics of the data (min, max, mean, std,
+          percentiles and histogram, as well as min, max, mean and std of
+          each slice along the last dimension) and store them in
+          ``/diag/stats/<name>``, see :meth:`get_stats`
+
+        pyramid_levels : int
+          number of downsampled levels to store for previews. Level ``k``
+          averages blocks of ``2**k`` pixels along each of the spatial
+          ``x``, ``y`` dimensions and is stored as a variable in
+          ``/diag/pyramid/<name>_L<k>``, see :meth:`read_preview`
+
+        quantize : {'absolute', 'relative'}, optional
+          store floating point data with a lossy quantization guaranteeing
+          an absolute or relative error of at most ``precision``, see
+          :func:`phicore.encoding.quantize`. The data is transparently
+          decoded by :meth:`read_xarray`. Compression should be enabled
+          (``complevel > 0``) to benefit from it.
+
+        precision : float, optional
+          the maximum absolute or relative quantization error
+
+        complex_storage : {'real-imag', 'amp-phase'}, optional
+          store complex data as two real planes, real and imaginary parts
+          or amplitude and phase, in datasets of the ``<location>/<name>``
+          group (see :func:`phicore.encoding.split_complex`). Planes
+          compress much better than interleaved complex numbers, and are
+          read identically by h5py and PyTables. The data is transparently
+          reassembled by :meth:`read_xarray`.
+
+        complex_dtype : str or numpy.dtype, optional
+          complex dtype of the stored data with ``complex_storage``, e.g.
+          'complex64' to store complex128 data as float32 planes
+
+        plane_options : dict, optional
+          per plane overrides of the ``complib``, ``complevel``,
+          ``quantize`` and ``precision`` options with ``complex_storage``,
+          e.g. ``{'phase': {'quantize': 'absolute', 'precision': 1e-3}}``
+
+        roi : {'variable', 'frame'} or dict, optional
+          store only a region of interest along the spatial ``x``, ``y``
+          dimensions and a background level, in the ``<location>/<name>``
+          group (see :func:`phicore.encoding.split_roi`). 'variable'
+          detects a single bounding box around the pixels that deviate
+          from the background in any frame, 'frame' detects a bounding box
+          in each frame (boxes are enlarged to a common size). A dict
+          mapping spatial dimensions to index slices, or to lists of one
+          slice per frame, gives the bounding box explicitly. The full
+          data, with the background level outside of the region of
+          interest, is reconstructed by :meth:`read_xarray`, which can
+          also return only the region of interest with ``roi_only=True``.
+
+        roi_threshold : float
+          with automatic ``roi`` detection, pixels deviate from the
+          background when they differ from the median of the frame by
+          more than ``roi_threshold`` times the noise level
+
+        delta_dim : str, optional
+          store consecutive frames along this dimension (e.g. shots or
+          time steps) as differences with the previous frame, with a
+          keyframe every ``keyframe_interval`` frames (see
+          :func:`phicore.encoding.delta_encode`). The encoding is lossless
+          and greatly improves compression of correlated frames, when
+          compression is enabled (``complevel > 0``). Cannot be combined
+          with ``quantize``.
+
+        keyframe_interval : int
+          distance between keyframes along ``delta_dim``. Reading a frame
+          requires reading at most ``keyframe_interval`` frames.
         """
-        import numpy as np
+        self.write_dataset([data], location=location, chunks=chunks,
+                           backend=backend, complib=complib,
+                           complevel=complevel, stats=stats,
+                           pyramid_levels=pyramid_levels, quantize=quantize,
+                           precision=precision,
+                           complex_storage=complex_storage,
+                           complex_dtype=complex_dtype,
+                           plane_options=plane_options, roi=roi,
+                           roi_threshold=roi_threshold, delta_dim=delta_dim,
+                           keyframe_interval=keyframe_interval, **args)
+
+    def write_dataset(self,
+                      data,
+                      location: str = '/data/',
+                      **args) -> None:
+        """ Write several variables at once
+
+        All variables are validated before writing anything, their values
+        are then written in a single session of the backend, and their
+        scales and attributes in a single h5py session. Scales shared by
+        several variables (same dimension, unit and values) are stored
+        once, and hard linked to the scale path of the other variables. If
+        writing any variable fails, all the variables are removed, so that
+        a measurement is never left half-written.
+
+        Parameters
+        ----------
+        data : xarray.Dataset or list of xarray.DataArray
+          the variables to save, stored under their name
+
+        location : str
+          path in the hdf5 file in which to save
 
+        args : kwargs
+          the keyword arguments of :meth:`write_xarray` (compression,
+          encodings, statistics, ...), applied to all variables
+        """
+        import xarray as xr
+
+        if isinstance(data, xr.Dataset):
+            data = [data[name] for name in data.data_vars]
+        plans = [self._plan_variable(X, location, **args) for X in data]
+
+        locations = [plan['location'] for plan in plans]
+        duplicated = sorted({path for path in locations
+                             if locations.count(path) > 1})
+        if duplicated:
+            raise ValueError('several variables would be written to {}'
+                             .format(', '.join(duplicated)))
+        with self.open('r') as fh:
+            for plan in plans:
+                for path in plan['nodes']:
+                    if path in fh:
+                        raise ValueError('{} already exists'.format(path))
+        nodes = [path for plan in plans for path in plan['nodes']]
+
+        backend = self._backend(args.get('backend', 'pytables'))
+        attrs_backend = self._backend('h5py')
+        encodings = {}
+
+        def _write_data(fh):
+            try:
+                for plan in plans:
+                    X = plan['data']
+                    encodings.update(self._write_values(
+                        fh, plan['location'], X.values, roi=plan['roi'],
+                        **plan['options']))
+                    if plan['pyramid_levels']:
+                        plan['pyramid'] = _build_pyramid(
+                            X.values, X.dims, {key: val.values for key, val
+                                               in X.coords.items()},
+                            plan['pyramid_levels'])
+                    options = dict(plan['options'], chunks=None,
+                                   roi_axes=None)
+                    for level, (values, _) in enumerate(plan['pyramid'], 1):
+                        encodings.update(self._write_values(
+                            fh, _pyramid_path(plan['location'], level), values,
+                            **options))
+            except Exception:
+                # do not leave partially written variables (e.g. a group
+                # holding some of the planes of an encoded variable)
+                _remove_nodes(backend, fh, nodes)
+                raise
+
+        def _write_attrs(fh):
+            scales = {}
+            try:
+                for plan in plans:
+                    X = plan['data']
+                    dataset_name = plan['name']
+                    _write_metadata(fh, plan['location'], dataset_name,
+                                    X.dims, {key: val.values for key, val
+                                             in X.coords.items()},
+                                    X.attrs['scale_units'], X.attrs,
+                                    scales=scales, **plan['args'])
+                    if plan['stats']:
+                        _write_stats(fh, plan['location'], X.dims, X.values)
+                    for level, (_, coords) in enumerate(plan['pyramid'], 1):
+                        level_path = _pyramid_path(plan['location'], level)
+                        attrs = dict(X.attrs, pyramid_level=level,
+                                     pyramid_factor=2 ** level, stale=False)
+                        _write_metadata(fh, level_path,
+                                        os.path.basename(level_path),
+                                        X.dims, coords,
+                                        X.attrs['scale_units'], attrs,
+                                        **plan['args'])
+                for path, attrs in encodings.items():
+                    fh[path].attrs.update(attrs)
+            except Exception:
+                _remove_nodes(attrs_backend, fh, nodes)
+                raise
+
+        # Create the datasets with the corresponding backend (and
+        # compression), and always use h5py to set attributes and scales
+        # (to use a simpler API)
+        with self._open_for_create(backend.name) as fh:
+            _write_data(fh)
+            if backend is attrs_backend:
+                _write_attrs(fh)
+        if backend is not attrs_backend:
+            with self.open('a') as fh:
+                _write_attrs(fh)
+
+    def _plan_variable(self,
+                       data,
+                       location: str = '/data/',
+                       chunks: bool = None,
+                       backend: str = 'pytables',
+                       complib: str = "blosc:lz4",
+                       complevel: int = 0,
+                       stats: bool = False,
+                       pyramid_levels: int = 0,
+                       quantize: Optional[str] = None,
+                       precision: Optional[float] = None,
+                       complex_storage: Optional[str] = None,
+                       complex_dtype=None,
+                       plane_options: Optional[Dict[str, Any]] = None,
+                       roi=None,
+                       roi_threshold: float = 5.,
+                       delta_dim: Optional[str] = None,
+                       keyframe_interval: int = 16,
+                       **args) -> Dict[str, Any]:
+        """ Validate a variable and the options to write it
+
+        See :meth:`write_xarray` for the parameters.
+
+        Returns
+        -------
+        plan : dict
+          the variable ``data`` and its ``name``, ``location``, the
+          ``nodes`` to create, the ``options`` of :meth:`_write_values`,
+          the ``roi`` option, the ``stats`` and ``pyramid_levels`` options
+          and the h5py ``args``
+        """
         if data.name is not None:
             dataset_name = data.name
         else:
@@ -282,38 +1186,309 @@ class PhiDataFile(object):
             raise ValueError(('Not a valid path {} inside hdf5 for saving '
                               'xarrays. Must be of the form '
                               '/data/<array_name>.').format(location))
-        # Create the dataset with the corresponding backend (and compression)
-        self.create_dataset(location, data=data.values, chunks=chunks,
-                            backend=backend, complib=complib,
-                            complevel=complevel, **args)
-        # Always use h5py to set attributes and scales (to use a simpler API)
-        with self.open('a') as fh:
-            fh[location].attrs['name'] = dataset_name
-            fh[location].attrs['scales'] = [el.encode('utf8')
-                                            for el in data.dims]
-            for key, val in data.coords.items():
-                scale_path = '/scales/' + '_'.join([dataset_name, key])
-                fh.create_dataset(scale_path, data=val.values, **args)
-                fh[scale_path].attrs['unit'] = data.attrs['scale_units'][key].encode('utf-8')  # noqa
-
-            # save optional attributes
-            for key, value in data.attrs.items():
-                if key in ['name', 'scale_units']:
-                    continue
+        missing = [key for key in data.coords
+                   if key not in data.attrs.get('scale_units', {})]
+        if missing:
+            raise ValueError('{} has no unit for the coordinates {}, set '
+                             "them in attrs['scale_units']"
+                             .format(dataset_name, missing))
+        if quantize is not None and precision is None:
+            raise ValueError('precision must be provided with quantize')
+        options = dict(chunks=chunks, backend=backend, complib=complib,
+                       complevel=complevel, quantize=quantize,
+                       precision=precision,
+                       complex_storage=complex_storage,
+                       complex_dtype=complex_dtype,
+                       plane_options=plane_options,
+                       roi_threshold=roi_threshold,
+                       keyframe_interval=keyframe_interval, **args)
+        if delta_dim is not None:
+            if delta_dim not in data.dims:
+                raise ValueError('delta_dim {!r} is not a dimension of {}, '
+                                 'expected one of {}'
+                                 .format(delta_dim, dataset_name,
+                                         list(data.dims)))
+            options['delta_axis'] = data.dims.index(delta_dim)
+        if roi is not None:
+            roi_axes = [idx for idx, dim in enumerate(data.dims)
+                        if dim in _SPATIAL_DIMS]
+            if not roi_axes:
+                raise ValueError('ROI storage requires at least one of the '
+                                 'spatial dimensions {}, got {}'
+                                 .format(_SPATIAL_DIMS, list(data.dims)))
+            if isinstance(roi, dict):
+                unknown = set(roi) - {data.dims[idx] for idx in roi_axes}
+                if unknown:
+                    raise ValueError('ROI dimensions {} are not spatial '
+                                     'dimensions of {}'
+                                     .format(sorted(unknown), dataset_name))
+                roi = {data.dims.index(dim): val for dim, val in roi.items()}
+            options['roi_axes'] = roi_axes
+        if pyramid_levels and not set(data.dims) & set(_SPATIAL_DIMS):
+            raise ValueError('building a pyramid requires at least one of '
+                             'the spatial dimensions {}, got {}'
+                             .format(_SPATIAL_DIMS, list(data.dims)))
+        nodes = [location] + [_pyramid_path(location, level)
+                              for level in range(1, pyramid_levels + 1)]
+        nodes += [_scale_path(path, key)
+                  for path in nodes for key in data.coords]
+        if stats:
+            nodes.append(_stats_path(location))
+        return {'data': data, 'name': dataset_name, 'location': location,
+                'nodes': nodes, 'options': options, 'roi': roi,
+                'stats': stats, 'pyramid_levels': pyramid_levels,
+                'pyramid': [], 'args': args}
+
+    def _write_values(self,
+                      fh,
+                      location: str,
+                      values,
+                      chunks: bool = None,
+                      backend: str = 'pytables',
+                      complib: str = "blosc:lz4",
+                      complevel: int = 0,
+                      quantize: Optional[str] = None,
+                      precision: Optional[float] = None,
+                      complex_storage: Optional[str] = None,
+                      complex_dtype=None,
+                      plane_options: Optional[dict] = None,
+                      roi=None,
+                      roi_axes: Optional[List[int]] = None,
+                      roi_threshold: float = 5.,
+                      delta_axis: Optional[int] = None,
+                      keyframe_interval: int = 16,
+                      **args) -> Dict[str, Dict[str, Any]]:
+        """ Create the dataset(s) storing the values of a variable
+
+        ``fh`` is the file opened with ``backend``, see :meth:`write_xarray`
+        for the other parameters.
 
-                if (isinstance(value, (np.ndarray, np.str_))
-                        and value.dtype.kind == 'U'
-                        and value.ndim == 0):
-                    value = str(value)
+        Returns
+        -------
+        encodings : dict
+          mapping of the created nodes to their encoding attributes, which
+          are to be written with h5py
+        """
+        if quantize is not None and precision is None:
+            raise ValueError('precision must be provided with quantize')
+        delta_options = dict(delta_axis=delta_axis,
+                             keyframe_interval=keyframe_interval)
+
+        if roi is not None:
+            if complex_storage is not None:
+                raise ValueError('roi and complex_storage cannot be used '
+                                 'together')
+            planes, encoding_attrs = split_roi(values, roi_axes, roi,
+                                               roi_threshold)
+            encodings = {location: encoding_attrs}
+            encodings.update(self._write_values(
+                fh, location + '/block', planes['block'], chunks=chunks,
+                backend=backend, complib=complib, complevel=complevel,
+                quantize=quantize, precision=precision, **delta_options,
+                **args))
+            for name in ('offsets', 'background'):
+                self._backend(backend).create_dataset(
+                    fh, location + '/' + name, planes[name], complib=complib,
+                    complevel=complevel, **args)
+            return encodings
+
+        if complex_storage is None:
+            encoding_attrs = {}
+            if quantize is not None and delta_axis is not None:
+                raise ValueError('quantize and delta_dim cannot be used '
+                                 'together')
+            if quantize is not None:
+                values, encoding_attrs = _quantize(values, quantize,
+                                                   precision)
+            elif delta_axis is not None:
+                values, encoding_attrs = delta_encode(values, delta_axis,
+                                                      keyframe_interval)
+            self._backend(backend).create_dataset(
+                fh, location, values, chunks=chunks, complib=complib,
+                complevel=complevel, **args)
+            return {location: encoding_attrs} if encoding_attrs else {}
+
+        planes, encoding_attrs = split_complex(values, complex_storage,
+                                               complex_dtype)
+        plane_options = plane_options or {}
+        unknown = set(plane_options) - set(planes)
+        if unknown:
+            raise ValueError('unknown planes {} for the {} complex storage, '
+                             'expected {}'.format(sorted(unknown),
+                                                  complex_storage,
+                                                  sorted(planes)))
+        # validate the options of all planes before creating any dataset
+        all_options = {}
+        for name in planes:
+            options = dict(complib=complib, complevel=complevel,
+                           quantize=quantize, precision=precision)
+            unknown = set(plane_options.get(name, {})) - set(options)
+            if unknown:
+                raise ValueError('unknown plane options {}, expected a '
+                                 'subset of {}'.format(sorted(unknown),
+                                                       sorted(options)))
+            options.update(plane_options.get(name, {}))
+            if options['quantize'] is not None:
+                if options['precision'] is None:
+                    raise ValueError('precision must be provided with '
+                                     'quantize')
+                if delta_axis is not None:
+                    raise ValueError('quantize and delta_dim cannot be used '
+                                     'together')
+            all_options[name] = options
+        encodings = {location: encoding_attrs}
+        for name, plane in planes.items():
+            encodings.update(self._write_values(
+                fh, location + '/' + name, plane, chunks=chunks,
+                backend=backend, **all_options[name], **delta_options,
+                **args))
+        return encodings
+
+    def write_region(self,
+                     location: str,
+                     values,
+                     index: Tuple[Any, ...] = (),
+                     sel: Optional[Dict[str, Any]] = None,
+                     casting: str = 'same_kind',
+                     backend: str = 'h5py') -> None:
+        """ Overwrite a region of an existing variable in place
+
+        Only the chunks intersecting the region are read and rewritten,
+        so the cost is proportional to the size of the update.
+
+        Only one of ``index``, ``sel`` can be provided at a time. When
+        neither is given and ``values`` is an ``xarray.DataArray``, the
+        region is located from its coordinates.
 
-                fh[location].attrs[key] = value
+        Parameters
+        ----------
+        location : str
+          path of the variable in the hdf5 file
+        values : {array-like, xarray.DataArray}
+          the new values. They are broadcast to the shape of the region
+          and cast to the dtype of the stored variable. When a DataArray
+          is given, its coordinates must match the stored scales.
+        index : tuple
+          tuple of ints and slices specifying the region to write
+        sel : dict, optional
+          mapping of dimension names to coordinate labels, label slices
+          (inclusive, as in ``xarray.DataArray.sel``) or arrays of labels
+        casting : str
+          the casting rule used to convert ``values`` to the stored dtype
+          (see ``numpy.ndarray.astype``)
+        backend : str
+          the backend to use, one of {'h5py', 'pytables'}
+        """
+        import numpy as np
+        import xarray as xr
+
+        dataset_name = os.path.basename(location)
+        if not dataset_name:
+            raise ValueError(('Not a valid path {} inside hdf5 for writing '
+                              'xarrays. Must be of the form '
+                              '/<folder>/<array_name>.').format(location))
+        if index and sel:
+            raise ValueError('index and sel parameters cannot '
+                             'be used together!')
+        backend = self._backend(backend)
+
+        is_xarray = isinstance(values, xr.DataArray)
+
+        with self.open('a', backend=backend.name) as fh:
+            node = backend.get_node(fh, location)
+            if 'scales' not in node_attrs(node):
+                raise ValueError('{} is not a phicore variable (no scales '
+                                 'attribute)'.format(location))
+            encoding = None
+            if 'encoding' in node_attrs(node):
+                encoding = _decode(node_attrs(node)['encoding'])
+                if encoding != 'bit-round':
+                    raise ValueError('{} is stored with the {} encoding and '
+                                     'cannot be updated in place'
+                                     .format(location, encoding))
+            dims = [_decode(el) for el in node_attrs(node)['scales']]
+            if is_xarray and not index and sel is None:
+                # locate the region from the (possibly scalar) coordinates
+                sel = {key: val.values for key, val in values.coords.items()
+                       if key in dims}
+
+            def _load_scale(dim):
+                return backend.read(backend.get_node(
+                    fh, _scale_path(location, dim)))
+
+            if sel:
+                unknown = set(sel) - set(dims)
+                if unknown:
+                    raise ValueError('dimensions {} not found in {} with '
+                                     'dims {}'.format(sorted(unknown),
+                                                      location, dims))
+                index = tuple(_label_to_index(_load_scale(dim), sel[dim], dim)
+                              if dim in sel else slice(None)
+                              for dim in dims)
+            index = _normalize_index(index, node.shape)
+
+            region_dims = [dim for dim, idx in zip(dims, index)
+                           if isinstance(idx, slice)]
+            region_shape = tuple(len(range(idx.start, idx.stop, idx.step))
+                                 for idx in index if isinstance(idx, slice))
+
+            if is_xarray:
+                missing = set(values.dims) - set(region_dims)
+                if missing:
+                    raise ValueError('values have dimensions {} that are '
+                                     'not part of the written region {}'
+                                     .format(sorted(missing), region_dims))
+                for dim, idx in zip(dims, index):
+                    if dim not in values.coords:
+                        continue
+                    expected = _load_scale(dim)[idx]
+                    if not np.array_equal(np.asarray(values.coords[dim]),
+                                          expected):
+                        raise ValueError('coordinates of values along {} do '
+                                         'not match the stored scale'
+                                         .format(dim))
+                values_dims = [dim for dim in region_dims
+                               if dim in values.dims]
+                values = values.transpose(*values_dims).values.reshape(
+                    [values.sizes[dim] if dim in values.dims else 1
+                     for dim in region_dims])
+
+            values = np.asarray(values)
+            if not np.can_cast(values.dtype, node.dtype, casting=casting):
+                raise TypeError('Cannot cast values from {} to {} according '
+                                'to the rule {!r}'.format(values.dtype,
+                                                          node.dtype,
+                                                          casting))
+            try:
+                values = np.broadcast_to(values.astype(node.dtype,
+                                                       casting=casting),
+                                         region_shape)
+            except ValueError:
+                raise ValueError('values with shape {} cannot be broadcast '
+                                 'to the region shape {}'
+                                 .format(values.shape, region_shape))
+            if encoding == 'bit-round':
+                values = _bitround(values,
+                                   int(node.attrs['encoding_keepbits']))
+            node[index] = np.ascontiguousarray(values)
+
+        with self.open('a') as fh:
+            stats_path = _find_stats(fh, location)
+            if stats_path is not None:
+                fh[stats_path].attrs['stale'] = True
+            level = 1
+            while _pyramid_path(location, level) in fh:
+                fh[_pyramid_path(location, level)].attrs['stale'] = True
+                level += 1
 
     def read_xarray(self,
                     location: str,
                     index: Tuple[int, ...] = (),
                     chunks: Tuple[int, ...] = (),
                     backend: str = 'h5py',
-                    mmap: bool = False):
+                    mmap: bool = False,
+                    level: int = 0,
+                    roi_only: bool = False):
         """ Read an xarray from hdf5
 
         Only one of ``index``, ``chunks`` can be provided at a time.
@@ -338,6 +1513,15 @@ class PhiDataFile(object):
           .. note:: this option is not compatible with index or chunks,
           and returns a namedtuple (with the idential fields) instead
           of a real DataArray.
+        level : int, default=0
+          read the downsampled level ``level`` of the variable stored with
+          ``write_xarray(..., pyramid_levels=...)`` instead of the full
+          resolution data, see also :meth:`read_preview`
+        roi_only : bool, default=False
+          for variables stored with ``write_xarray(..., roi=...)``, only
+          read the region of interest, i.e. the union of the bounding boxes
+          of the selected frames (intersected with ``index``), instead of
+          reconstructing the full images
 
         Returns
         -------
@@ -352,6 +1536,15 @@ class PhiDataFile(object):
             raise ValueError(('Not a valid path {} inside hdf5 for loading '
                               'xarrays. Must be of the form '
                               '/<folder>/<array_name>.').format(location))
+        if level:
+            level_path = _pyramid_path(location, level)
+            with self.open('r') as fh:
+                if level_path not in fh:
+                    raise ValueError('Level {} of {} does not exist, use '
+                                     'write_xarray(..., pyramid_levels=...)'
+                                     .format(level, location))
+            location = level_path
+            dataset_name = os.path.basename(location)
         if index and chunks:
             raise ValueError('index and chunks parameters cannot '
                              'be used together!')
@@ -360,34 +1553,41 @@ class PhiDataFile(object):
             raise ValueError('mmap=True is not compatible with providing '
                              'index or chunks!')
 
-        if backend not in ['pytables', 'h5py']:
-            raise ValueError('unknown backend {}'.format(backend))
+        backend = self._backend(backend)
+        fh = self.open('r', backend=backend.name)
 
-        fh = self.open('r', backend=backend)
-
-        def _h5_loader(fh, location):
-            if backend == 'pytables':
-                location = ('root.' + location.strip('/')).replace('/', '.')
-
-                return operator.attrgetter(location)(fh)
-            elif backend == 'h5py':
-                return fh[location]
-            else:
-                raise ValueError
-
-        def _h5_attr_iter(x):
-            if backend == 'pytables':
-                return {key: getattr(x, key)
-                        for key in [name for name in dir(x)
-                                    if not name.startswith('_')]}.items()
-            elif backend == 'h5py':
-                return x.items()
-            else:
-                raise ValueError
-
-        X_raw = _h5_loader(fh, location)
-
-        if chunks:
+        X_raw = backend.get_node(fh, location)
+        X_attrs = backend.attrs(X_raw)
+        if index:
+            index = _normalize_index(index, variable_shape(X_raw))
+        missing = backend.missing_sources(X_raw, self.fullpath, index)
+        if missing:
+            fh.close()
+            raise IOError('virtual sources {} of {} not found'
+                          .format(', '.join(missing), location))
+        encoding = None
+        if 'encoding' in X_attrs:
+            encoding = _decode(X_attrs['encoding'])
+            if encoding == 'bit-round':
+                # stored values need no decoding
+                encoding = None
+        if encoding is not None and (chunks or mmap):
+            raise ValueError('chunks and mmap are not supported for '
+                             'variables stored with the {} encoding'
+                             .format(encoding))
+
+        if roi_only:
+            if encoding != 'roi':
+                raise ValueError('{} is not stored with a region of '
+                                 'interest, use write_xarray(..., roi=...)'
+                                 .format(location))
+            index = roi_index(X_raw, _normalize_index(index,
+                                                      variable_shape(X_raw)))
+        if encoding is not None:
+            if index:
+                index = _normalize_index(index, variable_shape(X_raw))
+            X_raw = read_encoded(X_raw, index)
+        elif chunks:
             try:
                 import dask.array as da
             except ImportError:
@@ -395,32 +1595,37 @@ class PhiDataFile(object):
                                  ' be installed. Could not find dask!')
             X_raw = da.from_array(X_raw, chunks=chunks)
         elif index:
-            X_raw = X_raw[index]
+            index = _normalize_index(index, X_raw.shape)
+            X_raw = backend.read(X_raw, index)
         elif not mmap:
-            X_raw = X_raw[:]  # load data in memory
-        scale_names = [el.decode('utf-8')
-                       for el in _h5_loader(fh, location).attrs['scales']]
+            X_raw = backend.read(X_raw)  # load data in memory
+        scale_names = [_decode(el) for el in X_attrs['scales']]
+
+        if index:
+            # dimensions indexed with an integer are dropped
+            dims = [name for name, local_index in zip(scale_names, index)
+                    if isinstance(local_index, slice)]
+        else:
+            dims = scale_names
 
         coords = {}
         scale_units = {}
 
         for idx, name in enumerate(scale_names):
-            coord_path = '/scales/' + '_'.join([dataset_name, name])
-            coord_val = _h5_loader(fh, coord_path)
+            coord_val = backend.get_node(fh, _scale_path(location, name))
             if index:
-                local_index = index[idx]
-                coords[name] = coord_val[local_index]
+                coords[name] = backend.read(coord_val, (index[idx],))
             else:
-                coords[name] = coord_val[:]
+                coords[name] = backend.read(coord_val)
 
-            scale_units[name] = coord_val.attrs['unit'].decode('utf-8')
+            scale_units[name] = _decode(backend.attrs(coord_val)['unit'])
 
         attrs = {'name': dataset_name,
                  'scale_units': scale_units}
 
         # save optional attributes
-        for key, value in _h5_attr_iter(_h5_loader(fh, location).attrs):
-            if key in ['name', 'scales']:
+        for key, value in X_attrs.items():
+            if key in ['name', 'scales'] or is_encoding_attr(key):
                 continue
             if key.isupper():
                 # skip system attributes in PyTables
@@ -441,5 +1646,652 @@ class PhiDataFile(object):
                             ('values', 'coords', 'dims', 'attrs', 'name'))
             return nt(X_raw, coords, tuple(scale_names), attrs, dataset_name)
         else:
-            return xr.DataArray(X_raw, coords=coords, dims=scale_names,
+            return xr.DataArray(X_raw, coords=coords, dims=dims,
                                 attrs=attrs, name=dataset_name)
+
+    def read_preview(self,
+                     location: str,
+                     max_pixels: int,
+                     index: Tuple[int, ...] = (),
+                     backend: str = 'h5py'):
+        """ Read a downsampled version of a variable for display
+
+        Returns the pyramid level (see the ``pyramid_levels`` parameter of
+        :meth:`write_xarray`) with the highest resolution such that the
+        number of pixels along the spatial ``x``, ``y`` dimensions does
+        not exceed ``max_pixels``. If no level is small enough, the
+        coarsest one is returned.
+
+        Parameters
+        ----------
+        location : str
+          path of the variable in the hdf5 file
+        max_pixels : int
+          maximum number of spatial pixels
+        index : tuple
+          tuple of slices specifying the subset of the level to load
+          (e.g. to select a single frame along the last dimension)
+        backend : str
+          the backend to use, one of {'hdf5', 'pytables'}
+
+        Returns
+        -------
+        X : xarray.DataArray
+          the downsampled data, with the ``pyramid_level`` and
+          ``pyramid_factor`` attributes for levels other than 0, as well
+          as the ``stale`` attribute, which is True if the variable was
+          modified with :meth:`write_region` after computing the levels
+        """
+        import numpy as np
+
+        def _n_pixels(node):
+            dims = [_decode(el) for el in node_attrs(node)['scales']]
+            shape = variable_shape(node)
+            return int(np.prod([size for dim, size in zip(dims, shape)
+                                if dim in _SPATIAL_DIMS]))
+
+        with self.open('r') as fh:
+            level = 0
+            n_pixels = _n_pixels(fh[location])
+            while n_pixels > max_pixels and \
+                    _pyramid_path(location, level + 1) in fh:
+                level += 1
+                n_pixels = _n_pixels(fh[_pyramid_path(location, level)])
+
+        return self.read_xarray(location, index=index, backend=backend,
+                                level=level)
+
+    def append_shot(self,
+                    data,
+                    shot_id: Optional[int] = None,
+                    timestamp: Optional[float] = None,
+                    attrs: Optional[Dict[str, Any]] = None,
+                    **args) -> int:
+        """ Append a shot to the shot series of the file
+
+        The variables of the shot are stored in the ``/data/shots/shot_<id>``
+        group (with their scales in ``/scales/shots/shot_<id>``), and a row
+        with the shot id, its timestamp and its scalar attributes is
+        appended to the indexed ``/diag/shots`` table, which can be
+        searched with :meth:`query_shots`.
+
+        Parameters
+        ----------
+        data : xarray.Dataset or list of xarray.DataArray
+          the variables of the shot
+        shot_id : int, optional
+          the id of the shot, by default the number of shots already
+          stored
+        timestamp : float, optional
+          the time of the shot in seconds since the epoch, by default the
+          current time
+        attrs : dict, optional
+          numeric or boolean scalar attributes of the shot (e.g. the laser
+          energy or a delay), stored as attributes of the shot group
+          (booleans as 0 or 1) and as indexed columns of the shot table.
+          All the shots of a file must have the same attributes.
+        args : kwargs
+          the keyword arguments of :meth:`write_xarray` (compression,
+          encodings, statistics, ...) except ``pyramid_levels``, applied
+          to all variables
+
+        Returns
+        -------
+        shot_id : int
+          the id of the shot
+        """
+        import numpy as np
+        import tables as tb
+
+        self._require_hdf5('append_shot')
+        if args.get('pyramid_levels'):
+            raise ValueError('pyramid_levels is not supported for shots')
+        attrs = dict(attrs or {})
+        for key, val in attrs.items():
+            if key in ('shot_id', 'timestamp') or not key.isidentifier():
+                raise ValueError('invalid shot attribute name {!r}'
+                                 .format(key))
+            if np.ndim(val) != 0 or np.asarray(val).dtype.kind not in 'biuf':
+                raise ValueError('shot attribute {} must be a numeric or '
+                                 'boolean scalar, got {!r}'.format(key, val))
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.open('r') as fh:
+            columns = sorted(attrs)
+            n_shots = 0
+            if _SHOTS_TABLE in fh:
+                table = fh[_SHOTS_TABLE]
+                n_shots = len(table)
+                columns = [name for name in table.dtype.names
+                           if name not in ('shot_id', 'timestamp')]
+                if set(columns) != set(attrs):
+                    raise ValueError('shot attributes must be {}, got {}'
+                                     .format(columns, sorted(attrs)))
+            if shot_id is None:
+                shot_id = n_shots
+            shot_id = int(shot_id)
+            shot_path = _shot_path(shot_id)
+            if shot_path in fh:
+                raise ValueError('shot {} already exists'.format(shot_id))
+
+        try:
+            self.write_dataset(data, location=shot_path, **args)
+            with self.open('a') as fh:
+                # PyTables cannot read HDF5 boolean attributes
+                fh[shot_path].attrs.update(
+                    {key: int(val) if np.asarray(val).dtype.kind == 'b'
+                     else val for key, val in attrs.items()},
+                    shot_id=shot_id, timestamp=timestamp)
+            with self.open('a', backend='pytables') as fh:
+                if _SHOTS_TABLE in fh:
+                    table = fh.get_node(_SHOTS_TABLE)
+                else:
+                    description = {'shot_id': tb.Int64Col(pos=0),
+                                   'timestamp': tb.Float64Col(pos=1)}
+                    for pos, key in enumerate(columns, 2):
+                        description[key] = tb.Col.from_dtype(
+                            np.asarray(attrs[key]).dtype, pos=pos)
+                    table = _create_shot_table(fh, description)
+                table.append([(shot_id, timestamp)
+                              + tuple(attrs[key] for key in columns)])
+                table.flush()
+        except Exception:
+            with self.open('a') as fh:
+                _remove_nodes(self._backend('h5py'), fh,
+                              [shot_path,
+                               '/scales' + shot_path[len('/data'):]])
+            raise
+        return shot_id
+
+    def query_shots(self, condition: Optional[str] = None):
+        """ Search the shots of the shot series of the file
+
+        The search uses the indexes of the columns of the shot table, so
+        that neither the shot groups nor their variables are accessed.
+
+        Parameters
+        ----------
+        condition : str, optional
+          a PyTables condition on the ``shot_id``, ``timestamp`` and shot
+          attributes columns, e.g. ``'(energy > 1.5) & (delay < 10)'``, see
+          :meth:`tables.Table.read_where`. By default all shots are
+          returned.
+
+        Returns
+        -------
+        shots : numpy.ndarray
+          structured array with the ``shot_id``, ``timestamp`` and
+          attributes of the matching shots, in the order they were
+          appended. The variables of a shot are read with
+          :meth:`read_shot`.
+        """
+        self._require_hdf5('query_shots')
+        with self.open('r', backend='pytables') as fh:
+            if _SHOTS_TABLE not in fh:
+                raise ValueError('{} has no shots, use append_shot'
+                                 .format(self.fullpath))
+            table = fh.get_node(_SHOTS_TABLE)
+            if condition is None:
+                return table.read()
+            return table.read_where(condition)
+
+    def read_shot(self, shot_id: int, name: str, **args):
+        """ Read a variable of a shot
+
+        Parameters
+        ----------
+        shot_id : int
+          the id of the shot
+        name : str
+          the name of the variable
+        args : kwargs
+          keyword arguments passed to :meth:`read_xarray`
+
+        Returns
+        -------
+        X : xarray.DataArray
+          the variable
+        """
+        return self.read_xarray(_shot_path(int(shot_id)) + '/' + name,
+                                **args)
+
+    def reduce(self,
+               location: str,
+               op='mean',
+               dim=None,
+               working_memory: float = 64,
+               n_jobs: Optional[int] = 1,
+               output: Optional[str] = None,
+               backend: str = 'h5py'):
+        """ Reduce a variable along some dimensions without loading it
+
+        The variable is read in storage aligned blocks of at most
+        ``working_memory`` MiB, which are reduced in a thread pool and
+        accumulated, so that the peak memory is bounded by the size of
+        the result plus ``n_jobs`` blocks, regardless of the size of the
+        variable. The mean and standard deviation are accumulated with
+        the numerically stable pairwise update of Chan et al. The file is
+        opened once, and blocks are read one at a time (HDF5 libraries
+        serialize accesses anyway) while they are reduced in parallel.
+
+        Parameters
+        ----------
+        location : str
+          path of the variable in the hdf5 file
+        op : {'mean', 'sum', 'std', 'min', 'max'} or callable
+          the reduction. A callable is called as
+          ``op(values, axis=axes, keepdims=True)`` (e.g. ``numpy.median``)
+          on blocks covering the reduced dimensions entirely, which are
+          only split along the other dimensions. The memory is then only
+          bounded when those are large enough.
+        dim : str or list of str, optional
+          the dimension(s) to reduce, by default all of them
+        working_memory : float
+          maximum amount of memory in MiB used to read each block of data
+        n_jobs : int, optional
+          number of threads reducing blocks in parallel. None uses as
+          many threads as CPUs.
+        output : str, optional
+          if provided, the result is also stored as the ``/data/<output>``
+          variable, with its scales
+        backend : str
+          the backend to use, one of {'h5py', 'pytables'}
+
+        Returns
+        -------
+        X : xarray.DataArray
+          the reduced data, with the coordinates of the remaining
+          dimensions
+        """
+        import threading
+        import numpy as np
+        import xarray as xr
+        from concurrent.futures import ThreadPoolExecutor
+
+        dataset_name = os.path.basename(location)
+        if not (op in _REDUCE_OPS or callable(op)):
+            raise ValueError('op must be one of {} or a callable, got {!r}'
+                             .format(_REDUCE_OPS, op))
+        backend = self._backend(backend)
+
+        with self.open('r') as fh:
+            node = fh[location]
+            dims = [_decode(el) for el in node.attrs['scales']]
+            shape = variable_shape(node)
+            if 'encoding_dtype' in node.attrs:
+                dtype = np.dtype(_decode(node.attrs['encoding_dtype']))
+            else:
+                dtype = node.dtype
+            chunks = getattr(node, 'chunks', None)
+            coords = {}
+            scale_units = {}
+            for name in dims:
+                scale = fh[_scale_path(location, name)]
+                coords[name] = scale[:]
+                scale_units[name] = _decode(scale.attrs['unit'])
+
+        if dim is None:
+            dim = dims
+        elif isinstance(dim, str):
+            dim = [dim]
+        unknown = set(dim) - set(dims)
+        if unknown:
+            raise ValueError('dimensions {} not found in {} with dims {}'
+                             .format(sorted(unknown), location, dims))
+        axes = tuple(sorted(dims.index(name) for name in dim))
+        out_dims = [name for name in dims if name not in dim]
+        if output is not None and not out_dims:
+            raise ValueError('a reduction over all dimensions cannot be '
+                             'stored as a variable')
+
+        # named reductions can be merged across blocks, while callables
+        # must see the reduced dimensions entirely
+        if callable(op):
+            split_axes = tuple(axis for axis in range(len(shape))
+                               if axis not in axes)
+        else:
+            split_axes = tuple(range(len(shape)))
+        lock = threading.Lock()
+
+        # partial results of blocks that only differ along reduced axes
+        # are merged as soon as they are available, in storage order
+        partials = {}
+
+        def _accumulate(future):
+            index, partial = future.result()
+            key = tuple(None if axis in axes else idx.start
+                        for axis, idx in enumerate(index))
+            if key in partials:
+                partial = _merge_partials(partials[key][1], partial, op, axes)
+            partials[key] = (index, partial)
+
+        n_workers = n_jobs or os.cpu_count() or 1
+        pending = deque()
+        with self.open('r', backend=backend.name) as fh, \
+                ThreadPoolExecutor(max_workers=n_workers) as executor:
+            node = backend.get_node(fh, location)
+
+            def _process(index):
+                with lock:
+                    values = read_encoded(node,
+                                          _normalize_index(index, shape))
+                return index, _reduce_block(values, op, axes)
+
+            # only a few blocks are scheduled ahead to bound memory usage
+            for index in _reduction_blocks(shape, dtype.itemsize, chunks,
+                                           working_memory, split_axes):
+                pending.append(executor.submit(_process, index))
+                if len(pending) >= 2 * n_workers:
+                    _accumulate(pending.popleft())
+            while pending:
+                _accumulate(pending.popleft())
+
+        values = None
+        for index, partial in partials.values():
+            partial = _finalize_partial(partial, op)
+            if values is None:
+                values = np.empty([1 if axis in axes else size
+                                   for axis, size in enumerate(shape)],
+                                  dtype=partial.dtype)
+            values[tuple(slice(None) if axis in axes else idx
+                         for axis, idx in enumerate(index))] = partial
+        values = values.reshape([size for axis, size in enumerate(shape)
+                                 if axis not in axes])
+
+        result = xr.DataArray(values, dims=out_dims,
+                              coords={name: coords[name]
+                                      for name in out_dims},
+                              attrs={'name': output or dataset_name,
+                                     'scale_units': {name: scale_units[name]
+                                                     for name in out_dims}},
+                              name=output or dataset_name)
+        if output is not None:
+            self.write_xarray(result)
+        return result
+
+    def transform(self,
+                  location: str,
+                  dim: str = 't',
+                  to: str = 'w',
+                  out: Optional[str] = None,
+                  origin: Optional[float] = None,
+                  working_memory: float = 64,
+                  n_jobs: Optional[int] = 1,
+                  complib: str = "blosc:lz4",
+                  complevel: int = 0) -> str:
+        """ Fourier transform a variable between conjugate dimensions
+
+        The variable is read in tiles covering the transformed dimension
+        entirely, of at most ``working_memory`` MiB, which are transformed
+        in a thread pool and streamed into a new chunked variable, so that
+        variables larger than memory can be converted.
+
+        The transform approximates the continuous Fourier transform,
+        ``E(w) = int E(t) exp(-i w t) dt`` from a direct (``t``, ``tau``,
+        ``x``, ``y``) to a reciprocal (``w``, ``f``, ``kx``, ``ky``)
+        dimension, and ``E(t) = 1 / (2 pi) int E(w) exp(i w t) dw`` in
+        the other direction (``exp(-+2i pi f t)`` for frequencies ``f``),
+        accounting for the origin of both scales. Angular frequencies and
+        wave numbers (``w``, ``kx``, ``ky``) include the ``2 pi`` factor.
+        The new scale is centered on zero, with the same number of points.
+
+        Parameters
+        ----------
+        location : str
+          path of the variable in the hdf5 file
+        dim : str
+          the dimension to transform, which must be uniformly sampled
+        to : str
+          the conjugate dimension, see the coordinate notations of the
+          file format specification
+        out : str, optional
+          name of the new variable in ``/data``, by default
+          ``<name>_<to>``
+        origin : float, optional
+          first coordinate of the new scale, by default such that the
+          scale is centered on zero (as given by ``numpy.fft.fftfreq``).
+          Use the first coordinate of the original scale to recover it
+          with the inverse transform.
+        working_memory : float
+          maximum amount of memory in MiB used to read each tile of data
+        n_jobs : int, optional
+          number of threads transforming tiles in parallel. None uses as
+          many threads as CPUs.
+        complib : str
+          compression library of the new variable (see pytables.Filters)
+        complevel : int
+          the compression level of the new variable (see pytables.Filters)
+
+        Returns
+        -------
+        location : str
+          the path of the new variable, which can be read lazily with
+          ``read_xarray(..., chunks=...)``
+        """
+        import threading
+        import numpy as np
+        from concurrent.futures import ThreadPoolExecutor
+
+        dataset_name = os.path.basename(location)
+        if to not in _FFT_PAIRS.get(dim, ()):
+            raise ValueError('{} is not a conjugate dimension of {}, '
+                             'expected one of {}'
+                             .format(to, dim, list(_FFT_PAIRS.get(dim, ()))))
+        out = out or '{}_{}'.format(dataset_name, to)
+        out_location = '/data/' + out
+
+        with self.open('r') as fh:
+            if out_location in fh:
+                raise ValueError('{} already exists'.format(out_location))
+            node = fh[location]
+            dims = [_decode(el) for el in node.attrs['scales']]
+            if dim not in dims:
+                raise ValueError('dimension {} not found in {} with dims {}'
+                                 .format(dim, location, dims))
+            if to in dims:
+                raise ValueError('{} already has a {} dimension'
+                                 .format(location, to))
+            shape = variable_shape(node)
+            if 'encoding_dtype' in node.attrs:
+                dtype = np.dtype(_decode(node.attrs['encoding_dtype']))
+            else:
+                dtype = node.dtype
+            attrs = {key: val for key, val in node.attrs.items()
+                     if key not in ('name', 'scales')
+                     and not is_encoding_attr(key)}
+            coords = {}
+            scale_units = {}
+            for name in dims:
+                scale = fh[_scale_path(location, name)]
+                coords[name] = scale[:]
+                scale_units[name] = _decode(scale.attrs['unit'])
+
+        axis = dims.index(dim)
+        inverse = dim in _FFT_RECIPROCAL
+        step, start, target = _fft_coords(coords[dim], dim, to, origin)
+        out_dtype = np.result_type(dtype, np.complex64)
+        if out_dtype.itemsize > 8 or dtype.itemsize >= 8:
+            out_dtype = np.dtype(np.complex128)
+
+        unit = scale_units.pop(dim)
+        if unit == _FFT_UNITS[dim]:
+            scale_units[to] = _FFT_UNITS[to]
+        else:
+            scale_units[to] = '1/({})'.format(unit)
+        out_dims = list(dims)
+        out_dims[axis] = to
+        del coords[dim]
+        coords[to] = target * _FFT_FACTORS.get(to, 1.)
+
+        # tiles cover the transformed axis entirely
+        split_axes = tuple(el for el in range(len(shape)) if el != axis)
+        lock = threading.Lock()
+        n_workers = n_jobs or os.cpu_count() or 1
+        pending = deque()
+
+        backend = self._backend('pytables')
+        with self.open('a', backend=backend.name) as fh, \
+                ThreadPoolExecutor(max_workers=n_workers) as executor:
+            node = backend.get_node(fh, location)
+            dst = backend.create_dataset(fh, out_location, shape=shape,
+                                         dtype=out_dtype, complib=complib,
+                                         complevel=complevel)
+            # PyTables arrays have no chunks attribute
+            chunks = getattr(dst, 'chunkshape', None) or dst.chunks
+
+            def _process(index):
+                with lock:
+                    values = read_encoded(node,
+                                          _normalize_index(index, shape))
+                return index, _fft_tile(values, axis, step, start, target,
+                                        inverse)
+
+            def _store(future):
+                index, values = future.result()
+                with lock:
+                    dst[index] = values.astype(out_dtype)
+
+            try:
+                # only a few tiles are scheduled ahead to bound memory usage
+                for index in _reduction_blocks(shape, out_dtype.itemsize,
+                                               chunks, working_memory,
+                                               split_axes):
+                    pending.append(executor.submit(_process, index))
+                    if len(pending) >= 2 * n_workers:
+                        _store(pending.popleft())
+                while pending:
+                    _store(pending.popleft())
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                with lock:
+                    backend.remove(fh, out_location)
+                raise
+
+        with self.open('a') as fh:
+            _write_metadata(fh, out_location, out, out_dims, coords,
+                            scale_units, attrs)
+        return out_location
+
+    def verify(self, working_memory: float = 64) -> Dict[str, Any]:
+        """ Check the integrity of the file
+
+        All datasets are read in blocks of at most ``working_memory`` MiB,
+        which validates their fletcher32 checksums (when enabled), and the
+        structure of the file is checked against the phicore file format:
+
+         * the root node has a ``rev_fileformat`` attribute
+         * the ``data``, ``scales`` and ``diag`` groups exist
+         * every dataset in ``data`` has a ``scales`` attribute
+         * every variable scale exists, is a 1D vector of matching length
+           and has a ``unit`` attribute
+
+        Parameters
+        ----------
+        working_memory : float
+          maximum amount of memory in MiB used to read each block of data
+
+        Returns
+        -------
+        report : dict
+          a JSON serializable report with the file ``path``, an ``ok``
+          boolean, the list of ``errors`` (each a dict with a ``location``
+          and an ``error`` message), the number of datasets read
+          ``n_datasets``, the number of decoded bytes read ``n_bytes`` and
+          the ``elapsed`` time in seconds
+        """
+        from .archive import _walk_h5, _walk_store, _iter_blocks
+
+        t0 = time.time()
+        errors = []
+        n_datasets = 0
+        n_bytes = 0
+
+        def _error(location, message):
+            errors.append({'location': location, 'error': message})
+
+        def _check_scales(fh, path, node):
+            dims = [_decode(el) for el in node.attrs['scales']]
+            shape = variable_shape(node)
+            if len(dims) != len(shape):
+                _error(path, '{} scales for a {}D variable'
+                       .format(len(dims), len(shape)))
+            for idx, dim in enumerate(dims):
+                scale_path = _scale_path(path, dim)
+                if scale_path not in fh:
+                    _error(path, 'missing scale {}'.format(scale_path))
+                    continue
+                scale = fh[scale_path]
+                if not hasattr(scale, 'shape') or scale.ndim != 1:
+                    _error(scale_path, 'scale is not a 1D dataset')
+                elif idx < len(shape) and scale.shape[0] != shape[idx]:
+                    _error(scale_path, 'scale length {} does not match the '
+                           'dimension {} of size {}'
+                           .format(scale.shape[0], dim, shape[idx]))
+                if 'unit' not in scale.attrs:
+                    _error(scale_path, 'scale has no unit attribute')
+
+        try:
+            with self.open('r', backend='h5py') as fh:
+                if self.store == 'hdf5':
+                    plan = _walk_h5(fh)
+                else:
+                    plan = _walk_store(fh)
+
+                if 'rev_fileformat' not in fh.attrs:
+                    _error('/', 'missing rev_fileformat attribute')
+                for group in ('data', 'scales', 'diag'):
+                    if fh.get(group) is None or hasattr(fh[group], 'shape'):
+                        _error('/' + group, 'missing group')
+
+                for path, kind, _ in plan:
+                    if kind not in ('group', 'array', 'dataset', 'virtual'):
+                        continue
+                    node = fh[path]
+                    for source in _missing_sources(node, self.fullpath,
+                                                   open_sources=True):
+                        _error(path, 'virtual source {} not found'
+                               .format(source))
+                    if 'scales' in node.attrs:
+                        _check_scales(fh, path, node)
+                    elif (kind != 'group' and path.startswith('/data/')
+                          and 'encoding' not in node.parent.attrs):
+                        # datasets of encoded variables are not variables
+                        _error(path, 'data variable has no scales attribute')
+
+                    if kind == 'dataset':
+                        # strings, scalars, etc. that PyTables cannot read
+                        try:
+                            value = node[()]
+                            n_bytes += getattr(value, 'nbytes', 0)
+                            n_datasets += 1
+                        except Exception as exc:
+                            _error(path, 'read error: {}'.format(exc))
+
+            # use PyTables to read arrays as it supports all the
+            # compression libraries that phicore files may use
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                backend = self._backend('pytables')
+                with self.open('r', backend=backend.name) as fh:
+                    for path, kind, _ in plan:
+                        if kind not in ('array', 'virtual'):
+                            continue
+                        node = backend.get_node(fh, path)
+                        try:
+                            for sl in _iter_blocks(node, working_memory):
+                                n_bytes += backend.read(node, (sl,)).nbytes
+                            n_datasets += 1
+                        except Exception as exc:
+                            _error(path, 'read error (corrupted data or '
+                                   'checksum mismatch): {}'.format(exc))
+        except Exception as exc:
+            _error('/', 'cannot open file: {}'.format(exc))
+
+        return {'path': self.fullpath,
+                'ok': not errors,
+                'errors': errors,
+                'n_datasets': n_datasets,
+                'n_bytes': n_bytes,
+                'elapsed': time.time() - t0}
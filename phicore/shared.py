@@ -0,0 +1,293 @@
+# CeCILL-B license LIDYL, CEA
+
+"""Sharing variables between processes through shared memory
+
+A loader process reads a variable once with :func:`publish`, which copies
+it into a :mod:`multiprocessing.shared_memory` segment, and passes the
+resulting :class:`SharedHandle` to worker processes (as an argument of
+``Process``, ``Pool.map``, a queue, ...). Workers call :func:`attach` to
+obtain an :class:`xarray.DataArray` backed by the shared segment without
+copying or decompressing the data again, and :func:`detach` once done.
+
+Requires Python >= 3.8.
+"""
+
+import time
+import threading
+
+from collections import namedtuple
+from typing import Optional, Dict, Any
+
+from .io import PhiDataFile
+
+
+SharedHandle = namedtuple('SharedHandle',
+                          ('segment', 'shape', 'dtype', 'dims', 'coords',
+                           'attrs', 'name', 'refs', 'lock'))
+SharedHandle.__doc__ = """Picklable description of a shared variable
+
+Attributes
+----------
+segment : str
+  name of the shared memory segment
+shape : tuple
+  shape of the variable
+dtype : str
+  dtype of the variable
+dims : tuple
+  dimension names
+coords : dict
+  coordinates of each dimension
+attrs : dict
+  attributes of the variable, as returned by ``read_xarray``
+name : str
+  name of the variable
+refs : multiprocessing.managers.DictProxy
+  number of attachments of the segment, shared between processes
+lock : multiprocessing.managers.AcquirerProxy
+  lock protecting ``refs``
+"""
+
+# segments attached by the current process: name -> [SharedMemory, count]
+_ATTACHED = {}  # type: Dict[str, Any]
+_REGISTER_LOCK = threading.Lock()
+
+
+def _open_segment(name: str):
+    """Attach an existing segment without registering it for cleanup
+
+    Before Python 3.13, attaching a segment registers it with the resource
+    tracker, which unlinks it when the attaching process exits even though
+    the publisher still owns it. Unregistering it afterwards is not an
+    option, since forked workers share the tracker of the publisher.
+    """
+    from multiprocessing import shared_memory
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        from multiprocessing import resource_tracker
+
+        register = resource_tracker.register
+
+        def _register(name, rtype):
+            if rtype != 'shared_memory':
+                register(name, rtype)
+
+        with _REGISTER_LOCK:
+            resource_tracker.register = _register
+            try:
+                return shared_memory.SharedMemory(name=name)
+            finally:
+                resource_tracker.register = register
+
+
+class SharedVariable(object):
+    def __init__(self, values, dims, coords: Dict[str, Any],
+                 attrs: Dict[str, Any], name: str, manager=None):
+        """Owner of a variable copied into a shared memory segment
+
+        Use :func:`publish` to create it from a phicore file.
+
+        Parameters
+        ----------
+        values : numpy.ndarray
+          the data to share, copied once into the segment
+        dims : sequence of str
+          dimension names
+        coords : dict
+          coordinates of each dimension
+        attrs : dict
+          attributes of the variable
+        name : str
+          name of the variable
+        manager : multiprocessing.managers.SyncManager, optional
+          a started manager holding the reference count. By default a new
+          one is started and shut down by :meth:`close`; pass a common
+          manager when publishing several variables.
+        """
+        import multiprocessing
+        import numpy as np
+        from multiprocessing import shared_memory
+
+        values = np.asarray(values)
+        self._own_manager = manager is None
+        if manager is None:
+            manager = multiprocessing.Manager()
+        self._manager = manager
+        # zero sized segments are not allowed
+        self._shm = shared_memory.SharedMemory(create=True,
+                                               size=max(values.nbytes, 1))
+        try:
+            buf = np.ndarray(values.shape, dtype=values.dtype,
+                             buffer=self._shm.buf)
+            buf[...] = values
+            del buf
+            refs = manager.dict({'count': 0})
+            lock = manager.Lock()
+        except Exception:
+            self._shm.close()
+            self._shm.unlink()
+            if self._own_manager:
+                manager.shutdown()
+            raise
+        self.handle = SharedHandle(
+            self._shm.name, values.shape, values.dtype.str, tuple(dims),
+            {dim: np.asarray(val) for dim, val in coords.items()},
+            dict(attrs), name, refs, lock)
+        self.closed = False
+
+    @property
+    def n_attached(self) -> int:
+        """Number of current attachments, in all processes"""
+        if self.closed:
+            return 0
+        with self.handle.lock:
+            return self.handle.refs['count']
+
+    def close(self, wait: bool = True, timeout: Optional[float] = None,
+              poll: float = 0.05) -> None:
+        """Release the shared memory segment
+
+        Parameters
+        ----------
+        wait : bool
+          wait until all workers have called :func:`detach` before
+          releasing the segment
+        timeout : float, optional
+          maximum time to wait in seconds, after which an IOError is raised
+          and the segment is kept
+        poll : float
+          interval between checks of the reference count, in seconds
+        """
+        if self.closed:
+            return
+        if wait:
+            t0 = time.time()
+            while self.n_attached:
+                if timeout is not None and time.time() - t0 > timeout:
+                    raise IOError('{} is still attached {} time(s) after '
+                                  '{} s'.format(self.handle.name,
+                                                self.n_attached, timeout))
+                time.sleep(poll)
+        self.closed = True
+        self._shm.close()
+        self._shm.unlink()
+        if self._own_manager:
+            self._manager.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(wait=exc_type is None)
+        return False
+
+
+def publish(fh: PhiDataFile, location: str, manager=None,
+            **args) -> SharedVariable:
+    """Read a variable once and share it with other processes
+
+    Parameters
+    ----------
+    fh : PhiDataFile
+      the file to read from
+    location : str
+      path of the variable, e.g. ``/data/I``
+    manager : multiprocessing.managers.SyncManager, optional
+      see :class:`SharedVariable`
+    args : kwargs
+      keyword arguments passed to
+      :meth:`PhiDataFile.read_xarray <phicore.io.PhiDataFile.read_xarray>`,
+      e.g. ``index`` or ``backend``. ``chunks`` and ``mmap`` are not
+      supported.
+
+    Returns
+    -------
+    shared : SharedVariable
+      the owner of the segment, whose ``handle`` attribute is passed to
+      the workers. It must be closed to release the memory.
+
+    Examples
+    --------
+    >>> with publish(fh, '/data/I') as shared:  # doctest: +SKIP
+    ...     with multiprocessing.Pool(4) as pool:
+    ...         pool.map(analyse, [shared.handle] * 4)
+
+    where ``analyse`` calls ``X = attach(handle)``, works on ``X`` and
+    calls ``detach(handle)``.
+    """
+    if 'chunks' in args or args.get('mmap'):
+        raise ValueError('chunks and mmap are not supported for shared '
+                         'variables')
+    X = fh.read_xarray(location, **args)
+    return SharedVariable(X.values, X.dims,
+                          {key: val.values for key, val in X.coords.items()},
+                          X.attrs, X.name, manager=manager)
+
+
+def attach(handle: SharedHandle):
+    """Attach a shared variable
+
+    The returned array is read-only and shares its memory with the
+    publisher and all other workers. Attaching the same handle several
+    times in a process maps the segment once.
+
+    Parameters
+    ----------
+    handle : SharedHandle
+      the ``handle`` attribute of a :class:`SharedVariable`
+
+    Returns
+    -------
+    X : xarray.DataArray
+      the shared variable
+    """
+    import numpy as np
+    import xarray as xr
+
+    if handle.segment not in _ATTACHED:
+        try:
+            shm = _open_segment(handle.segment)
+        except FileNotFoundError:
+            raise IOError('shared variable {} was already released'
+                          .format(handle.name))
+        _ATTACHED[handle.segment] = [shm, 0]
+    with handle.lock:
+        handle.refs['count'] = handle.refs['count'] + 1
+    entry = _ATTACHED[handle.segment]
+    entry[1] += 1
+
+    values = np.ndarray(handle.shape, dtype=np.dtype(handle.dtype),
+                        buffer=entry[0].buf)
+    values.flags.writeable = False
+    return xr.DataArray(values, coords=handle.coords, dims=handle.dims,
+                        attrs=handle.attrs, name=handle.name)
+
+
+def detach(handle: SharedHandle) -> None:
+    """Release an attachment obtained with :func:`attach`
+
+    The segment is unmapped from the current process when it is detached
+    as many times as it was attached and no array obtained from it is
+    alive anymore, otherwise it stays mapped until the process exits.
+
+    Parameters
+    ----------
+    handle : SharedHandle
+      the handle given to :func:`attach`
+    """
+    entry = _ATTACHED.get(handle.segment)
+    if entry is None:
+        raise ValueError('shared variable {} is not attached in this '
+                         'process'.format(handle.name))
+    with handle.lock:
+        handle.refs['count'] = handle.refs['count'] - 1
+    entry[1] -= 1
+    if entry[1] == 0:
+        try:
+            entry[0].close()
+        except BufferError:
+            # arrays are still referenced, keep the mapping for them
+            return
+        del _ATTACHED[handle.segment]
@@ -0,0 +1,222 @@
+# CeCILL-B license LIDYL, CEA
+
+import os
+import json
+
+import numpy as np
+from numpy.testing import assert_array_equal
+import xarray as xr
+import pytest
+
+from phicore.io import PhiDataFile
+from phicore.archive import repack, verify, convert
+from phicore.cli import main
+
+
+@pytest.fixture
+def archive_files(tmpdir):
+    rng = np.random.RandomState(0)
+
+    paths = []
+    for idx in range(3):
+        X = xr.DataArray(np.round(rng.rand(40, 30, 20), 2),
+                         dims=['x', 'y', 't'],
+                         coords={'x': np.arange(40), 'y': np.arange(30),
+                                 't': np.linspace(0, 1, 20)},
+                         attrs={'scale_units': {'x': 'mm', 'y': 'mm',
+                                                't': 'fs'},
+                                'comments': 'shot {}'.format(idx)},
+                         name='I')
+        path = str(tmpdir / 'shot_{}.h5'.format(idx))
+        fh = PhiDataFile(path, 'w')
+        fh.write_xarray(X)
+        fh.write_attrs({'operator': 'LIDYL'})
+        fh.create_dataset('/diag/reference', data=X.values[..., 0],
+                          backend='h5py')
+        with fh.open('a') as h5:
+            h5['/diag/label'] = 'a variable length string'
+            h5['/diag/reference_link'] = h5['/diag/reference']
+        paths.append(path)
+    return paths
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_repack(archive_files, n_jobs):
+    X_ref = [PhiDataFile(path).read_xarray('/data/I')
+             for path in archive_files]
+    attrs_ref = [PhiDataFile(path).get_attrs() for path in archive_files]
+
+    report = repack(archive_files, complevel=9, n_jobs=n_jobs)
+
+    assert [item['path'] for item in report] == archive_files
+    for item, X, attrs in zip(report, X_ref, attrs_ref):
+        assert 'error' not in item
+        assert item['size_after'] == os.path.getsize(item['path'])
+        assert item['saved'] == item['size_before'] - item['size_after']
+        assert item['saved'] > 0
+
+        fh = PhiDataFile(item['path'])
+        # the default compression can be read with the default backend
+        xr.testing.assert_identical(fh.read_xarray('/data/I'), X)
+        assert fh.get_attrs() == attrs
+        with fh.open('r', backend='pytables') as h5:
+            filters = h5.root.data.I.filters
+            assert filters.complevel == 9
+            assert filters.fletcher32
+            assert_array_equal(h5.root.diag.reference[:], X.values[..., 0])
+        with fh.open('r') as h5:
+            assert h5['/diag/label'][()] == b'a variable length string'
+            assert h5['/diag/reference'] == h5['/diag/reference_link']
+    # no temporary file is left behind
+    assert len(os.listdir(os.path.dirname(archive_files[0]))) == 3
+
+
+def test_repack_failure_keeps_original(tmpdir):
+    path = str(tmpdir / 'not_hdf5.h5')
+    with open(path, 'w') as fh:
+        fh.write('not an hdf5 file')
+
+    report = repack(path)
+
+    assert 'error' in report[0]
+    with open(path) as fh:
+        assert fh.read() == 'not an hdf5 file'
+    assert os.listdir(str(tmpdir)) == ['not_hdf5.h5']
+
+
+def test_repack_complib(archive_files):
+    X = PhiDataFile(archive_files[0]).read_xarray('/data/I')
+
+    with pytest.warns(UserWarning, match="cannot be read by h5py"):
+        report = repack(archive_files[0], complib='blosc:lz4')
+    assert 'error' not in report[0]
+    fh = PhiDataFile(archive_files[0])
+    xr.testing.assert_identical(fh.read_xarray('/data/I',
+                                               backend='pytables'), X)
+
+
+def test_cli_repack(archive_files, capsys):
+    assert main(['repack', '--complevel', '3', '--chunks', '10,10,20']
+                + archive_files) == 0
+    out = capsys.readouterr().out
+    assert 'Total space saved' in out
+
+    with PhiDataFile(archive_files[0]).open('r', backend='pytables') as h5:
+        assert h5.root.data.I.chunkshape == (10, 10, 20)
+        assert h5.root.data.I.filters.complevel == 3
+
+    with pytest.raises(SystemExit):
+        main(['repack', '--chunks', 'a,b'] + archive_files)
+
+
+def _corrupt_chunk(path, location, chunk_index=0):
+    with PhiDataFile(path).open('r') as h5:
+        offset = h5[location].id.get_chunk_info(chunk_index).byte_offset
+    with open(path, 'r+b') as fh:
+        fh.seek(offset + 10)
+        byte = fh.read(1)
+        fh.seek(offset + 10)
+        fh.write(bytes([byte[0] ^ 0xff]))
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_verify(archive_files, n_jobs):
+    report = verify(archive_files, n_jobs=n_jobs, working_memory=0.01)
+
+    assert [item['path'] for item in report] == archive_files
+    for item in report:
+        assert item['ok'], item['errors']
+        assert item['errors'] == []
+        # I, its 3 scales, the reference image and label
+        assert item['n_datasets'] == 6
+        assert item['n_bytes'] > 40 * 30 * 20 * 8
+    json.dumps(report)
+
+
+def test_verify_detects_errors(archive_files):
+    _corrupt_chunk(archive_files[0], '/data/I')
+
+    with PhiDataFile(archive_files[1]).open('a') as h5:
+        del h5['/scales/I_t'].attrs['unit']
+        del h5['/scales/I_y']
+        h5['/data/J'] = np.zeros(3)
+        del h5.attrs['rev_fileformat']
+
+    report = verify(archive_files)
+
+    assert not report[0]['ok']
+    assert [err['location'] for err in report[0]['errors']] == ['/data/I']
+    assert 'checksum' in report[0]['errors'][0]['error']
+
+    assert not report[1]['ok']
+    errors = {(err['location'], err['error'])
+              for err in report[1]['errors']}
+    assert errors == {('/', 'missing rev_fileformat attribute'),
+                      ('/scales/I_t', 'scale has no unit attribute'),
+                      ('/data/I', 'missing scale /scales/I_y'),
+                      ('/data/J', 'data variable has no scales attribute')}
+
+    assert report[2]['ok']
+
+
+def test_cli_verify(archive_files, tmpdir, capsys):
+    assert main(['verify'] + archive_files) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert [item['ok'] for item in report] == [True] * 3
+
+    _corrupt_chunk(archive_files[0], '/data/I')
+    output = str(tmpdir / 'report.json')
+    assert main(['verify', '-o', output, '-j', '2'] + archive_files) == 1
+    with open(output) as fh:
+        report = json.load(fh)
+    assert [item['ok'] for item in report] == [False, True, True]
+
+
+def test_convert(archive_files, tmpdir):
+    src = PhiDataFile(archive_files[0])
+    X_ref = src.read_xarray('/data/I')
+
+    store = convert(archive_files[0], str(tmpdir / 'shot_0.phi'))
+    assert store.store == 'directory'
+    xr.testing.assert_identical(store.read_xarray('/data/I'), X_ref)
+    assert store.get_attrs()['operator'] == 'LIDYL'
+    with store.open('r') as h5:
+        assert_array_equal(h5['/diag/reference_link'][()],
+                           X_ref.values[..., 0])
+        assert h5['/diag/label'][()] == b'a variable length string'
+    assert store.verify()['ok']
+
+    # back to HDF5, with compression
+    fh = convert(store.fullpath, str(tmpdir / 'copy.h5'), complevel=5)
+    assert fh.store == 'hdf5'
+    xr.testing.assert_identical(fh.read_xarray('/data/I'), X_ref)
+    with fh.open('r', backend='pytables') as h5:
+        assert h5.root.data.I.filters.complevel == 5
+    assert fh.verify()['ok']
+
+    with pytest.raises(IOError, match='already exists'):
+        convert(archive_files[0], store.fullpath)
+    with pytest.raises(ValueError, match='only supports the zlib'):
+        convert(archive_files[0], str(tmpdir / 'blosc.phi'),
+                complib='blosc:lz4', complevel=5)
+
+
+def test_convert_shots(tmpdir):
+    X = xr.DataArray(np.arange(12.).reshape(3, 4), dims=['x', 't'],
+                     coords={'x': np.arange(3), 't': np.arange(4)},
+                     attrs={'scale_units': {'x': 'mm', 't': 'fs'}},
+                     name='I')
+    fh = PhiDataFile(str(tmpdir / 'shots.h5'), 'w')
+    for idx in range(4):
+        fh.append_shot([X * idx], attrs={'energy': 0.1 * idx})
+
+    store = convert(fh.fullpath, str(tmpdir / 'shots.phi'))
+    xr.testing.assert_identical(store.read_shot(2, 'I'),
+                                fh.read_shot(2, 'I'))
+
+    fh = convert(store.fullpath, str(tmpdir / 'copy.h5'))
+    assert_array_equal(fh.query_shots('energy > 0.15')['shot_id'], [2, 3])
+    with fh.open('r', backend='pytables') as h5:
+        assert h5.root.diag.shots.will_query_use_indexing('energy > 0.15')
+    assert main(['convert', '-f', fh.fullpath, store.fullpath]) == 0
+    assert PhiDataFile(store.fullpath).store == 'directory'
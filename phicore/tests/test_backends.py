@@ -0,0 +1,202 @@
+# CeCILL-B license LIDYL, CEA
+
+import os
+import multiprocessing
+
+import numpy as np
+from numpy.testing import assert_array_equal
+import xarray as xr
+import pytest
+
+from phicore.io import PhiDataFile
+from phicore.backends import Backend, get_backend, register_backend
+
+
+@pytest.fixture
+def new_xarray():
+    rng = np.random.RandomState(42)
+    return xr.DataArray(rng.rand(40, 30, 20),
+                        coords={'x': np.arange(40), 'y': np.arange(30),
+                                't': np.linspace(0, 1, 20)},
+                        dims=['x', 'y', 't'],
+                        attrs={'name': 'I',
+                               'scale_units': {'x': 'mm', 'y': 'mm',
+                                               't': 'fs'},
+                               'comments': 'üy', 'gain': np.float32(2.5),
+                               'roi': np.array([1, 2, 3])},
+                        name='I')
+
+
+def test_get_backend():
+    assert get_backend('pytables').name == 'pytables'
+    # the default backends of the methods work with all stores
+    assert get_backend('pytables', 'directory').name == 'directory'
+    assert get_backend('directory', 'hdf5').name == 'h5py'
+    with pytest.raises(ValueError, match='unknown backend'):
+        get_backend('zarr')
+    with pytest.raises(ValueError, match='unknown store'):
+        get_backend('h5py', 'zarr')
+
+
+def test_register_backend(tmpdir, new_xarray):
+    calls = []
+
+    class LoggingBackend(type(get_backend('h5py'))):
+        name = 'logging'
+
+        def create_dataset(self, fh, name, data=None, **args):
+            calls.append(name)
+            return super(LoggingBackend, self).create_dataset(
+                fh, name, data, **args)
+
+    assert issubclass(LoggingBackend, Backend)
+    register_backend(LoggingBackend())
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    fh.write_xarray(new_xarray, backend='logging')
+    assert calls == ['/data/I']
+    xr.testing.assert_identical(fh.read_xarray('/data/I', backend='logging'),
+                                new_xarray)
+
+
+def test_missing_sources(tmpdir, monkeypatch, new_xarray):
+    from phicore.backends import hdf5
+
+    # PyTables reads only reopen the file with h5py for virtual datasets
+    opened = []
+    open_h5py = hdf5._open_h5py
+
+    def _open_h5py(tb_file):
+        opened.append(tb_file.filename)
+        return open_h5py(tb_file)
+
+    monkeypatch.setattr(hdf5, '_open_h5py', _open_h5py)
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    fh.write_xarray(new_xarray, complevel=3)
+    fh.write_xarray(new_xarray.rename('J'), backend='h5py')
+    for name in ('I', 'J'):
+        fh.read_xarray('/data/' + name, backend='pytables')
+    assert opened == []
+    with fh.open('r', backend='pytables') as h5:
+        node = get_backend('pytables').get_node(h5, '/data/I')
+        assert get_backend('pytables').missing_sources(
+            node, fh.fullpath) == []
+    assert get_backend('directory').missing_sources(None, fh.fullpath) == []
+
+
+@pytest.mark.parametrize('backend', ['pytables', 'h5py'])
+def test_directory_store(tmpdir, new_xarray, backend):
+    path = str(tmpdir / 'test.phi')
+    fh = PhiDataFile(path, 'w', store='directory')
+    assert fh.store == 'directory'
+    fh.write_xarray(new_xarray, backend=backend, chunks=(10, 30, 20),
+                    complib='zlib', complevel=3, stats=True)
+    Z = (new_xarray * np.exp(1j * new_xarray)).rename('Z')
+    fh.write_xarray(Z, complex_storage='amp-phase')
+    fh.write_attrs({'operator': 'LIDYL'})
+
+    # existing stores are detected
+    fh = PhiDataFile(path)
+    assert fh.store == 'directory'
+    assert fh.list_xarray() == ['/data/I', '/data/Z']
+    assert fh.get_attrs()['operator'] == 'LIDYL'
+    xr.testing.assert_identical(fh.read_xarray('/data/I', backend=backend),
+                                new_xarray)
+    xr.testing.assert_allclose(fh.read_xarray('/data/Z'), Z)
+    xr.testing.assert_identical(
+        fh.read_xarray('/data/I', index=(3, slice(2, 29, 4)),
+                       backend=backend),
+        new_xarray[3, 2:29:4])
+    assert fh.get_stats('/data/I')['max'] == new_xarray.values.max()
+    assert fh.verify()['ok']
+    # one file per chunk
+    assert sorted(name for name in os.listdir(os.path.join(path, 'data', 'I'))
+                  if not name.startswith('.')) == ['0.0.0', '1.0.0',
+                                                   '2.0.0', '3.0.0']
+
+    fh = PhiDataFile(path, 'a')
+    fh.write_region('/data/I', 0.5, index=(slice(5, 15), 3), backend=backend)
+    X = new_xarray.copy()
+    X[5:15, 3] = 0.5
+    xr.testing.assert_identical(fh.read_xarray('/data/I'), X)
+    assert fh.get_stats('/data/I')['stale']
+    xr.testing.assert_allclose(fh.reduce('/data/I', 'mean', dim='t'),
+                               X.mean('t').assign_attrs(X.attrs))
+
+    with pytest.raises(ValueError, match='only supports the zlib'):
+        fh.write_xarray(new_xarray.rename('J'), complevel=5)
+    with pytest.raises(ValueError, match='only supported for HDF5'):
+        fh.query_shots()
+    with pytest.raises(ValueError, match='only supported for HDF5'):
+        PhiDataFile(str(tmpdir / 'other.phi'), 'w', store='directory',
+                    in_memory=True)
+    with fh.open('r') as store, pytest.raises(IOError, match='read-only'):
+        store.attrs['operator'] = 'modified'
+
+
+def test_directory_store_checksums(tmpdir, new_xarray):
+    path = str(tmpdir / 'test.phi')
+    fh = PhiDataFile(path, 'w', store='directory')
+    fh.write_xarray(new_xarray, chunks=(10, 30, 20))
+
+    chunk_path = os.path.join(path, 'data', 'I', '1.0.0')
+    with open(chunk_path, 'r+b') as fd:
+        fd.seek(100)
+        byte = fd.read(1)
+        fd.seek(100)
+        fd.write(bytes([byte[0] ^ 0xff]))
+
+    with pytest.raises(IOError, match='checksum mismatch'):
+        fh.read_xarray('/data/I')
+    # chunks that do not intersect the region are not read
+    fh.read_xarray('/data/I', index=(slice(0, 10),))
+    report = fh.verify()
+    assert not report['ok']
+    assert report['errors'][0]['location'] == '/data/I'
+
+
+def _write_rows(args):
+    path, start, values = args
+    PhiDataFile(path, 'a').write_region('/data/I', values,
+                                        index=(slice(start, start + 10),))
+    return os.getpid()
+
+
+def test_directory_store_parallel_writes(tmpdir, new_xarray):
+    path = str(tmpdir / 'test.phi')
+    fh = PhiDataFile(path, 'w', store='directory')
+    fh.write_xarray(xr.zeros_like(new_xarray), chunks=(10, 15, 20))
+
+    tasks = [(path, start, new_xarray.values[start:start + 10])
+             for start in range(0, 40, 10)]
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(4) as pool:
+        pool.map(_write_rows, tasks)
+    assert_array_equal(fh.read_xarray('/data/I').values, new_xarray.values)
+
+
+def test_directory_array_indexing(tmpdir):
+    fh = PhiDataFile(str(tmpdir / 'test.phi'), 'w', store='directory')
+    values = np.arange(7 * 9 * 5).reshape(7, 9, 5)
+    with fh.open('a') as store:
+        node = store.create_dataset('/diag/values', data=values,
+                                    chunks=(3, 4, 2))
+        for index in [(), (2,), (-1, slice(1, 8, 3)), (Ellipsis, 4),
+                      (slice(None, None, 4), 5, slice(1, None, 2)),
+                      (slice(3, 3),), (1, 2, 3)]:
+            assert_array_equal(node[index], values[index])
+
+        values[1:6:2, ::3] = -1
+        node[1:6:2, ::3] = -1
+        assert_array_equal(node[()], values)
+
+        empty = store.create_dataset('/diag/empty', shape=(4, 5),
+                                     dtype='int16')
+        assert_array_equal(empty[()], np.zeros((4, 5)))
+        with pytest.raises(IndexError, match='positive slice steps'):
+            node[::-1]
+        with pytest.raises(TypeError, match='must be int or slice'):
+            node[[0, 1]]
+        with pytest.raises(ValueError, match='already exists'):
+            store.create_group('/diag/values')
+        assert store.keys() == ['data', 'diag', 'scales']
+        assert store['diag'].keys() == ['empty', 'values']
@@ -100,6 +100,7 @@ def test_io_xarray_preserves_attrs(tmpdir_factory, new_xarray, backend):
     X = new_xarray
     X.attrs['a'] = 'test'
     X.attrs['c'] = np.array('üy')
+    X.attrs['d'] = np.bool_(True)
     file_inst = PhiDataFile(str(tmp_dir / file_name), "w")
     file_inst.write_xarray(X, backend=backend)
 
@@ -173,3 +174,781 @@ def test_read_xarray_mmap(tmpdir_factory, example_dataset, backend):
         assert_array_equal(X_m.coords[key], X.coords[key])
 
     fh._fh.close()
+
+
+@pytest.mark.parametrize('backend', ['pytables', 'h5py'])
+def test_write_region(example_dataset, new_xarray, backend):
+    fh = PhiDataFile(example_dataset, 'r+')
+    X = new_xarray.copy()
+
+    # integer / slice index, with broadcasting of a scalar
+    fh.write_region('/data/test_data', 0.5, index=(3, slice(10, 20)),
+                    backend=backend)
+    X[3, 10:20] = 0.5
+
+    # label based selection with dtype casting from int
+    fh.write_region('/data/test_data', np.arange(120),
+                    sel={'x': X.x.values[7], 'y': slice(0.2, 0.25)},
+                    backend=backend)
+    X.loc[{'x': X.x.values[7], 'y': slice(0.2, 0.25)}] = np.arange(120)
+
+    # region located from the coordinates of a DataArray
+    X_sub = X[10:20, ::2, 5] * 2
+    fh.write_region('/data/test_data', X_sub, backend=backend)
+    X[10:20, ::2, 5] = X_sub
+
+    xr.testing.assert_identical(fh.read_xarray('/data/test_data'), X)
+
+
+def test_write_region_validation(example_dataset, new_xarray):
+    fh = PhiDataFile(example_dataset, 'r+')
+
+    with pytest.raises(ValueError, match='cannot be used together'):
+        fh.write_region('/data/test_data', 0, index=(0,), sel={'x': 0})
+    with pytest.raises(ValueError, match='not found in'):
+        fh.write_region('/data/test_data', 0, sel={'z': 0})
+    with pytest.raises(KeyError, match='not found in the x scale'):
+        fh.write_region('/data/test_data', 0, sel={'x': 12.3})
+    with pytest.raises(ValueError, match='cannot be broadcast'):
+        fh.write_region('/data/test_data', np.zeros(3), index=(0, 0))
+    with pytest.raises(TypeError, match='Cannot cast'):
+        fh.write_region('/data/test_data', 1j, index=(0, 0))
+
+    X_sub = new_xarray[:2, :2, :2].assign_coords(x=[-1., -2.])
+    with pytest.raises(ValueError, match='do not match the stored scale'):
+        fh.write_region('/data/test_data', X_sub, index=(slice(0, 2),) * 3)
+
+    # the stored data was left untouched
+    xr.testing.assert_identical(fh.read_xarray('/data/test_data'),
+                                new_xarray)
+
+
+@pytest.mark.parametrize('backend', ['pytables', 'h5py'])
+def test_read_xarray_index(example_dataset, new_xarray, backend):
+    fh = PhiDataFile(example_dataset)
+
+    X = fh.read_xarray('/data/test_data', index=(3, slice(2, 10, 2)),
+                       backend=backend)
+    xr.testing.assert_identical(X, new_xarray[3, 2:10:2])
+
+
+@pytest.mark.parametrize('backend', ['pytables', 'h5py'])
+def test_in_memory(tmpdir, new_xarray, backend):
+    path = str(tmpdir / 'test.h5')
+
+    with PhiDataFile(path, 'w', in_memory=True) as fh:
+        fh.write_xarray(new_xarray, backend=backend)
+        fh.write_attrs({'operator': 'test'})
+        fh.create_group('run', location='/diag')
+        # nothing is written before close
+        assert not os.path.exists(path)
+        xr.testing.assert_identical(fh.read_xarray('/data/test_data',
+                                                   backend=backend),
+                                    new_xarray)
+        assert fh.verify()['ok']
+
+    fh = PhiDataFile(path, 'r')
+    xr.testing.assert_identical(fh.read_xarray('/data/test_data',
+                                               backend=backend), new_xarray)
+    assert fh.get_attrs()['operator'] == 'test'
+
+    # parse and modify a file received as bytes, without touching the disk
+    buf = fh.to_bytes()
+    fh = PhiDataFile.from_bytes(buf, mode='a')
+    fh.write_xarray(new_xarray.rename('copy'), backend=backend)
+    fh.close()
+    assert fh.list_xarray() == ['/data/copy', '/data/test_data']
+    with open(path, 'rb') as fd:
+        assert fd.read() == buf
+
+    fh = PhiDataFile(path, 'a', in_memory=True)
+    fh.write_attrs({'operator': 'modified'})
+    fh.close()
+    assert PhiDataFile(path).get_attrs()['operator'] == 'modified'
+
+    with pytest.raises(ValueError, match="mode must be"):
+        PhiDataFile.from_bytes(buf, mode='w')
+
+
+def test_in_memory_write_cost(tmpdir, monkeypatch, new_xarray):
+    import tables as tb
+
+    # PyTables only copies the image of the new variables, so that the
+    # cost of a write does not grow with the number of previous writes
+    image_sizes = []
+    get_file_image = tb.File.get_file_image
+
+    def _get_file_image(self):
+        image = get_file_image(self)
+        image_sizes.append(len(image))
+        return image
+
+    monkeypatch.setattr(tb.File, 'get_file_image', _get_file_image)
+    X = new_xarray[:, :, :10]
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w', in_memory=True)
+    for idx in range(20):
+        fh.write_xarray(X.rename('I{}'.format(idx)), backend='pytables',
+                        complib='blosc:lz4', complevel=1)
+    assert len(image_sizes) == 20
+    assert max(image_sizes) < 2 * X.nbytes
+    assert len(fh.to_bytes()) > 10 * X.nbytes
+    xr.testing.assert_identical(
+        fh.read_xarray('/data/I19', backend='pytables'),
+        X.rename('I19').assign_attrs(name='I19'))
+    assert fh.verify()['ok']
+
+
+@pytest.mark.parametrize('backend', ['pytables', 'h5py'])
+def test_write_dataset(tmpdir, new_xarray, backend):
+    X = new_xarray
+    ds = xr.Dataset({'I': X, 'A': np.sqrt(X),
+                     'spectrum': X[0, 0].rename({'f': 'w'})
+                     .assign_coords(w=X.f.values * 2)})
+    for name in ds.data_vars:
+        ds[name].attrs = {'scale_units': {'x': 'mm', 'y': 'mm', 'f': 'PHz',
+                                          'w': 'PHz'},
+                          'comments': name}
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    fh.write_dataset(ds, backend=backend, stats=True)
+
+    assert fh.list_xarray() == ['/data/A', '/data/I', '/data/spectrum']
+    for name in ds.data_vars:
+        X_2 = fh.read_xarray('/data/' + name, backend=backend)
+        xr.testing.assert_identical(X_2.drop_attrs(),
+                                    ds[name].drop_attrs())
+        assert X_2.attrs['comments'] == name
+        assert fh.get_stats('/data/' + name)['count'] == ds[name].size
+    with fh.open('r') as h5:
+        # shared scales are written once
+        assert h5['/scales/I_x'] == h5['/scales/A_x']
+        assert h5['/scales/I_f'] == h5['/scales/A_f']
+        assert h5['/scales/I_f'] != h5['/scales/spectrum_w']
+    assert fh.verify()['ok']
+
+    # variables are validated before writing anything
+    Y = X.copy().rename('Y')
+    Y.attrs = {'scale_units': {'x': 'mm'}}
+    with pytest.raises(ValueError, match=r"no unit for the coordinates"):
+        fh.write_dataset([X.rename('Z'), Y])
+    with pytest.raises(ValueError, match='/data/I already exists'):
+        fh.write_dataset([X.rename('Z'), X.rename('I')])
+    with pytest.raises(ValueError, match='several variables'):
+        fh.write_dataset([X.rename('Z'), X.rename('Z')])
+    # and removed if writing one of them fails
+    with pytest.raises(ValueError, match='requires complex data'):
+        fh.write_dataset([(X * 1j).rename('Z'), X.rename('Y')],
+                         backend=backend, complex_storage='amp-phase')
+    assert fh.list_xarray() == ['/data/A', '/data/I', '/data/spectrum']
+    with fh.open('r') as h5:
+        assert 'Z_x' not in h5['scales']
+    assert fh.verify()['ok']
+
+
+def test_shots(tmpdir):
+    from phicore.archive import repack
+
+    X = xr.DataArray(np.random.RandomState(0).rand(8, 6), dims=['x', 't'],
+                     coords={'x': np.arange(8), 't': np.arange(6)},
+                     attrs={'scale_units': {'x': 'mm', 't': 'fs'}},
+                     name='I')
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    for idx in range(10):
+        shot_id = fh.append_shot(
+            [X * idx, X.isel(t=0).rename('ref')], timestamp=1000. + idx,
+            attrs={'energy': 0.1 * idx, 'valid': idx % 2 == 0},
+            complib='zlib', complevel=5)
+        assert shot_id == idx
+
+    condition = '(energy > 0.45) & valid'
+    shots = fh.query_shots(condition)
+    assert_array_equal(shots['shot_id'], [6, 8])
+    assert_array_equal(shots['timestamp'], [1006., 1008.])
+    assert fh.query_shots().shape == (10,)
+    with fh.open('r', backend='pytables') as h5:
+        assert h5.root.diag.shots.will_query_use_indexing(condition) == \
+            frozenset(['energy', 'valid'])
+
+    xr.testing.assert_allclose(fh.read_shot(6, 'I').drop_attrs(),
+                               (X * 6).drop_attrs())
+    X_ref = fh.read_shot(6, 'ref', backend='pytables')
+    assert X_ref.attrs['scale_units'] == {'x': 'mm'}
+    assert fh.list_xarray('/data/shots/shot_6') == ['/data/shots/shot_6/I',
+                                                    '/data/shots/shot_6/ref']
+    assert fh.get_attrs('/data/shots/shot_6')['energy'] == pytest.approx(0.6)
+    # shots are not variables of /data and have their own scales
+    assert fh.list_xarray() == []
+    with fh.open('r') as h5:
+        assert '/scales/shots/shot_6/I_x' in h5
+    assert fh.verify()['ok']
+
+    with pytest.raises(ValueError, match='shot 3 already exists'):
+        fh.append_shot([X], shot_id=3, attrs={'energy': 1., 'valid': True})
+    with pytest.raises(ValueError, match='shot attributes must be'):
+        fh.append_shot([X], attrs={'energy': 1.})
+    with pytest.raises(ValueError, match='numeric or boolean scalar'):
+        fh.append_shot([X], attrs={'energy': 'high', 'valid': True})
+    # a failed append leaves no trace
+    with pytest.raises(ValueError, match='requires complex data'):
+        fh.append_shot([X], attrs={'energy': 1., 'valid': True},
+                       complex_storage='amp-phase')
+    assert fh.query_shots().shape == (10,)
+    with fh.open('r') as h5:
+        assert 'shot_10' not in h5['/data/shots']
+
+    # indexes are rebuilt when repacking
+    assert 'error' not in repack(fh.fullpath)[0]
+    assert_array_equal(fh.query_shots(condition)['shot_id'], [6, 8])
+    with fh.open('r', backend='pytables') as h5:
+        assert h5.root.diag.shots.indexed
+    fh.append_shot([X], attrs={'energy': 2., 'valid': True})
+    assert_array_equal(fh.query_shots(condition)['shot_id'], [6, 8, 10])
+
+
+def test_read_fileformat_2(tmpdir, new_xarray):
+    import h5py
+
+    # layout of files written before revision 3, where variables of
+    # sub-groups of /data have their scales directly in /scales
+    path = str(tmpdir / 'test.h5')
+    with h5py.File(path, 'w') as h5:
+        h5.attrs['rev_fileformat'] = 2
+        h5.create_group('/diag')
+        node = h5.create_dataset('/data/sub/test_data',
+                                 data=new_xarray.values, fletcher32=True)
+        node.attrs['name'] = 'test_data'
+        node.attrs['scales'] = [b'x', b'y', b'f']
+        for dim in new_xarray.dims:
+            scale = h5.create_dataset('/scales/test_data_' + dim,
+                                      data=new_xarray[dim].values)
+            scale.attrs['unit'] = b'px'
+
+    fh = PhiDataFile(path, 'a')
+    xr.testing.assert_identical(fh.read_xarray('/data/sub/test_data'),
+                                new_xarray)
+    assert fh.verify()['ok']
+    fh.write_region('/data/sub/test_data', 0., index=(0,))
+    assert (fh.read_xarray('/data/sub/test_data')[0] == 0).all()
+
+
+def test_write_xarray_stats(tmpdir, new_xarray):
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    X = new_xarray
+    X[0, 0, 0] = np.nan
+    fh.write_xarray(X, stats=True)
+
+    with pytest.raises(KeyError, match='No statistics stored'):
+        fh.get_stats('/data/other')
+
+    stats = fh.get_stats('/data/test_data')
+    values = X.values[np.isfinite(X.values)]
+    assert stats['min'] == values.min()
+    assert stats['max'] == values.max()
+    assert stats['mean'] == pytest.approx(values.mean())
+    assert stats['std'] == pytest.approx(values.std())
+    assert stats['count'] == X.size - 1
+    assert stats['percentiles'][50] == pytest.approx(np.median(values))
+    assert stats['histogram'].sum() == X.size - 1
+    assert_array_equal(stats['bin_edges'][[0, -1]],
+                       [values.min(), values.max()])
+    assert stats['slice_dim'] == 'f'
+    assert_array_equal(stats['slice_max'], np.nanmax(X.values, axis=(0, 1)))
+    assert stats['slice_mean'] == pytest.approx(np.nanmean(X.values,
+                                                           axis=(0, 1)))
+    assert not stats['stale']
+
+    fh.write_region('/data/test_data', 0, index=(0,))
+    assert fh.get_stats('/data/test_data')['stale']
+
+
+def test_write_xarray_stats_sub_groups(tmpdir, new_xarray):
+    import h5py
+
+    # variables with the same name in different groups (e.g. the shots of
+    # a series) have their own statistics
+    X = new_xarray[:10, :10]
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    fh.write_xarray(X, stats=True)
+    fh.append_shot([X * 2], shot_id=1, stats=True)
+    fh.append_shot([X * 3], shot_id=2, stats=True)
+    shot_1 = '/data/shots/shot_1/test_data'
+    assert fh.get_stats('/data/test_data')['max'] == X.values.max()
+    assert fh.get_stats(shot_1)['max'] == 2 * X.values.max()
+    with fh.open('r') as h5:
+        assert '/diag/stats/shots/shot_1/test_data' in h5
+
+    fh.write_region(shot_1, 0, index=(0,))
+    assert fh.get_stats(shot_1)['stale']
+    assert not fh.get_stats('/data/shots/shot_2/test_data')['stale']
+    assert not fh.get_stats('/data/test_data')['stale']
+
+    # statistics written by earlier versions under the variable name
+    with h5py.File(fh.fullpath, 'a') as h5:
+        del h5['/diag/stats/test_data']
+        h5.move('/diag/stats/shots/shot_1/test_data',
+                '/diag/stats/test_data')
+    assert fh.get_stats(shot_1)['stale']
+    with pytest.raises(KeyError, match='No statistics stored'):
+        fh.get_stats('/data/test_data')
+
+
+@pytest.mark.parametrize('backend', ['pytables', 'h5py'])
+def test_write_xarray_pyramid(tmpdir, new_xarray, backend):
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    X = (new_xarray * 1000).astype(np.int16).rename('X')
+    X.attrs = dict(new_xarray.attrs, name='X')
+    fh.write_xarray(X, pyramid_levels=8, backend=backend)
+
+    # the pyramid doesn't alter the variable
+    assert fh.list_xarray() == ['/data/X']
+    xr.testing.assert_identical(fh.read_xarray('/data/X'), X)
+
+    X_1 = fh.read_xarray('/data/X', level=1, backend=backend)
+    assert X_1.shape == (50, 55, 120)
+    assert X_1.dtype == np.int16
+    assert X_1.attrs['pyramid_factor'] == 2
+    assert_array_equal(X_1.values[0, 0],
+                       np.round(X.values[:2, :2].mean(axis=(0, 1))))
+    assert_array_equal(X_1.x, X.x.values.reshape(50, 2).mean(axis=1))
+    assert_array_equal(X_1.f, X.f)
+    assert X_1.attrs['stale'].dtype == np.bool_
+    assert not X_1.attrs['stale']
+    # rounding errors do not accumulate across levels
+    X_2 = fh.read_xarray('/data/X', level=2, backend=backend)
+    assert_array_equal(X_2.values,
+                       np.round(X.values[:, :108].reshape(25, 4, 27, 4, 120)
+                                .mean(axis=(1, 3))))
+
+    # levels stop once a spatial dimension has a size of 1
+    X_6 = fh.read_xarray('/data/X', level=6)
+    assert X_6.shape == (1, 1, 120)
+    with pytest.raises(ValueError, match='Level 7 of /data/X does not exist'):
+        fh.read_xarray('/data/X', level=7)
+
+    assert fh.read_preview('/data/X', max_pixels=10**6).shape == X.shape
+    X_p = fh.read_preview('/data/X', max_pixels=1000,
+                          index=(slice(None), slice(None), 0))
+    assert X_p.shape == (25, 27)
+    assert X_p.attrs['pyramid_level'] == 2
+    assert fh.read_preview('/data/X', max_pixels=0).shape == (1, 1, 120)
+
+    assert fh.verify()['ok']
+
+    # levels are flagged as stale once the variable is modified
+    fh.write_region('/data/X', 0, index=(0,), backend=backend)
+    assert fh.read_preview('/data/X', max_pixels=1000).attrs['stale']
+    assert fh.read_xarray('/data/X', level=6, backend=backend).attrs['stale']
+    with fh.open('r') as h5:
+        assert h5['/diag/pyramid/X_L1'].attrs['stale'].dtype == np.bool_
+
+    # levels of variables in sub-groups are stored in the same sub-groups
+    fh.write_xarray(X.rename('Y'), location='/data/sub', pyramid_levels=2,
+                    backend=backend)
+    with fh.open('r') as h5:
+        assert '/diag/pyramid/sub/Y_L2' in h5
+    assert fh.read_preview('/data/sub/Y', max_pixels=1000).shape == \
+        (25, 27, 120)
+    fh.write_region('/data/sub/Y', 0, index=(0,), backend=backend)
+    assert fh.read_xarray('/data/sub/Y', level=1).attrs['stale']
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('quantize, precision', [('absolute', 1e-3),
+                                                 ('absolute', 1e-6),
+                                                 ('relative', 1e-4)])
+def test_write_xarray_quantize(tmpdir, new_xarray, dtype, quantize,
+                               precision):
+    X = new_xarray.astype(dtype)
+    X.attrs = new_xarray.attrs
+    X[0, 0, :3] = [np.nan, np.inf, -np.inf]
+
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    fh.write_xarray(X, quantize=quantize, precision=precision,
+                    complevel=5)
+    fh_ref = PhiDataFile(str(tmpdir / 'ref.h5'), 'w')
+    fh_ref.write_xarray(X, complevel=5)
+
+    X_2 = fh.read_xarray('/data/test_data', backend='pytables')
+    assert X_2.dtype == dtype
+    assert X_2.attrs == X.attrs
+    assert_array_equal(X_2.values[0, 0, :3], [np.nan, np.inf, -np.inf])
+    finite = np.isfinite(X.values)
+    error = np.abs(X_2.values[finite] - X.values[finite])
+    if quantize == 'relative':
+        error /= np.abs(X.values[finite])
+    assert error.max() <= precision
+    assert error.max() > 0
+    assert (os.path.getsize(str(tmpdir / 'test.h5'))
+            < os.path.getsize(str(tmpdir / 'ref.h5')))
+
+    X_3 = fh.read_xarray('/data/test_data', index=(slice(1, 3), 5),
+                         backend='pytables')
+    assert_array_equal(X_3.values, X_2.values[1:3, 5])
+
+
+def test_write_xarray_quantize_errors(tmpdir, new_xarray):
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    with pytest.raises(ValueError, match='precision must be provided'):
+        fh.write_xarray(new_xarray, quantize='absolute')
+    with pytest.raises(ValueError, match='quantize must be one of'):
+        fh.write_xarray(new_xarray, quantize='log', precision=1)
+    X = new_xarray.astype(np.int32)
+    X.attrs = new_xarray.attrs
+    with pytest.raises(ValueError, match='requires floating point'):
+        fh.write_xarray(X, quantize='absolute', precision=1)
+
+    fh.write_xarray(new_xarray, quantize='absolute', precision=1e-3)
+    with pytest.raises(ValueError, match='cannot be updated in place'):
+        fh.write_region('/data/test_data', 0, index=(0,))
+    with pytest.raises(ValueError, match='not supported for variables'):
+        fh.read_xarray('/data/test_data', mmap=True)
+
+
+@pytest.fixture
+def complex_xarray(new_xarray):
+    rng = np.random.RandomState(0)
+    X = new_xarray * np.exp(1j * rng.uniform(-np.pi, np.pi,
+                                             new_xarray.shape))
+    X.attrs = dict(new_xarray.attrs, name='E')
+    return X.rename('E')
+
+
+@pytest.mark.parametrize('complex_storage', ['real-imag', 'amp-phase'])
+@pytest.mark.parametrize('backend', ['pytables', 'h5py'])
+def test_write_xarray_complex(tmpdir, complex_xarray, complex_storage,
+                              backend):
+    X = complex_xarray
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    fh.write_xarray(X, complex_storage=complex_storage, backend=backend)
+
+    assert fh.list_xarray() == ['/data/E']
+    X_h5py = fh.read_xarray('/data/E', backend='h5py')
+    X_tables = fh.read_xarray('/data/E', backend='pytables')
+    xr.testing.assert_identical(X_h5py, X_tables)
+    assert X_h5py.dtype == np.complex128
+    assert X_h5py.attrs == X.attrs
+    xr.testing.assert_allclose(X_h5py, X, rtol=1e-12)
+
+    X_sub = fh.read_xarray('/data/E', index=(slice(2, 4), 0))
+    xr.testing.assert_identical(X_sub, X_h5py[2:4, 0])
+
+    with fh.open('r') as h5:
+        planes = sorted(h5['/data/E'])
+        assert h5['/data/E/' + planes[0]].dtype == np.float64
+    assert fh.verify()['ok']
+
+    with pytest.raises(ValueError, match='cannot be updated in place'):
+        fh.write_region('/data/E', 0, index=(0,), backend=backend)
+
+
+def test_write_xarray_complex_options(tmpdir, complex_xarray):
+    X = complex_xarray
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    fh.write_xarray(X, complex_storage='amp-phase',
+                    complex_dtype='complex64', complevel=5,
+                    plane_options={'phase': {'quantize': 'absolute',
+                                             'precision': 1e-3},
+                                   'amplitude': {'complib': 'zlib'}})
+
+    X_2 = fh.read_xarray('/data/E', backend='pytables')
+    assert X_2.dtype == np.complex64
+    assert X_2.attrs == X.attrs
+    phase_error = np.angle(X_2.values / X.values)
+    assert np.abs(phase_error).max() <= 1e-3 + 1e-6
+    np.testing.assert_allclose(np.abs(X_2.values), np.abs(X.values),
+                               rtol=1e-6)
+
+    with fh.open('r', backend='pytables') as h5:
+        assert h5.root.data.E.amplitude.filters.complib == 'zlib'
+        assert h5.root.data.E.amplitude.dtype == np.float32
+        assert h5.root.data.E.phase.filters.complib == 'blosc:lz4'
+        assert h5.root.data.E.phase.dtype == np.uint16
+
+    with pytest.raises(ValueError, match='unknown planes'):
+        fh.write_xarray(X.rename('E2'), complex_storage='amp-phase',
+                        plane_options={'real': {'complevel': 1}})
+    with pytest.raises(ValueError, match='unknown plane options'):
+        fh.write_xarray(X.rename('E3'), complex_storage='amp-phase',
+                        plane_options={'phase': {'chunks': 1}})
+    with pytest.raises(ValueError, match="quantize must be one of"):
+        fh.write_xarray(X.rename('E3'), complex_storage='amp-phase',
+                        plane_options={'phase': {'quantize': 'lossy',
+                                                 'precision': 1e-3}})
+    # no partially written variable is left
+    with fh.open('r') as h5:
+        assert 'E3' not in h5['data']
+    with pytest.raises(ValueError, match='already exists'):
+        fh.write_xarray(X, complex_storage='amp-phase')
+    with pytest.raises(ValueError, match='requires complex data'):
+        fh.write_xarray(X.real.rename('E4'), complex_storage='amp-phase')
+
+
+@pytest.fixture
+def beam_xarray():
+    rng = np.random.RandomState(0)
+    x = np.arange(64.)
+    y = np.arange(48.)
+    t = np.arange(5.)
+    # a gaussian beam drifting along x on a noisy background
+    x0 = 20 + 3 * t[None, None, :]
+    beam = 1000 * np.exp(-((x[:, None, None] - x0) ** 2
+                           + (y[None, :, None] - 30) ** 2) / 8)
+    values = np.round(beam + 10 + rng.normal(0, 1, (64, 48, 5)))
+    return xr.DataArray(values.astype(np.int32), dims=['x', 'y', 't'],
+                        coords={'x': x, 'y': y, 't': t},
+                        attrs={'name': 'I',
+                               'scale_units': {'x': 'um', 'y': 'um',
+                                               't': 's'}},
+                        name='I')
+
+
+@pytest.mark.parametrize('roi', ['variable', 'frame'])
+@pytest.mark.parametrize('backend', ['pytables', 'h5py'])
+def test_write_xarray_roi(tmpdir, beam_xarray, roi, backend):
+    X = beam_xarray
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    fh.write_xarray(X, roi=roi, backend=backend)
+
+    with fh.open('r') as h5:
+        block = h5['/data/I/block']
+        assert block.dtype == np.int32
+        assert block.size < X.size / 4
+        assert h5['/data/I/offsets'].shape == (5, 2)
+        assert (h5['/data/I/background'][:] == 10).all()
+    assert fh.list_xarray() == ['/data/I']
+    assert fh.verify()['ok']
+
+    X_2 = fh.read_xarray('/data/I', backend=backend)
+    assert X_2.dtype == np.int32
+    assert X_2.attrs == X.attrs
+    xr.testing.assert_identical(X_2.coords.to_dataset(),
+                                X.coords.to_dataset())
+    # the beam is preserved, the background is replaced by its level
+    beam = X > 100
+    assert (X_2.values[beam] == X.values[beam]).all()
+    assert np.abs(X_2 - X).max() <= 6
+
+    X_sub = fh.read_xarray('/data/I', index=(slice(10, 40, 3), 30, 2))
+    xr.testing.assert_identical(X_sub, X_2[10:40:3, 30, 2])
+
+    X_roi = fh.read_xarray('/data/I', roi_only=True)
+    assert X_roi.size < X.size / 4
+    xr.testing.assert_identical(X_roi, X_2.sel(x=X_roi.x, y=X_roi.y))
+    assert beam.sel(x=X_roi.x, y=X_roi.y).sum() == beam.sum()
+
+    X_frame = fh.read_xarray('/data/I', index=(slice(None), 15, 0),
+                             roi_only=True)
+    assert X_frame.dims == ('x',)
+    xr.testing.assert_identical(X_frame, X_2[:, 15, 0].sel(x=X_frame.x))
+    if roi == 'frame':
+        assert X_frame.size < X_roi.sizes['x']
+
+
+def test_write_xarray_roi_explicit(tmpdir, beam_xarray):
+    X = beam_xarray.astype(np.float64)
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    fh.write_xarray(X, roi={'x': slice(10, 50)}, quantize='absolute',
+                    precision=0.1, complevel=5)
+
+    X_2 = fh.read_xarray('/data/I', backend='pytables', roi_only=True)
+    xr.testing.assert_allclose(X_2, X[10:50], atol=0.1, rtol=0)
+
+    J = X.rename('J')
+    J.attrs['name'] = 'J'
+    fh.write_xarray(J, roi={'y': [slice(25, 35)] * 4 + [slice(20, 26)]})
+    X_3 = fh.read_xarray('/data/J', index=(0, slice(None), 4),
+                         roi_only=True)
+    # the box of the last frame is enlarged to the common size
+    xr.testing.assert_identical(X_3, J[0, 18:28, 4])
+
+    with pytest.raises(ValueError, match='not spatial dimensions'):
+        fh.write_xarray(X.rename('K'), roi={'t': slice(0, 2)})
+    with pytest.raises(ValueError, match='one ROI slice per frame'):
+        fh.write_xarray(X.rename('K'), roi={'x': [slice(0, 2)] * 2})
+    with pytest.raises(ValueError, match='roi must be one of'):
+        fh.write_xarray(X.rename('K'), roi='auto')
+    fh.write_xarray(X.rename('L'))
+    with pytest.raises(ValueError, match='not stored with a region'):
+        fh.read_xarray('/data/L', roi_only=True)
+
+
+@pytest.mark.parametrize('dtype', [np.uint16, np.float32])
+@pytest.mark.parametrize('backend', ['pytables', 'h5py'])
+def test_write_xarray_delta(tmpdir, beam_xarray, dtype, backend):
+    X = beam_xarray.astype(dtype)
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    fh.write_xarray(X, delta_dim='t', keyframe_interval=2, backend=backend)
+
+    with fh.open('r') as h5:
+        assert h5['/data/I'].dtype.kind == 'u'
+    assert fh.verify()['ok']
+
+    X_2 = fh.read_xarray('/data/I', backend=backend)
+    xr.testing.assert_identical(X_2, X)
+    for index in [(slice(None), slice(None), 3), (2, slice(5, 40, 7)),
+                  (slice(10, 20), 4, slice(1, 5, 2))]:
+        xr.testing.assert_identical(fh.read_xarray('/data/I', index=index),
+                                    X[index])
+
+    with pytest.raises(ValueError, match='cannot be updated in place'):
+        fh.write_region('/data/I', 0, index=(0,))
+
+
+def test_write_xarray_delta_combined(tmpdir, beam_xarray, complex_xarray):
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    fh.write_xarray(beam_xarray, delta_dim='t', roi='frame', complevel=5)
+    fh.write_xarray(beam_xarray.rename('R'), roi='frame')
+    X_2 = fh.read_xarray('/data/I', backend='pytables', roi_only=True)
+    X_ref = fh.read_xarray('/data/R', roi_only=True)
+    with fh.open('r') as h5:
+        assert h5['/data/I/block'].attrs['encoding'] == 'delta'
+    np.testing.assert_array_equal(X_2.values, X_ref.values)
+
+    fh.write_xarray(complex_xarray, delta_dim='y',
+                    complex_storage='real-imag')
+    xr.testing.assert_identical(fh.read_xarray('/data/E', index=(1,)),
+                                complex_xarray[1])
+
+    with pytest.raises(ValueError, match='not a dimension'):
+        fh.write_xarray(beam_xarray.rename('J'), delta_dim='w')
+    with pytest.raises(ValueError, match='cannot be used together'):
+        fh.write_xarray(beam_xarray.rename('J').astype(np.float64),
+                        delta_dim='t', quantize='absolute', precision=0.1)
+
+
+@pytest.mark.parametrize('op', ['mean', 'sum', 'std', 'min', 'max'])
+@pytest.mark.parametrize('dim', [None, 't', 'x', ['x', 't'], ['y']])
+def test_reduce(tmpdir, beam_xarray, op, dim):
+    X = beam_xarray.astype(np.float64)
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    fh.write_xarray(X, chunks=(8, 8, 5))
+
+    # blocks of a few rows, or a few elements along y
+    for working_memory in [0.01, 0.001]:
+        X_red = fh.reduce('/data/I', op=op, dim=dim, n_jobs=2,
+                          working_memory=working_memory)
+        X_ref = getattr(X, op)(dim=dim)
+        xr.testing.assert_allclose(X_red, X_ref, rtol=1e-12)
+        assert X_red.name == 'I'
+        assert X_red.attrs['scale_units'] == {
+            key: val for key, val in X.attrs['scale_units'].items()
+            if key in X_ref.dims}
+
+
+def test_reduce_options(tmpdir, beam_xarray, complex_xarray):
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    X = beam_xarray
+    fh.write_xarray(X, delta_dim='t')
+
+    X_red = fh.reduce('/data/I', op=np.ptp, dim='t', working_memory=0.001,
+                      output='I_ptp', backend='pytables', n_jobs=None)
+    xr.testing.assert_identical(X_red, fh.read_xarray('/data/I_ptp'))
+    np.testing.assert_array_equal(X_red.values, np.ptp(X.values, axis=2))
+    assert fh.read_xarray('/data/I_ptp').attrs['scale_units'] == \
+        {'x': 'um', 'y': 'um'}
+
+    fh.write_xarray(complex_xarray, complex_storage='amp-phase')
+    X_std = fh.reduce('/data/E', op='std', dim='x', working_memory=0.5,
+                      n_jobs=4)
+    np.testing.assert_allclose(X_std.values,
+                               complex_xarray.std(dim='x').values)
+
+    with pytest.raises(ValueError, match='not found'):
+        fh.reduce('/data/I', dim='w')
+    with pytest.raises(ValueError, match='op must be one of'):
+        fh.reduce('/data/I', op='median')
+    with pytest.raises(ValueError, match='cannot be stored'):
+        fh.reduce('/data/I', output='I_mean')
+
+
+@pytest.mark.parametrize('op', [np.ptp, np.median])
+@pytest.mark.parametrize('dim', ['x', ['x', 't']])
+def test_reduce_callable(tmpdir, beam_xarray, op, dim):
+    # x is the outermost (blocked) axis for named reductions
+    X = beam_xarray
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    fh.write_xarray(X)
+
+    X_red = fh.reduce('/data/I', op=op, dim=dim, working_memory=0.01,
+                      n_jobs=2)
+    axes = X.get_axis_num(dim)
+    np.testing.assert_array_equal(X_red.values, op(X.values, axis=axes))
+
+
+@pytest.fixture
+def pulse_xarray():
+    # gaussian pulses delayed by t0 on a non centered time scale
+    t = np.linspace(-60, 80, 256)
+    t0 = np.array([-5., 0., 10.])
+    sigma = 4.
+    values = np.exp(-(t[None, None, :] - t0[None, :, None]) ** 2
+                    / (2 * sigma ** 2))
+    values = np.repeat(values, 4, axis=0)
+    return xr.DataArray(values, dims=['x', 'y', 't'],
+                        coords={'x': np.arange(4.), 'y': t0, 't': t},
+                        attrs={'name': 'E', 'comments': 'pulses',
+                               'scale_units': {'x': 'mm', 'y': 'mm',
+                                               't': 'fs'}},
+                        name='E')
+
+
+@pytest.mark.parametrize('to', ['w', 'f'])
+def test_transform(tmpdir, pulse_xarray, to):
+    X = pulse_xarray
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    fh.write_xarray(X)
+
+    location = fh.transform('/data/E', dim='t', to=to, n_jobs=2,
+                            working_memory=0.01)
+    assert location == '/data/E_' + to
+    X_w = fh.read_xarray(location)
+    assert X_w.dims == ('x', 'y', to)
+    assert X_w.dtype == np.complex128
+    assert X_w.attrs['comments'] == 'pulses'
+    assert X_w.attrs['scale_units'] == {
+        'x': 'mm', 'y': 'mm', to: {'w': 'PHz.rad', 'f': 'PHz'}[to]}
+    assert fh.verify()['ok']
+
+    # analytical transform of the gaussian pulses
+    w = X_w.coords[to].values
+    if to == 'f':
+        # E(f) = E(w = 2 pi f)
+        w = 2 * np.pi * w
+        assert X_w.coords['f'].values[128] == 0
+        np.testing.assert_allclose(np.diff(X_w.f), 1 / (140 / 255 * 256))
+    sigma = 4.
+    t0 = X.y.values
+    expected = (sigma * np.sqrt(2 * np.pi) * np.exp(-sigma ** 2 * w ** 2 / 2)
+                * np.exp(-1j * w[None, :] * t0[:, None]))
+    np.testing.assert_allclose(X_w.values[0], expected, atol=1e-10)
+    for idx in range(1, 4):
+        np.testing.assert_array_equal(X_w.values[idx], X_w.values[0])
+
+    # the inverse transform restores the original scale and data
+    location = fh.transform(location, dim=to, to='t', out='E_back',
+                            origin=X.t.values[0])
+    X_back = fh.read_xarray(location)
+    np.testing.assert_allclose(X_back.t, X.t)
+    np.testing.assert_allclose(X_back.values.real, X.values, atol=1e-10)
+    np.testing.assert_allclose(X_back.values.imag, 0, atol=1e-10)
+
+
+def test_transform_errors(tmpdir, pulse_xarray):
+    X = pulse_xarray
+    fh = PhiDataFile(str(tmpdir / 'test.h5'), 'w')
+    fh.write_xarray(X)
+    fh.write_xarray(X.isel(t=[0, 1, 3]).rename('J'))
+
+    location = fh.transform('/data/E', dim='x', to='kx', complevel=5)
+    X_k = fh.read_xarray(location, backend='pytables')
+    assert X_k.attrs['scale_units']['kx'] == '1/mm'
+    np.testing.assert_allclose(X_k.kx, 2 * np.pi * np.array([-2, -1, 0, 1])
+                               / 4)
+
+    with pytest.raises(ValueError, match='not a conjugate dimension'):
+        fh.transform('/data/E', dim='t', to='kx')
+    with pytest.raises(ValueError, match='not found'):
+        fh.transform('/data/E', dim='tau', to='w')
+    with pytest.raises(ValueError, match='already exists'):
+        fh.transform('/data/E', dim='x', to='kx')
+    with pytest.raises(ValueError, match='uniformly sampled'):
+        fh.transform('/data/J', dim='t', to='w')
@@ -0,0 +1,88 @@
+# CeCILL-B license LIDYL, CEA
+
+import multiprocessing
+
+import numpy as np
+import xarray as xr
+import pytest
+
+from phicore import PhiDataFile
+from phicore.shared import publish, attach, detach
+
+
+def _analyse(handle):
+    X = attach(handle)
+    try:
+        return (float(X.sum()), X.dims, X.attrs['comments'],
+                X.values.flags.writeable)
+    finally:
+        del X
+        detach(handle)
+
+
+@pytest.fixture
+def shared_file(tmpdir):
+    X = xr.DataArray(np.random.RandomState(0).rand(20, 30),
+                     dims=['x', 'y'],
+                     coords={'x': np.arange(20), 'y': np.arange(30) * 0.5},
+                     attrs={'scale_units': {'x': 'mm', 'y': 'fs'},
+                            'comments': 'shared'},
+                     name='I')
+    fh = PhiDataFile(str(tmpdir / 'shared.h5'), 'w')
+    fh.write_xarray(X)
+    return fh, X
+
+
+def test_shared_workers(shared_file):
+    fh, X_ref = shared_file
+
+    with publish(fh, '/data/I') as shared:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(2) as pool:
+            results = pool.map(_analyse, [shared.handle] * 4)
+        assert shared.n_attached == 0
+        for total, dims, comments, writeable in results:
+            np.testing.assert_allclose(total, X_ref.values.sum())
+            assert dims == ('x', 'y')
+            assert comments == 'shared'
+            assert not writeable
+        # workers exiting did not release the segment
+        X = attach(shared.handle)
+        xr.testing.assert_allclose(X, X_ref)
+        np.testing.assert_array_equal(X.y, X_ref.y)
+        assert X.attrs['scale_units'] == {'x': 'mm', 'y': 'fs'}
+        X2 = attach(shared.handle)
+        assert shared.n_attached == 2
+        assert np.shares_memory(X.values, X2.values)
+        with pytest.raises(IOError, match='still attached'):
+            shared.close(timeout=0.1)
+        del X, X2
+        detach(shared.handle)
+        detach(shared.handle)
+        assert shared.n_attached == 0
+
+    assert shared.closed
+    with pytest.raises(IOError, match='already released'):
+        attach(shared.handle)
+    with pytest.raises(ValueError, match='not attached'):
+        detach(shared.handle)
+
+
+def test_shared_options(shared_file):
+    fh, X_ref = shared_file
+
+    manager = multiprocessing.Manager()
+    try:
+        shared = publish(fh, '/data/I', manager=manager, index=(3,))
+        X = attach(shared.handle)
+        xr.testing.assert_allclose(X, X_ref[3])
+        del X
+        detach(shared.handle)
+        shared.close()
+        # the manager is not shut down with a variable
+        assert len(manager.dict()) == 0
+    finally:
+        manager.shutdown()
+
+    with pytest.raises(ValueError, match='not supported'):
+        publish(fh, '/data/I', chunks=(10, 10))
@@ -0,0 +1,141 @@
+# CeCILL-B license LIDYL, CEA
+
+import os
+
+import numpy as np
+import xarray as xr
+import pytest
+
+from phicore import PhiDataFile, build_virtual
+
+
+def _write_shots(directory, t_step):
+    rng = np.random.RandomState(0)
+
+    shots = []
+    paths = []
+    os.makedirs(directory)
+    for idx in range(3):
+        X = xr.DataArray(rng.rand(6, 5, 4),
+                         dims=['x', 'y', 't'],
+                         coords={'x': np.arange(6), 'y': np.arange(5),
+                                 't': np.arange(4) + t_step * idx},
+                         attrs={'scale_units': {'x': 'mm', 'y': 'mm',
+                                                't': 'fs'},
+                                'data_source': 'experiment',
+                                'shot': idx},
+                         name='I')
+        path = os.path.join(directory, 'shot_{}.h5'.format(idx))
+        PhiDataFile(path, 'w').write_xarray(X)
+        shots.append(X)
+        paths.append(path)
+    return paths, shots
+
+
+def test_build_virtual_stack(tmpdir):
+    paths, shots = _write_shots(str(tmpdir / 'shots'), t_step=0.)
+    output = str(tmpdir / 'campaign.h5')
+
+    fh = build_virtual(paths, '/data/I', 'shot', output,
+                       concat_unit='index')
+
+    X = fh.read_xarray('/data/I')
+    X_ref = xr.concat(shots, dim='shot')
+    assert X.dims == ('shot', 'x', 'y', 't')
+    np.testing.assert_array_equal(X.values, X_ref.values)
+    np.testing.assert_array_equal(X.t, X_ref.t)
+    np.testing.assert_array_equal(X.shot, [0, 1, 2])
+    assert X.attrs['scale_units']['shot'] == 'index'
+    # only attributes common to all shots are kept
+    assert X.attrs['data_source'] == 'experiment'
+    assert 'shot' not in X.attrs
+    assert fh.verify()['ok']
+    with fh.open('r') as h5:
+        assert np.isnan(h5['/data/I'].fillvalue)
+
+
+def test_build_virtual_concat(tmpdir):
+    paths, shots = _write_shots(str(tmpdir / 'shots'), t_step=4.)
+    output = str(tmpdir / 'campaign.h5')
+
+    fh = build_virtual(paths, '/data/I', 't', output)
+
+    X = fh.read_xarray('/data/I', backend='pytables')
+    X_ref = xr.concat(shots, dim='t')
+    np.testing.assert_array_equal(X.values, X_ref.values)
+    np.testing.assert_array_equal(X.t, X_ref.t)
+
+    with pytest.raises(ValueError, match='scale t differs'):
+        build_virtual(paths, '/data/I', 'shot', output, force=True)
+
+    # reading a subset only requires the files it overlaps
+    os.remove(paths[2])
+    X_sub = fh.read_xarray('/data/I', index=(slice(None), slice(None),
+                                             slice(2, 6)))
+    np.testing.assert_array_equal(X_sub.values, X_ref.values[..., 2:6])
+    # while reading a region mapped to a missing file fails
+    for backend in ('h5py', 'pytables'):
+        with pytest.raises(IOError,
+                           match='shot_2.h5:/data/I of /data/I not found'):
+            fh.read_xarray('/data/I', backend=backend)
+    with pytest.raises(IOError, match='not found'):
+        fh.read_xarray('/data/I', index=(0, 0, slice(1, 12, 4)))
+    report = fh.verify()
+    assert not report['ok']
+    assert report['errors'] == [{'location': '/data/I',
+                                 'error': 'virtual source '
+                                          'shots/shot_2.h5:/data/I '
+                                          'not found'}]
+
+    # the whole campaign directory can be moved
+    os.rename(str(tmpdir), str(tmpdir) + '_moved')
+    fh = PhiDataFile(os.path.join(str(tmpdir) + '_moved', 'campaign.h5'))
+    X_sub = fh.read_xarray('/data/I', index=(0, 0, slice(0, 4)))
+    xr.testing.assert_identical(X_sub.drop_attrs(),
+                                X_ref[0, 0, :4].drop_attrs())
+
+
+def test_build_virtual_encoded(tmpdir):
+    paths, shots = _write_shots(str(tmpdir / 'shots'), t_step=0.)
+    for path, X in zip(paths, shots):
+        PhiDataFile(path, 'w', force=True).write_xarray(
+            X, quantize='absolute', precision=1e-3)
+
+    # each file has its own quantization offset
+    with pytest.raises(ValueError, match='different encodings'):
+        build_virtual(paths, '/data/I', 'shot', str(tmpdir / 'out.h5'))
+
+
+def test_build_virtual_delta(tmpdir):
+    paths, shots = _write_shots(str(tmpdir / 'shots'), t_step=0.)
+    for path, X in zip(paths, shots):
+        PhiDataFile(path, 'a').write_xarray(X.rename('J'), delta_dim='t')
+
+    with pytest.raises(ValueError, match='delta encoding'):
+        build_virtual(paths, '/data/J', 'shot', str(tmpdir / 'out.h5'))
+
+
+def test_repack_virtual(tmpdir):
+    from phicore.archive import repack, convert
+
+    paths, shots = _write_shots(str(tmpdir / 'shots'), t_step=0.)
+    output = str(tmpdir / 'campaign.h5')
+    fh = build_virtual(paths, '/data/I', 'shot', output, concat_unit='index')
+    X = fh.read_xarray('/data/I')
+
+    # the mapping to the source files is kept rather than copied
+    report, = repack(output)
+    assert 'error' not in report
+    with fh.open('r') as h5:
+        assert h5['/data/I'].is_virtual
+    xr.testing.assert_identical(fh.read_xarray('/data/I'), X)
+    assert fh.verify()['ok']
+
+    # missing sources are not filled with NaN, while converting copies
+    # the values, which requires all the sources
+    os.remove(paths[1])
+    assert 'error' not in repack(output)[0]
+    with pytest.raises(IOError, match='shot_1.h5:/data/I of /data/I'):
+        fh.read_xarray('/data/I')
+    with pytest.raises(ValueError, match='shot_1.h5:/data/I of /data/I'):
+        convert(output, str(tmpdir / 'campaign.phi'))
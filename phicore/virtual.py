@@ -0,0 +1,198 @@
+# CeCILL-B license LIDYL, CEA
+
+"""Virtual aggregation of variables stored in several phicore files"""
+
+import os
+
+from typing import List, Dict, Any, Sequence
+
+from .io import PhiDataFile, _decode, _scale_path, _write_metadata
+from .encoding import is_encoding_attr
+
+
+def _read_metadata(path: str, location: str) -> Dict[str, Any]:
+    """Read the shape, dtype, scales and attributes of a variable"""
+    import h5py
+
+    with h5py.File(path, 'r') as fh:
+        node = fh[location]
+        if not isinstance(node, h5py.Dataset) or 'scales' not in node.attrs:
+            raise ValueError('{} in {} is not a phicore variable'
+                             .format(location, path))
+        dims = [_decode(el) for el in node.attrs['scales']]
+        coords = {}
+        units = {}
+        for dim in dims:
+            scale = fh[_scale_path(location, dim)]
+            coords[dim] = scale[:]
+            units[dim] = _decode(scale.attrs['unit'])
+        attrs = {key: val for key, val in node.attrs.items()
+                 if key not in ('name', 'scales') and not key.isupper()}
+        return {'shape': node.shape, 'dtype': node.dtype, 'dims': dims,
+                'coords': coords, 'units': units, 'attrs': attrs}
+
+
+def _encoding_attrs(attrs: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: _decode(val) for key, val in attrs.items()
+            if is_encoding_attr(key)}
+
+
+def _merge_attrs(all_attrs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Attributes that are present with the same value in all sources"""
+    import numpy as np
+
+    merged = {}
+    for key, value in all_attrs[0].items():
+        if all(key in attrs and np.array_equal(np.asarray(attrs[key]),
+                                               np.asarray(value))
+               for attrs in all_attrs[1:]):
+            merged[key] = value
+    return merged
+
+
+def build_virtual(paths: Sequence[str],
+                  location: str,
+                  concat_dim: str,
+                  output: str,
+                  concat_coords=None,
+                  concat_unit: str = '',
+                  force: bool = False) -> PhiDataFile:
+    """Aggregate a variable from several files without copying data
+
+    Creates a small phicore file whose variable is an HDF5 virtual dataset
+    mapping the variable ``location`` of each of the ``paths`` files, in
+    order. The result can be read with
+    :meth:`PhiDataFile.read_xarray <phicore.io.PhiDataFile.read_xarray>`
+    as any other variable, and reading a subset with ``index`` only
+    accesses the source files that it overlaps.
+
+    Source files are referenced with paths relative to ``output``, so that
+    a directory holding both can be moved as a whole. Reading a region
+    mapped to a source file that no longer exists raises an IOError, and
+    :meth:`PhiDataFile.verify <phicore.io.PhiDataFile.verify>` reports
+    missing sources.
+
+    Parameters
+    ----------
+    paths : list of str
+      the source files
+    location : str
+      path of the variable in the source files, e.g. ``/data/I``. The
+      virtual variable is stored at ``/data/<name>`` in the output.
+    concat_dim : str
+      the dimension along which sources are aggregated. If it is an
+      existing dimension of the variable, sources are concatenated along
+      it, and the output scale is the concatenation of the source scales.
+      Otherwise a new leading dimension with this name is created and
+      sources are stacked along it.
+    output : str
+      path of the phicore file to create
+    concat_coords : array-like, optional
+      coordinates of the new dimension when stacking, by default the
+      index of each source file
+    concat_unit : str
+      unit of the new dimension when stacking
+    force : bool
+      overwrite ``output`` if it exists
+
+    Returns
+    -------
+    fh : PhiDataFile
+      the created file, opened in read mode
+    """
+    import h5py
+    import numpy as np
+
+    dataset_name = os.path.basename(location)
+    if not dataset_name:
+        raise ValueError(('Not a valid path {} inside hdf5 for loading '
+                          'xarrays. Must be of the form '
+                          '/<folder>/<array_name>.').format(location))
+    if not paths:
+        raise ValueError('at least one source file must be provided')
+
+    sources = [_read_metadata(path, location) for path in paths]
+    ref = sources[0]
+    if _encoding_attrs(ref['attrs']).get('encoding') == 'delta':
+        # keyframes would not be aligned in the aggregated variable
+        raise ValueError('{} in {} is stored with the delta encoding, which '
+                         'cannot be aggregated'.format(location, paths[0]))
+    for path, src in zip(paths[1:], sources[1:]):
+        if src['dims'] != ref['dims']:
+            raise ValueError('{} has dims {} while {} has dims {}'
+                             .format(path, src['dims'], paths[0],
+                                     ref['dims']))
+        if src['dtype'] != ref['dtype']:
+            raise ValueError('{} has dtype {} while {} has dtype {}'
+                             .format(path, src['dtype'], paths[0],
+                                     ref['dtype']))
+        if _encoding_attrs(src['attrs']) != _encoding_attrs(ref['attrs']):
+            raise ValueError('{} and {} are stored with different encodings'
+                             .format(path, paths[0]))
+        for dim in ref['dims']:
+            if src['units'][dim] != ref['units'][dim]:
+                raise ValueError('unit of {} differs between {} and {}'
+                                 .format(dim, path, paths[0]))
+            if dim != concat_dim and not np.array_equal(src['coords'][dim],
+                                                        ref['coords'][dim]):
+                raise ValueError('scale {} differs between {} and {}'
+                                 .format(dim, path, paths[0]))
+
+    dims = list(ref['dims'])
+    units = dict(ref['units'])
+    coords = dict(ref['coords'])
+    if concat_dim in dims:
+        axis = dims.index(concat_dim)
+        coords[concat_dim] = np.concatenate([src['coords'][concat_dim]
+                                             for src in sources])
+    else:
+        axis = 0
+        dims.insert(0, concat_dim)
+        units[concat_dim] = concat_unit
+        if concat_coords is None:
+            concat_coords = np.arange(len(paths))
+        concat_coords = np.asarray(concat_coords)
+        if concat_coords.shape != (len(paths),):
+            raise ValueError('concat_coords must have one value per file, '
+                             'got shape {}'.format(concat_coords.shape))
+        coords[concat_dim] = concat_coords
+    shape = tuple(len(coords[dim]) for dim in dims)
+
+    output_dir = os.path.dirname(os.path.abspath(output))
+    layout = h5py.VirtualLayout(shape=shape, dtype=ref['dtype'])
+    offset = 0
+    for path, src in zip(paths, sources):
+        try:
+            src_path = os.path.relpath(os.path.abspath(path), output_dir)
+        except ValueError:
+            # e.g. on a different drive on Windows
+            src_path = os.path.abspath(path)
+        vsource = h5py.VirtualSource(src_path, location, shape=src['shape'],
+                                     dtype=src['dtype'])
+        index = [slice(None)] * len(shape)
+        if concat_dim in ref['dims']:
+            index[axis] = slice(offset, offset + src['shape'][axis])
+            offset += src['shape'][axis]
+        else:
+            index[axis] = offset
+            offset += 1
+        layout[tuple(index)] = vsource
+
+    # regions whose source cannot be read are filled with NaN (or with
+    # the code standing for NaN of the scale-offset encoding)
+    dtype = np.dtype(ref['dtype'])
+    fillvalue = None
+    if dtype.kind in 'fc':
+        fillvalue = np.array(complex(np.nan, np.nan) if dtype.kind == 'c'
+                             else np.nan, dtype=dtype)
+    elif _encoding_attrs(ref['attrs']).get('encoding') == 'scale-offset':
+        fillvalue = np.array(ref['attrs']['encoding_fill'], dtype=dtype)
+
+    fh = PhiDataFile(output, 'w', force=force)
+    data_location = '/data/' + dataset_name
+    with fh.open('a') as h5:
+        h5.create_virtual_dataset(data_location, layout, fillvalue=fillvalue)
+        _write_metadata(h5, data_location, dataset_name, dims, coords,
+                        units, _merge_attrs([src['attrs']
+                                             for src in sources]))
+    return PhiDataFile(fh.fullpath, 'r')
@@ -11,4 +11,7 @@ setup(
     author="LIDYL CEA",
     description="Spatio temporal laser metrology package",
     long_description=open('README.rst').read(),
+    entry_points={
+        'console_scripts': ['phicore = phicore.cli:main'],
+    },
 )